@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.aio
+----------------------------------
+
+Defines :class:`.AsyncBulletBot` and :class:`.AsyncSlackBulletBot`.
+
+The synchronous :class:`.BulletBot` remains the source of truth for
+all bullet logic.  These classes put an :mod:`asyncio` front on it:
+the websocket is multiplexed on the event loop and the blocking
+database/HTTP calls are handed to a bounded thread pool, so one
+process can serve many concurrent conversations.
+
+Example usage::
+
+    loop = asyncio.get_event_loop()
+    abot = AsyncBulletBot()
+    loop.run_until_complete(abot.create_bullet('user1', 'Test bullet'))
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import asyncio
+import logging
+
+from .bulletbot import BulletBot
+from .slack import SlackBulletBot
+
+
+class AsyncBulletBot(object):
+    """Awaitable interface to a :class:`.BulletBot`."""
+
+    logger = logging.getLogger(__name__)
+
+    _default_workers = 8
+
+    def __init__(self, bot=None, loop=None, max_workers=None):
+        """
+        :param bot: :class:`.BulletBot` to wrap, one is created if None
+        :param loop: event loop, defaults to the current loop
+        :param int max_workers:
+            Size of the pool running blocking calls.  Should not be
+            larger than the database connection pool.
+
+        """
+
+        self.bot = bot or BulletBot()
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or self._default_workers)
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking callable on the worker pool.
+
+        :param func: callable to run
+        :returns: the result of ``func(*args, **kwargs)``
+
+        """
+
+        call = partial(func, *args, **kwargs)
+        return await self.loop.run_in_executor(self.executor, call)
+
+    async def create_bullet(self, nick, text):
+        """Awaitable :meth:`.BulletBot.create_bullet`"""
+
+        return await self.run(self.bot.create_bullet, nick, text)
+
+    async def list_bullets(self, nick):
+        """Awaitable :meth:`.BulletBot.list_bullets`"""
+
+        return await self.run(self.bot.list_bullets, nick)
+
+    async def delete_bullets(self, nick, text):
+        """Awaitable :meth:`.BulletBot.delete_bullets`"""
+
+        return await self.run(self.bot.delete_bullets, nick, text)
+
+    async def register_nick(self, nick, text):
+        """Awaitable :meth:`.BulletBot.register_nick`"""
+
+        return await self.run(self.bot.register_nick, nick, text)
+
+    def close(self):
+        """Wait for outstanding calls and release the worker pool."""
+
+        self.executor.shutdown(wait=True)
+
+
+class AsyncSlackBulletBot(SlackBulletBot):
+    """SlackBulletBot that reads the RTM websocket from an event loop.
+
+    The socket is registered with :meth:`loop.add_reader` instead of
+    being read in a blocking loop.  Each event is parsed on the worker
+    pool, serialized per channel so a user's bullets keep their
+    order.
+
+    """
+
+    _default_workers = 8
+
+    def __init__(self, db=None, token=None, loop=None, max_workers=None):
+        super(AsyncSlackBulletBot, self).__init__(db, token)
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or self._default_workers)
+        self._channel_locks = {}
+        self._channel_waiting = {}
+        self._disconnected = None
+
+    async def _run(self, func, *args):
+        return await self.loop.run_in_executor(self.executor,
+                                               partial(func, *args))
+
+    async def listen_async(self):
+        """Connect a websocket and dispatch incoming events until the
+        connection drops, then reconnect.
+
+        """
+
+        while True:
+            connected = await self._run(self.rtm_connect)
+            if connected:
+                await self._serve()
+            else:
+                self.logger.error("Connection Failed, invalid token?")
+
+            await asyncio.sleep(1)
+            self.reset_sc()
+
+    async def _serve(self):
+        """Watch the websocket until it errors out."""
+
+        sock = self.sc.server.websocket.sock
+        sock.setblocking(False)
+        fd = sock.fileno()
+
+        self._disconnected = self.loop.create_future()
+        self.loop.add_reader(fd, self._on_readable)
+        try:
+            await self._disconnected
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            self.loop.remove_reader(fd)
+
+    def _on_readable(self):
+        """Drain the websocket and schedule a task per event.
+
+        The SSL layer may have buffered more than one frame, so keep
+        reading until :meth:`rtm_read` comes back empty.
+
+        """
+
+        try:
+            while True:
+                reads = self.rtm_read()
+                if not reads:
+                    break
+                for read in reads:
+                    self.loop.create_task(self._dispatch(read))
+        except Exception as e:
+            if not self._disconnected.done():
+                self._disconnected.set_exception(e)
+
+    async def _dispatch(self, read):
+        """Parse a single read on the worker pool, one at a time per
+        channel.
+
+        :param dict read: JSON read from websocket
+
+        """
+
+        channel = read.get('channel')
+        lock = self._channel_locks.setdefault(channel, asyncio.Lock())
+        self._channel_waiting[channel] = \
+            self._channel_waiting.get(channel, 0) + 1
+        try:
+            async with lock:
+                await self._run(self._parse_read, read)
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            # Forget the lock once nobody is queued on it so idle
+            # channels don't accumulate
+            self._channel_waiting[channel] -= 1
+            if not self._channel_waiting[channel]:
+                del self._channel_waiting[channel]
+                del self._channel_locks[channel]
+
+    def listen(self):
+        """Blocking entry point that runs :meth:`listen_async` on the
+        event loop.
+
+        """
+
+        self.loop.run_until_complete(self.listen_async())
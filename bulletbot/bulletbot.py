@@ -5,25 +5,39 @@ bulletbot.bulletbot
 ----------------------------------
 
 Defines :class:`.BulletBot`.
+
+Subsystems only some entry points use (markov text, email, the
+dispatcher's scheduler, export/import, archiving, spell checking) are
+imported where they are used, so the chat bots start without loading
+them.
 """
 
+from collections import OrderedDict
+
 import configargparse
 import logging
-import markovify
+import os
 import re
-import smtplib
 import sqlalchemy as sa
-import textwrap
+import tempfile
 import time
 
-from apscheduler.schedulers.blocking import BlockingScheduler
-from email.mime.text import MIMEText
-from getpass import getpass
+from datetime import date, datetime, timedelta, timezone
 
 from .driver import SQLAlchemyDriver
+from .journal import BulletJournal, JournalReplayer
+from . import commands
+from . import history
+from . import log
+from . import minhash
+from . import queries
+from . import rollups
+from . import search
 
 from .models import (
+    ArchivedBullet,
     Recipient,
+    Team,
     User,
     Bullet,
 )
@@ -44,6 +58,18 @@ class BulletBot(object):
     logger = logging.getLogger(__name__)
 
     _email_width = 80
+
+    # Workspace of a bot serving one of several Slack workspaces, see
+    # bulletbot.workspaces
+    tenant = None
+    _page_size = 20
+
+    # Chat command responses, see bulletbot.commands
+    help_message = ("Talk to me to add bullets.  Commands: .list, .delete, "
+                    ".search, .history, .stats, .team, .register")
+    unknown_command = "Sorry, I don't know that command."
+    flood_message = "Too many commands, try again shortly."
+    excluded_commands = ()
     _default_configs = [
         '~/.bulletbot.ini',
         '/etc/bulletbot.ini',
@@ -71,14 +97,78 @@ class BulletBot(object):
         assert hasattr(self.db.session, '__call__'),\
             'Driver session manager not callable'
 
+        self.page_cursors = history.PageCursors()
+        self.router = self.get_router()
+        self.journal = self.get_journal()
+        self.enricher = self.get_enricher()
+
+    def prepare_db(self):
+        """Create the schema if it isn't current and fill the connection
+        pool.  Safe to call from a background thread while a frontend
+        connects, see :meth:`.SlackBulletBot.rtm_connect`.
+
+        """
+
+        if getattr(self, '_db_prepared', False):
+            return
+
+        start = time.time()
+        if hasattr(self.db, 'ensure_schema'):
+            self.db.ensure_schema(self.db_settings)
+        if hasattr(self.db, 'warm_up'):
+            self.db.warm_up()
+        self._db_prepared = True
+
+        self.logger.info('Database ready in %.2fs', time.time() - start)
+
     @property
     def db_settings(self):
-        return dict(
-            host=self.args.host,
-            user=self.args.user,
-            password=self.args.password,
-            database=self.args.database,
+        return self.get_db_settings(self.args)
+
+    @staticmethod
+    def get_db_settings(args):
+        """:class:`.SQLAlchemyDriver` keyword arguments from parsed
+        :meth:`get_parser` arguments
+
+        """
+
+        settings = dict(
+            host=args.host,
+            user=args.user,
+            password=args.password,
+            database=args.database,
+            backend=args.backend,
         )
+        if getattr(args, 'replicas', None):
+            settings['replicas'] = [
+                url.strip() for url in args.replicas.split(',')
+                if url.strip()]
+            settings['max_replica_lag'] = args.max_replica_lag
+        return settings
+
+    def read_session(self, nick=None):
+        """A session for reads that a replica may serve, see
+        :mod:`bulletbot.driver`.
+
+        :param str nick: The user reading, if any
+
+        """
+
+        if getattr(self.db, 'replicas', None):
+            return self.db.session(readonly=True, nick=nick)
+        return self.db.session()
+
+    def write_session(self, nick):
+        """A session for writes by a user, whose following reads then go
+        to the primary.
+
+        :param str nick: The user writing
+
+        """
+
+        if getattr(self.db, 'replicas', None):
+            return self.db.session(nick=nick)
+        return self.db.session()
 
     @staticmethod
     def get_parser():
@@ -89,7 +179,32 @@ class BulletBot(object):
         parser.add('-d', '--database', env_var='BBOT_DATABASE', default='bullets')
         parser.add('-u', '--user', env_var='BBOT_USER', required=True)
         parser.add('-p', '--password', env_var='BBOT_PASS', required=True)
+        parser.add('--backend', env_var='BBOT_BACKEND', default='postgresql',
+                   choices=['postgresql', 'sqlite'],
+                   help='database backend, for sqlite --database is the '
+                   'file path')
+        parser.add('--replicas', env_var='BBOT_REPLICAS',
+                   help='comma separated SQLAlchemy URLs of read replicas')
+        parser.add('--max-replica-lag', env_var='BBOT_MAX_REPLICA_LAG',
+                   type=float, default=5.0,
+                   help='read from the primary when replicas are further '
+                   'behind than this many seconds')
         parser.add('-t', '--token', env_var='BBOT_SLACK_TOKEN')
+        parser.add('--slack-tokens', env_var='BBOT_SLACK_TOKENS',
+                   help='comma separated bot tokens of several workspaces '
+                   'to serve from one process')
+        parser.add('--asyncio', env_var='BBOT_ASYNCIO', action='store_true',
+                   help='serve slack from an asyncio event loop')
+        parser.add('--record-rtm', env_var='BBOT_RECORD_RTM',
+                   help='record slack events to this gzipped file for '
+                   '`bulletbot replay`')
+        parser.add('--record-anonymize', env_var='BBOT_RECORD_ANONYMIZE',
+                   action='store_true',
+                   help='hash message text in the recording')
+        parser.add('--startup-budget', env_var='BBOT_STARTUP_BUDGET',
+                   type=float, default=3.0,
+                   help='warn if connecting takes longer than this many '
+                   'seconds')
 
         parser.add('--email-user', env_var='BBOT_EMAIL_USER')
         parser.add('--email-from', env_var='BBOT_EMAIL_FROM')
@@ -100,15 +215,199 @@ class BulletBot(object):
                    type=int, default=587)
         parser.add('--cron-hour', env_var='BBOT_CRON_HOUR')
         parser.add('--cron-minute', env_var='BBOT_CRON_MINUTE')
+        parser.add('--cron-timezone', env_var='BBOT_CRON_TIMEZONE',
+                   help='timezone of the cron schedule, defaults to local')
+        parser.add('--send-jitter', env_var='BBOT_SEND_JITTER',
+                   type=int, default=300,
+                   help='spread sends over up to this many seconds')
+        parser.add('--misfire-grace', env_var='BBOT_MISFIRE_GRACE',
+                   type=int, default=6 * 3600,
+                   help='send a missed digest up to this many seconds late')
+        parser.add('--schedule-minutes', env_var='BBOT_SCHEDULE_MINUTES',
+                   type=int, default=5,
+                   help='how often team schedules are reread')
+        parser.add('--digest-summary', env_var='BBOT_DIGEST_SUMMARY',
+                   action='store_true',
+                   help='start the digest with top terms per user')
+        parser.add('--digest-processes', env_var='BBOT_DIGEST_PROCESSES',
+                   type=int,
+                   help='processes used to build team digests, defaults '
+                   'to the number of CPUs')
+        parser.add('--spellcheck', env_var='BBOT_SPELLCHECK',
+                   action='store_true',
+                   help='spell check bullets for the digest')
+        parser.add('--spellcheck-lang', env_var='BBOT_SPELLCHECK_LANG',
+                   default='en_US')
+        parser.add('--duplicate-days', env_var='BBOT_DUPLICATE_DAYS',
+                   type=int, default=30,
+                   help='flag bullets that nearly repeat one from the '
+                   'last N days, 0 to disable')
+        parser.add('--collapse-duplicates', env_var='BBOT_COLLAPSE_DUPLICATES',
+                   action='store_true',
+                   help='list repeated bullets once in the digest')
+        parser.add('--workers', env_var='BBOT_WORKERS', type=int, default=4,
+                   help='threads used to run chat commands')
+        parser.add('--queue-depth', env_var='BBOT_QUEUE_DEPTH',
+                   type=int, default=1000,
+                   help='queued events per lane before reading pauses')
+        parser.add('--shed-depth', env_var='BBOT_SHED_DEPTH',
+                   type=int, default=200,
+                   help='defer --shed-lanes while more commands and '
+                   'bullets than this are queued')
+        parser.add('--shed-lag', env_var='BBOT_SHED_LAG',
+                   type=float, default=5.0,
+                   help='defer --shed-lanes while a command or bullet has '
+                   'waited longer than this many seconds')
+        parser.add('--shed-lanes', env_var='BBOT_SHED_LANES',
+                   default='enrich',
+                   help='comma separated lanes deferred under load: bulk, '
+                   'enrich')
+        parser.add('--flood-rate', env_var='BBOT_FLOOD_RATE',
+                   type=float, default=1.0,
+                   help='commands per second allowed per user, 0 for no '
+                   'limit')
+        parser.add('--flood-burst', env_var='BBOT_FLOOD_BURST',
+                   type=int, default=20,
+                   help='commands per user allowed at once')
+        parser.add('--metrics-interval', env_var='BBOT_METRICS_INTERVAL',
+                   type=float, default=60,
+                   help='seconds between queue metrics in the log')
+        parser.add('--command-rate', env_var='BBOT_COMMAND_RATE',
+                   type=float, default=0,
+                   help='.history, .search and .stats commands per second '
+                   'allowed per user, 0 for no limit')
+        parser.add('--command-burst', env_var='BBOT_COMMAND_BURST',
+                   type=int, default=5,
+                   help='.history, .search and .stats commands per user '
+                   'allowed at once')
+        parser.add('--journal-dir', env_var='BBOT_JOURNAL_DIR',
+                   help='directory to journal bullets in while the '
+                   'database is unavailable')
+        parser.add('--retention-days', env_var='BBOT_RETENTION_DAYS',
+                   type=int, help='archive sent bullets older than this')
+        parser.add('--archive-dir', env_var='BBOT_ARCHIVE_DIR',
+                   help='directory to dump archived bullets to')
+        parser.add('--rollup-minutes', env_var='BBOT_ROLLUP_MINUTES',
+                   type=int, default=15,
+                   help='how often the dispatcher refreshes .stats')
+        parser.add('--profile-dir', env_var='BBOT_PROFILE_DIR',
+                   default=os.path.join(tempfile.gettempdir(),
+                                        'bulletbot-profiles'),
+                   help='where kill -USR1/-USR2 write profiles and stacks')
+        parser.add('--profile-seconds', env_var='BBOT_PROFILE_SECONDS',
+                   type=float, default=30)
+        parser.add('--log-level', env_var='BBOT_LOG_LEVEL', default='INFO')
+        parser.add('--log-format', env_var='BBOT_LOG_FORMAT', default='text',
+                   choices=['text', 'json'])
+        parser.add('--log-max-length', env_var='BBOT_LOG_MAX_LENGTH',
+                   type=int, default=log.MAX_LENGTH,
+                   help='truncate longer log messages, 0 to disable')
 
         return parser
 
+    def setup_logging(self):
+        """Log through a background thread, see :mod:`bulletbot.log`.
+
+        :returns: the root logger's :class:`.TruncatingQueueHandler`
+
+        """
+
+        return log.setup_logging(self.args.log_level, self.args.log_format,
+                                 self.args.log_max_length)
+
+    def get_router(self):
+        """Build the chat command router with a timer on every command
+        and ``--command-rate`` limits on the expensive ones.
+
+        :returns: :class:`.CommandRouter`
+
+        """
+
+        router = commands.CommandRouter(exclude=self.excluded_commands)
+        self.command_timer = commands.Timer()
+        router.use(self.command_timer)
+        if getattr(self.args, 'command_rate', 0):
+            router.use(commands.RateLimit(self.args.command_rate,
+                                          self.args.command_burst),
+                       commands.EXPENSIVE)
+        return router
+
+    def get_journal(self):
+        """Open the ``--journal-dir`` journal and start replaying it, see
+        :mod:`bulletbot.journal`.
+
+        :returns: :class:`.BulletJournal` or None
+
+        """
+
+        if not getattr(self.args, 'journal_dir', None):
+            return None
+        journal = BulletJournal(self.args.journal_dir)
+        self.replayer = JournalReplayer(journal, self.db,
+                                        cursors=self.page_cursors)
+        self.replayer.start()
+        return journal
+
+    def get_enricher(self):
+        """Spell check bullets in the background with ``--spellcheck``,
+        see :mod:`bulletbot.spelling`.
+
+        :returns: :class:`.Enricher` or None
+
+        """
+
+        if not getattr(self.args, 'spellcheck', False):
+            return None
+        from . import spelling
+        return spelling.Enricher(
+            self.db, spelling.Speller(self.args.spellcheck_lang))
+
+    def help_text(self, nick):
+        return self.help_message
+
+    def start_lanes(self):
+        """Queue chat work in priority lanes with per user flood
+        limits on commands, see :mod:`bulletbot.executor`.  Spell
+        checking moves to the enrichment lane.
+
+        """
+
+        from .executor import FloodLimiter, LaneExecutor
+        self.lanes = LaneExecutor(
+            max_workers=self.args.workers,
+            max_depth=self.args.queue_depth,
+            shed_depth=self.args.shed_depth,
+            shed_lag=self.args.shed_lag,
+            shed_lanes=[lane.strip() for lane in
+                        self.args.shed_lanes.split(',') if lane.strip()],
+            metrics_interval=self.args.metrics_interval,
+        )
+        self.flood = FloodLimiter(self.args.flood_rate, self.args.flood_burst)
+        if self.enricher is not None:
+            self.enricher.lanes = self.lanes
+
+    def install_profiler(self):
+        """Profile the process on SIGUSR1 and dump thread stacks on
+        SIGUSR2, see :mod:`bulletbot.profiling`.  Call from the main
+        thread.
+
+        :returns: :class:`.Profiler`
+
+        """
+
+        from .profiling import Profiler
+        profiler = Profiler(self.args.profile_dir, self.args.profile_seconds)
+        profiler.install()
+        return profiler
+
     @staticmethod
-    def tokenize(text, delim=',[ ]*|[ ]+'):
+    def tokenize(text, delim=None):
         """Tokenize a string for with regex deplimeter
 
         :param text: The string you want to tokenize
-        :param delim=',[ ]*|[ ]+': Delimiter to tokenize on
+        :param delim:
+            Delimiter to tokenize on, commas and spaces if None, see
+            :func:`bulletbot.commands.tokenize`
         :returns: :class:`list` of :class:`str` tokens
 
         Example:
@@ -117,19 +416,43 @@ class BulletBot(object):
 
         """
 
+        if delim is None:
+            return commands.tokenize(text)
         return [index.strip() for index in re.split(delim, text)]
 
     def markov_nick(self, nick):
-        with self.db.session() as s:
+        with self.read_session(nick) as s:
             user = s.query(User).filter(User.nick == nick).first()
             if not user:
                 return None
             else:
                 bullets = [b.bullet for b in user.bullets]
 
+        import markovify
         model = markovify.Text('\n'.join(bullets))
         return model.make_sentence(retries=100)
 
+    def qualify(self, name):
+        """Return the nick a chat user name is stored under.  Bots
+        serving one of several Slack workspaces prefix it with the
+        workspace, see :mod:`bulletbot.workspaces`.
+
+        :param str name: The user name on the chat server
+
+        """
+
+        if self.tenant is None:
+            return name
+        return '{}/{}'.format(self.tenant, name)
+
+    def unqualify(self, nick):
+        """Inverse of :meth:`qualify`, for display"""
+
+        prefix = self.qualify('')
+        if self.tenant is not None and nick.startswith(prefix):
+            return nick[len(prefix):]
+        return nick
+
     def merge_nick(self, nick, realname=None):
         """If no :class:`.models.User` entry with `nick` exists in the
         database, create it.  Since we have a foreign key relationship
@@ -145,6 +468,8 @@ class BulletBot(object):
         user.nick = str(nick)
         if realname is not None:
             user.realname = realname
+        if self.tenant is not None:
+            user.tenant = self.tenant
 
         with self.db.session() as s:
             s.merge(user)
@@ -170,6 +495,33 @@ class BulletBot(object):
         self.logger.info(response)
         return response
 
+    def join_team(self, nick, text):
+        """Move a user to a team.  The user's bullets go out in that
+        team's digest.  Without a team name, the user leaves their team.
+
+        :param str nick: The nickname of the user
+        :param str text: The team name
+        :returns: :class:`str` with channel response
+
+        """
+
+        name = self.qualify(text.strip()) if text.strip() else None
+        user = User()
+        user.nick = nick
+        with self.db.session() as s:
+            if name is not None:
+                s.merge(Team(name=name))
+            user = s.merge(user)
+            user.team = name
+
+        if name is None:
+            response = "{} is not on a team".format(self.unqualify(nick))
+        else:
+            response = "{} joined team {}".format(
+                self.unqualify(nick), self.unqualify(name))
+        self.logger.info(response)
+        return response
+
     @staticmethod
     def unsent(s, nick):
         """Query database for a user's unsent bullets (as noted by last_sent
@@ -183,7 +535,8 @@ class BulletBot(object):
 
         return (s.query(Bullet)
                 .filter(Bullet.last_sent == None)  # noqa
-                .filter(Bullet.nick == nick))
+                .filter(Bullet.nick == nick)
+                .order_by(Bullet.datetime, Bullet.id))
 
     def create_bullet(self, nick, text):
         """Create a new bullet with the user's nick.
@@ -194,40 +547,313 @@ class BulletBot(object):
 
         """
 
-        self.merge_nick(nick)
-        bullet = Bullet()
-        bullet.bullet = text
-        bullet.nick = nick
-        with self.db.session() as s:
-            s.merge(bullet)
+        return self.create_bullets(nick, [text])[0]
 
-        response = 'Wrote bullet: {}'.format(bullet.bullet)
+    def create_bullets(self, nick, texts, realname=None, source=None):
+        """Create several bullets with the user's nick in a single
+        transaction.  This is the write path shared by all frontends.
 
-        self.logger.info((nick, response))
-        return response
+        If a journal is configured, the bullets are journaled first and
+        a database outage is not an error: they will be written when
+        the database comes back.
+
+        :param str nick: The nickname of the user
+        :param list texts: :class:`list` of :class:`str` bullet texts
+        :param str realname: The pretty name of the user, if known
+        :param str source:
+            Unique id of the chat message the texts came from.  A
+            message that was already stored is not stored again.
+        :returns: :class:`list` of :class:`str` channel responses
+
+        """
+
+        source_ids = None
+        if source is not None:
+            source_ids = ['{}/{}'.format(source, n)
+                          for n in range(len(texts))]
+
+        records = None
+        if self.journal:
+            records = self.journal.append(nick, texts, source_ids,
+                                          tenant=self.tenant)
+
+        user = User()
+        user.nick = str(nick)
+        if realname is not None:
+            user.realname = realname
+        if self.tenant is not None:
+            user.tenant = self.tenant
+
+        ids = []
+        try:
+            with self.write_session(nick) as s:
+                s.merge(user)
+                for n, text in enumerate(texts):
+                    bullet = Bullet()
+                    bullet.bullet = text
+                    bullet.nick = nick
+                    bullet.tenant = self.tenant
+                    if source_ids:
+                        bullet.source_id = source_ids[n]
+                    s.add(bullet)
+                    self.flag_duplicate(s, bullet)
+                    s.flush()
+                    ids.append(bullet.id)
+        except sa.exc.IntegrityError:
+            if source_ids is None or not self.source_stored(nick, source_ids):
+                raise
+            self.logger.info('Message %s already stored', source)
+            if records:
+                self.journal.ack(records)
+        except (sa.exc.OperationalError,
+                sa.exc.InterfaceError,
+                sa.exc.TimeoutError) as e:
+            if records is None:
+                raise
+            self.logger.warning(
+                'Database unavailable, %s bullets left in journal: %s',
+                len(records), e)
+            self.journal.defer(records)
+        else:
+            if records:
+                self.journal.ack(records)
+            if self.enricher:
+                self.enricher.submit(ids)
+
+        self.page_cursors.invalidate(nick)
+        responses = ['Wrote bullet: {}'.format(text) for text in texts]
+
+        self.logger.debug('%s: %s', nick, responses)
+        return responses
+
+    def source_stored(self, nick, source_ids):
+        """Whether bullets from a chat message were already stored, to
+        tell a redelivered message from any other integrity error.  Asks
+        the primary, which a replica may lag behind.
+
+        :param str nick: The user writing
+        :param list source_ids: the message's source ids
 
-    def list_bullets(self, nick):
+        """
+
+        with self.write_session(nick) as s:
+            return s.query(
+                s.query(Bullet)
+                .filter(Bullet.source_id.in_(source_ids))
+                .exists()).scalar()
+
+    def flag_duplicate(self, s, bullet):
+        """Point :attr:`.Bullet.duplicate_of` at a recent bullet the new
+        bullet nearly repeats, and add it to the near-duplicate index.
+        Does nothing if ``--duplicate-days`` is 0.
+
+        :param s: :class:`sqlalchemy.orm.session.Session`
+        :param bullet: the new :class:`.Bullet`, added to `s`
+
+        """
+
+        if not self.args.duplicate_days:
+            return
+
+        since = (datetime.now(timezone.utc) -
+                 timedelta(days=self.args.duplicate_days))
+        duplicate, keys = minhash.find_duplicate(
+            s, bullet.nick, bullet.bullet, since)
+        if duplicate is not None:
+            bullet.duplicate_of = duplicate.duplicate_of or duplicate.id
+            self.logger.info('%s repeats %s', bullet, duplicate)
+
+        s.flush()
+        minhash.index(s, bullet, keys)
+
+    def list_bullets(self, nick, text=''):
         """List unsent (as noted by last_sent column) bullets with the user's
-        nick.
+        nick, one page at a time.
+
+        Example text::
+
+            "--page 2"
 
         :param str nick: The nickname of the user
+        :param str text: optional ``--page N``
         :returns: :class:`str` with channel response
 
         """
 
-        with self.db.session() as s:
-            bullets = [b.bullet for b in self.unsent(s, nick).all()]
+        return self.router.dispatch(self, nick, '.list', text)
+
+    def _list_bullets(self, nick, page=1):
+        """List a page of unsent bullets
+
+        :param str nick: The nickname of the user
+        :param int page: 1 based page number
+        :returns: :class:`str` with channel response
+
+        .. seealso::
+
+            :ref:`.list_bullets`
+
+        """
+
+        with self.read_session(nick) as s:
+            rows, has_more = history.get_page(
+                [queries.unsent_page(s, nick)], page, self._page_size,
+                self.page_cursors, (nick, 'unsent'))
 
         def get_line(n, bullet):
             return '{n}. {bullet}'.format(n=n, bullet=bullet)
 
-        if bullets:
-            lines = [get_line(n, bullet) for n, bullet in enumerate(bullets)]
+        start = (page - 1) * self._page_size
+        if rows:
+            lines = [get_line(n, row.bullet)
+                     for n, row in enumerate(rows, start)]
+            if has_more:
+                lines.append('... more on `.list --page {}`'
+                             .format(page + 1))
             response = '\n'.join(lines)
+        elif page > 1:
+            response = "No page {}.".format(page)
         else:
             response = "No unsent bullets."
 
-        self.logger.info((nick, response))
+        self.logger.debug('%s: %s', nick, response)
+        return response
+
+    def history_bullets(self, nick, since=None, until=None, page=1,
+                        limit=None, include_archive=False):
+        """Page through all of a user's bullets, sent or not, oldest
+        first.
+
+        :param str nick: The nickname of the user
+        :param datetime since: only bullets created at or after
+        :param datetime until: only bullets created before
+        :param int page: 1 based page number
+        :param int limit: page size
+        :param bool include_archive: also page through archived bullets
+        :returns: ``(rows, has_more)``
+
+        """
+
+        limit = limit or self._page_size
+        models = [Bullet, ArchivedBullet] if include_archive else [Bullet]
+
+        def get_query(s, model):
+            query = (s.query(model.id, model.bullet, model.datetime,
+                             model.last_sent)
+                     .filter(model.nick == nick))
+            if since is not None:
+                query = query.filter(model.datetime >= since)
+            if until is not None:
+                query = query.filter(model.datetime < until)
+            return query, model
+
+        listing = (nick, 'history', since, until, limit, include_archive)
+        with self.read_session(nick) as s:
+            return history.get_page(
+                [get_query(s, model) for model in models], page, limit,
+                self.page_cursors, listing)
+
+    def history(self, nick, text):
+        """Show a page of a user's bullet history.
+
+        Example text::
+
+            "2016-01-01 2016-02-01 --page 2"
+
+        :param str nick: The nickname of the user
+        :param str text: ``[since] [until] [--page N]`` with YYYY-MM-DD dates
+        :returns: :class:`str` with channel response
+
+        """
+
+        return self.router.dispatch(self, nick, '.history', text)
+
+    def _history(self, nick, since=None, until=None, page=1):
+        """Show a page of a user's bullet history
+
+        :param str nick: The nickname of the user
+        :param datetime since: only bullets created at or after
+        :param datetime until: only bullets created before
+        :param int page: 1 based page number
+        :returns: :class:`str` with channel response
+
+        .. seealso::
+
+            :ref:`.history`
+
+        """
+
+        rows, has_more = self.history_bullets(
+            nick, since=since, until=until, page=page)
+
+        def get_line(row):
+            return '{:%Y-%m-%d}: {}'.format(row.datetime, row.bullet)
+
+        if rows:
+            lines = [get_line(row) for row in rows]
+            if has_more:
+                lines.append('... more on `.history {}--page {}`'.format(
+                    ''.join('{:%Y-%m-%d} '.format(d) for d in (since, until)
+                            if d), page + 1))
+            response = '\n'.join(lines)
+        else:
+            response = "No bullets found."
+
+        self.logger.debug('%s: %s', nick, response)
+        return response
+
+    def search_bullets(self, query, nick=None, since=None, limit=10,
+                       after=None, include_archive=False):
+        """Ranked full text search over all bullets, sent or not.
+
+        :param str query: free text search terms
+        :param str nick: only search this nick's bullets
+        :param datetime since: only search bullets created at or after
+        :param int limit: page size
+        :param after:
+            last :class:`.search.SearchResult` of the previous page
+        :param bool include_archive: also search archived bullets
+        :returns: :class:`list` of :class:`.search.SearchResult`
+
+        """
+
+        with self.read_session(nick) as s:
+            return search.search(s, query, nick=nick, since=since,
+                                 limit=limit, after=after,
+                                 include_archive=include_archive)
+
+    def search(self, nick, text):
+        """Search a user's bullet history for `text`.
+
+        :param str nick: The nickname of the user
+        :param str text: search terms
+        :returns: :class:`str` with channel response
+
+        """
+
+        return self.router.dispatch(self, nick, '.search', text)
+
+    def _search(self, nick, text):
+        """Search a user's bullets for terms already checked by
+        :func:`bulletbot.commands.terms_args`
+
+        """
+
+        limit = 10
+        results = self.search_bullets(text, nick=nick, limit=limit + 1)
+
+        def get_line(result):
+            return '{:%Y-%m-%d}: {}'.format(result.datetime, result.bullet)
+
+        if results:
+            lines = [get_line(result) for result in results[:limit]]
+            if len(results) > limit:
+                lines.append('... showing the best {} matches'.format(limit))
+            response = '\n'.join(lines)
+        else:
+            response = "No bullets found."
+
+        self.logger.debug('%s: %s', nick, response)
         return response
 
     def delete_bullets(self, nick, text):
@@ -243,26 +869,16 @@ class BulletBot(object):
 
             "0, 1 2"
 
-        Will delete 'bullet A' and 'bullet B'.
+        Will delete 'bullet A' and 'bullet B'.  Ranges are inclusive,
+        ``"0-1"`` does the same.
 
         :param str nick: The nickname of the user
-        :param list nick:
-            :class:`list` of :class:`int` indices of bullets to
-            delete.
+        :param str text: indices and ranges of bullets to delete
         :returns: :class:`str` with channel response
 
         """
 
-        try:
-            indices = [int(t) for t in self.tokenize(text)]
-        except ValueError:
-            response = ("Please specify indices of bullets from .list. "
-                        "e.g. `.delete 1, 3`")
-        else:
-            response = self._delete_bullets(nick, indices)
-
-        self.logger.info((nick, response))
-        return response
+        return self.router.dispatch(self, nick, '.delete', text)
 
     def _delete_bullets(self, nick, indices):
         """Delete unsent (as noted by last_sent column) bullets
@@ -285,15 +901,15 @@ class BulletBot(object):
             # unsent bullets.  This is the view that the user has when
             # listing the bullets.  We want to look up all the bullets
             # first, before we start deleting any.
-            with self.db.session() as s:
-                bullet = self.unsent(s, nick).offset(index).first()
+            with self.write_session(nick) as s:
+                bullet = queries.unsent_at(s, nick, index)
                 if not bullet:
                     return 'Bullet {} not found.'.format(index)
                 bullets[index] = bullet
-                s.expunge(bullet)
 
-        self.logger.info('Deleting bullets {}'.format(bullets))
+        self.logger.info('Deleting bullets %s', bullets)
         ids = [bullet.id for bullet in bullets.values()]
+        self.page_cursors.invalidate(nick)
 
         with self.db.session() as s:
             # Delete bullets by id, not offset
@@ -311,10 +927,136 @@ class BulletBot(object):
         lines = [get_line(n, bullet) for n, bullet in bullets.items()]
         response = '\n'.join(lines)
 
-        self.logger.info((nick, response))
+        self.logger.debug('%s: %s', nick, response)
+        return response
+
+    def export_bullets(self, path, fmt=None, since=None, until=None,
+                       nick=None, sent=None, include_archive=True):
+        """Stream bullet history to a file.
+
+        :param str path:
+            Output path, ``-`` for stdout.  A ``.gz`` suffix compresses
+            csv and jsonl output.
+        :param str fmt: ``csv``, ``jsonl`` or ``parquet``
+        :param datetime since: only bullets created at or after
+        :param datetime until: only bullets created before
+        :param str nick: only bullets by this nick
+        :param bool sent: only sent (True) or unsent (False) bullets
+        :param bool include_archive: also export archived bullets
+        :returns: :class:`int` number of bullets exported
+
+        """
+
+        from . import transfer
+        with self.read_session() as s:
+            rows = transfer.bullet_rows(
+                s, since=since, until=until, nick=nick, sent=sent,
+                include_archive=include_archive)
+            count = transfer.export_rows(rows, path, fmt)
+
+        self.logger.info('Exported %s bullets to %s', count, path)
+        return count
+
+    def import_bullets(self, path, fmt=None, chunk_size=10000):
+        """Bulk load bullets from a csv or jsonl file, e.g. one written
+        by :meth:`export_bullets`.  Users are created as needed.
+
+        :param str path: Input path, ``-`` for stdin
+        :param str fmt: ``csv`` or ``jsonl``
+        :param int chunk_size: bullets loaded per transaction
+        :returns: :class:`int` number of bullets imported
+
+        """
+
+        from . import transfer
+        count = transfer.import_path(self.db.engine, path, fmt, chunk_size)
+
+        self.logger.info('Imported %s bullets from %s', count, path)
+        return count
+
+    def refresh_rollups(self, since=None, backfill=False):
+        """Recompute the daily activity rollups behind :meth:`stats`.
+
+        :param date since: first day to recompute, defaults to yesterday
+        :param bool backfill: recompute all of history
+        :returns: :class:`int` number of rollup rows written
+
+        """
+
+        if since is None and not backfill:
+            since = date.today() - timedelta(days=1)
+
+        with self.db.engine.begin() as conn:
+            count = rollups.refresh(conn, since)
+
+        self.logger.info('Refreshed %s activity rollups since %s',
+                         count, since)
+        return count
+
+    def activity_stats(self, nick=None, period='week'):
+        """Per user activity over a period, read from the rollups.
+
+        :param str nick: a single user, or everyone if None
+        :param str period: one of :data:`.rollups.PERIODS`
+        :returns: :class:`list` of :class:`.rollups.Stats`
+
+        """
+
+        prefix = self.qualify('') if self.tenant is not None else None
+        with self.read_session(nick) as s:
+            return rollups.stats(s, nick, rollups.PERIODS[period],
+                                 prefix=prefix)
+
+    def stats(self, nick, text):
+        """Show activity statistics.
+
+        Example text::
+
+            "all month"
+
+        :param str nick: The nickname of the user asking
+        :param str text: ``[nick|all] [day|week|month|quarter|year]``
+        :returns: :class:`str` with channel response
+
+        """
+
+        return self.router.dispatch(self, nick, '.stats', text)
+
+    def _stats(self, nick, who=None, period='week'):
+        """Show activity statistics
+
+        :param str nick: The nickname of the user asking
+        :param str who: another nick, ``all``, or None for `nick`
+        :param str period: key of :data:`bulletbot.rollups.PERIODS`
+        :returns: :class:`str` with channel response
+
+        """
+
+        target = nick
+        if who == 'all':
+            target = None
+        elif who:
+            target = self.qualify(who)
+
+        results = self.activity_stats(target, period)
+
+        def get_line(r):
+            return ('{nick}: {r.total} bullets on {r.active_days} days '
+                    '({r.per_day:.1f}/day), streak {r.streak} '
+                    '(best {r.longest_streak})'.format(
+                        nick=self.unqualify(r.nick), r=r))
+
+        if results:
+            lines = ['Last {}:'.format(period)]
+            lines += [get_line(r) for r in results]
+            response = '\n'.join(lines)
+        else:
+            response = "No bullets in the last {}.".format(period)
+
+        self.logger.debug('%s: %s', nick, response)
         return response
 
-    def create_recipients(self, text):
+    def create_recipients(self, text, team=None):
         """Add a recipient email from user input string.
 
         Example text::
@@ -322,17 +1064,19 @@ class BulletBot(object):
             "user1@example.com, user2@example.com"
 
         :param str email: The emails of the user
+        :param str team: Send them this team's digest
         :returns: :class:`str` with channel response
 
         """
 
         addresses = self.tokenize(text)
-        return self._create_recipients(addresses)
+        return self._create_recipients(addresses, team)
 
-    def _create_recipients(self, addresses):
+    def _create_recipients(self, addresses, team=None):
         """Add a recipient email.
 
         :param list email: List of addresses
+        :param str team: Send them this team's digest
         :returns: :class:`str` with channel response
 
         .. seealso::
@@ -342,9 +1086,12 @@ class BulletBot(object):
         """
 
         with self.db.session() as s:
+            if team is not None:
+                s.merge(Team(name=team))
             for address in addresses:
                 recipient = Recipient()
                 recipient.email = address
+                recipient.team = team
                 s.merge(recipient)
 
         response = "Created recipient addresses '{}'".format(addresses)
@@ -391,27 +1138,20 @@ class BulletBot(object):
 
     def get_unsent_bullets(self):
         """Load unset bullets for all users and return a dictionary with `str`
-        keys (the realname or nick) and list of :class:`Bullet`
-        values.
+        keys (the realname or nick) and list of bullet rows, see
+        :func:`bulletbot.queries.unsent_bullets`.
 
         """
 
-        bullets = {}
-        with self.db.session() as s:
-            users = (s.query(User)
-                     .join(User.bullets)
-                     .filter(Bullet.last_sent == None)  # noqa
-                     .all())
-            for user in users:
-                name = user.realname or user.nick
-                bullets[name] = bullets.get(name, [])
-                bullets[name] += self.unsent(s, user.nick)
-
-            s.expunge_all()
+        bullets = OrderedDict()
+        with self.read_session() as s:
+            for row in queries.unsent_bullets(s):
+                bullets.setdefault(row.realname or row.nick, []).append(row)
 
         return bullets
 
-    def compile_plaintext_bullets(self, unsent_bullets=None):
+    def compile_plaintext_bullets(self, unsent_bullets=None, summarize=None,
+                                  collapse=None):
         """Generate a text paragraph with user bullets
 
         .. codeblock::
@@ -424,26 +1164,35 @@ class BulletBot(object):
               - User1's bullet
               - Bullet 2
 
+        Spell checked text is used where there is one, see
+        :mod:`bulletbot.spelling`.
+
+        :param dict unsent_bullets: from :meth:`get_unsent_bullets`
+        :param bool summarize:
+            start with a summary of top terms, see
+            :mod:`bulletbot.summary`.  Defaults to ``--digest-summary``.
+        :param bool collapse:
+            list near-duplicate bullets once, with a count.  Defaults to
+            ``--collapse-duplicates``.
+
         """
 
         if unsent_bullets is None:
             unsent_bullets = self.get_unsent_bullets()
+        if summarize is None:
+            summarize = self.args.digest_summary
+        if collapse is None:
+            collapse = self.args.collapse_duplicates
+
+        from . import digest
+        response = digest.format_digest(
+            unsent_bullets,
+            summarize=summarize,
+            collapse_duplicates=collapse,
+            width=self._email_width,
+        )
 
-        def format_bullet(bullet):
-            prefix = '  - '
-            return "{}{}".format(prefix, textwrap.fill(
-                bullet.bullet,
-                width=self._email_width - len(prefix),
-                subsequent_indent=' '*len(prefix)
-            ))
-
-        lines = []
-        for name, bullets in unsent_bullets.items():
-            lines += ['', '[{}]'.format(name)]
-            lines += map(format_bullet, bullets)
-        response = '\n'.join(lines).strip()
-
-        self.logger.info(response)
+        self.logger.debug('Digest:\n%s', response)
         return response
 
     def mark_all_sent(self):
@@ -456,11 +1205,56 @@ class BulletBot(object):
 
         """
 
+        self.page_cursors.invalidate()
+        with self.db.session() as s:
+            return s.execute(queries.mark_all_sent).rowcount
+
+    def mark_sent(self, ids, chunk_size=1000):
+        """Marks the `last_sent` timestamp on bullets by id.
+
+        :param list ids: :class:`list` of :attr:`.Bullet.id`
+        :returns: :class:`int` number of bullets marked
+
+        """
+
+        self.page_cursors.invalidate()
+        count = 0
         with self.db.session() as s:
-            return (s.query(Bullet)
-                    .filter(Bullet.last_sent == None)  # noqa
-                    .update({Bullet.last_sent: sa.func.now()},
-                            synchronize_session=False))
+            for i in range(0, len(ids), chunk_size):
+                count += (s.query(Bullet)
+                          .filter(Bullet.id.in_(ids[i:i + chunk_size]))
+                          .update({Bullet.last_sent: sa.func.now()},
+                                  synchronize_session=False))
+        return count
+
+    def _connect_smtp(self):
+        assert self.args.email_user, 'No email user specified'
+        assert self.args.email_server, 'No email server specified'
+        assert self.args.email_port, 'No email server port specified'
+        assert self._email_password, 'No email pass specified'
+
+        import smtplib
+        self.logger.info('Connecting to %s', self.args.email_server)
+        server = smtplib.SMTP(self.args.email_server, self.args.email_port)
+        server.starttls()
+        server.ehlo()
+        server.login(self.args.email_user, self._email_password)
+        return server
+
+    def _send_email(self, server, to, text, team=None):
+        from email.mime.text import MIMEText
+        msg = MIMEText(text)
+
+        subject = 'Bullets {}'.format(time.strftime("%m-%d-%Y"))
+        if team is not None:
+            subject = '{} {}'.format(team, subject)
+        msg['Subject'] = subject
+        msg['From'] = self.args.email_from
+        msg['To'] = ', '.join(to)
+
+        server.sendmail(self.args.email_from, to, msg.as_string())
+        self.logger.info('Sent %s to %s', subject, msg['To'])
+        self.logger.debug('%s', msg)
 
     def send_bullets(self, message=None):
         """Sends bullets to recipient per config specification.  If
@@ -472,37 +1266,131 @@ class BulletBot(object):
             self.logger.warning("No bullets to send")
             return
 
-        msg = MIMEText(message or self.compile_plaintext_bullets())
-
-        assert self.args.email_user, 'No email user specified'
-        assert self.args.email_server, 'No email server specified'
-        assert self.args.email_port, 'No email server port specified'
         assert self.args.email_to, 'No email recip specified'
-        assert self._email_password, 'No email pass specified'
+        text = message or self.compile_plaintext_bullets()
 
-        msg['Subject'] = 'Bullets {}'.format(time.strftime("%m-%d-%Y"))
-        msg['From'] = self.args.email_from
-        msg['To'] = self.args.email_to
+        server = self._connect_smtp()
+        try:
+            self._send_email(server, [self.args.email_to], text)
+        finally:
+            server.quit()
 
-        self.logger.info('Connecting to {}'.format(self.args.email_server))
-        server = smtplib.SMTP(self.args.email_server, self.args.email_port)
-        server.starttls()
-        server.ehlo()
-        server.login(self.args.email_user, self._email_password)
+    def compile_team_digests(self, teams=None):
+        """Snapshot unsent bullets and format one digest per team, see
+        :mod:`bulletbot.digest`.
+
+        :param list teams:
+            only these teams, None in the list is users without a team
+
+        :returns:
+            ``(digests, ids)``, :class:`dict` s of team name (None for
+            users without a team) to digest text and to the ids of the
+            team's bullets in the snapshot
+
+        """
 
-        server.sendmail(
-            self.args.email_from,
-            [self.args.email_to],
-            msg.as_string()
+        from . import digest
+        with self.read_session() as s:
+            teams = digest.snapshot(s, teams)
+
+        digests = digest.format_teams(
+            teams,
+            max_workers=self.args.digest_processes,
+            summarize=self.args.digest_summary,
+            collapse_duplicates=self.args.collapse_duplicates,
+            width=self._email_width,
         )
+        return digests, {team: digest.snapshot_ids({team: users})
+                         for team, users in teams.items()}
+
+    def send_team_digests(self, teams=None):
+        """Send each team's digest to the team's recipients and mark its
+        bullets sent.  Users without a team, and teams without
+        recipients, go to ``--email-to``.
+
+        Each team is marked as soon as its digest is sent, so when a
+        send fails the teams before it aren't sent again.
+
+        :param list teams:
+            only these teams, None in the list is users without a team
+
+        :returns:
+            :class:`list` of the ids of the bullets sent
+
+        """
+
+        digests, ids = self.compile_team_digests(teams)
+        if not ids:
+            self.logger.warning("No bullets to send")
+            return []
+
+        recipients = {}
+        with self.db.session() as s:
+            for row in s.query(Recipient.email, Recipient.team).filter(
+                    Recipient.team != None):  # noqa
+                recipients.setdefault(row.team, []).append(row.email)
+
+        sent = []
+        server = self._connect_smtp()
+        try:
+            for team in sorted(digests, key=lambda team: team or ''):
+                to = recipients.get(team) or [self.args.email_to]
+                assert all(to), 'No email recip specified'
+                self._send_email(server, to, digests[team], team)
+                self.mark_sent(ids[team])
+                sent.extend(ids[team])
+        finally:
+            server.quit()
+
+        return sent
+
+    def send_bullets_mark_sent(self, teams=None):
+        """Send each team's digest and mark the bullets in them sent,
+        see :meth:`send_team_digests`.  Prune old near-duplicate buckets
+        and archive old bullets if ``--duplicate-days`` or
+        ``--retention-days`` is configured.
+
+        :param list teams:
+            only these teams, None in the list is users without a team
+
+        """
 
-        self.logger.info(msg)
+        self.send_team_digests(teams)
+        if self.args.duplicate_days:
+            with self.db.session() as s:
+                minhash.prune(s, datetime.now(timezone.utc) -
+                              timedelta(days=self.args.duplicate_days))
+        if self.args.retention_days:
+            self.archive_bullets()
+
+    def archive_bullets(self, days=None, dump_dir=None):
+        """Move sent bullets older than the retention age out of the
+        bullets table.
+
+        :param int days: retention age, defaults to ``--retention-days``
+        :param str dump_dir:
+            also dump archived bullets to a gzipped JSONL file in this
+            directory, defaults to ``--archive-dir``
+        :returns: :class:`int` number of bullets archived
+
+        """
 
-    def send_bullets_mark_sent(self):
-        """Send bullets and mark all unsent bullets sent."""
+        days = self.args.retention_days if days is None else days
+        dump_dir = dump_dir or self.args.archive_dir
+        assert days is not None, 'No retention age specified'
 
-        self.send_bullets()
-        self.mark_all_sent()
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+        dump_path = None
+        if dump_dir:
+            dump_path = os.path.join(dump_dir, 'bullets-archive-{:%Y-%m-%d}'
+                                     '.jsonl.gz'.format(datetime.now()))
+
+        from . import retention
+        count = retention.archive_sent(self.db.engine, cutoff, dump_path)
+        self.page_cursors.invalidate()
+
+        self.logger.info('Archived %s bullets older than %s', count, cutoff)
+        return count
 
     def set_email_password(self):
         """Sets the email password from one of two sources
@@ -512,6 +1400,7 @@ class BulletBot(object):
 
         """
 
+        from getpass import getpass
         self._email_password = (
             self.args.email_pass or
             getpass('Email password for {}: '.format(self.args.email_user))
@@ -530,19 +1419,52 @@ class BulletBot(object):
             ).items() if v
         }
 
+    def team_schedules(self):
+        """Load all teams with their digest schedules.
+
+        :returns: :class:`list` of :class:`.Team`
+
+        """
+
+        with self.db.session() as s:
+            teams = s.query(Team).order_by(Team.name).all()
+            s.expunge_all()
+        return teams
+
+    def set_team_schedule(self, name, hour=None, minute=None, timezone=None):
+        """Set when a team's digest is sent.  Without an hour or
+        minute, the team goes back to the dispatcher's schedule.
+
+        :param str name: The team name
+        :param str hour: cron hour expression, e.g. ``17``
+        :param str minute: cron minute expression, e.g. ``30``
+        :param str timezone: e.g. ``Europe/London``
+
+        """
+
+        with self.db.session() as s:
+            team = s.merge(Team(name=name))
+            team.cron_hour = hour
+            team.cron_minute = minute
+            team.timezone = timezone
+
+        self.logger.info('Team %s sends at hour=%s minute=%s %s',
+                         name, hour, minute, timezone or '')
+
     def schedule_send_bullets(self):
-        """Blocking call to schedule bullets."""
+        """Blocking call to schedule bullets.  Team schedules are read
+        from the database, see :mod:`bulletbot.schedule`.
+
+        """
 
         self.set_email_password()
 
         cron_args = self.get_email_cron_args()
         assert cron_args, 'No cron args specified.'
 
-        scheduler = BlockingScheduler()
-        scheduler.add_job(self.send_bullets_mark_sent, 'cron', **cron_args)
-
-        self.logger.info("Scheduled for {}".format(cron_args))
+        from . import schedule
+        self.logger.info('Scheduled for %s', cron_args)
         try:
-            scheduler.start()
+            schedule.DigestScheduler(self).start()
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.cli
+----------------------------------
+
+Administrative commands, run with ``bin/bulletbot <command>``.
+Database settings are read the same way as :class:`.BulletBot`.
+
+Example::
+
+    $ bin/bulletbot export --since 2016-01-01 --output bullets.csv.gz
+
+"""
+
+from datetime import datetime
+
+import argparse
+import logging
+import time
+
+from .bulletbot import BulletBot
+from .transfer import FORMATS
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_date(text):
+    return datetime.strptime(text, '%Y-%m-%d')
+
+
+def export(bbot, args):
+    sent = {'sent': True, 'unsent': False}.get(args.state)
+    start = time.time()
+    count = bbot.export_bullets(
+        args.output,
+        fmt=args.format,
+        since=args.since,
+        until=args.until,
+        nick=args.nick,
+        sent=sent,
+        include_archive=args.include_archive,
+    )
+    elapsed = time.time() - start
+    logger.info('%s bullets in %.1fs (%.0f rows/s)',
+                count, elapsed, count / elapsed if elapsed else 0)
+
+
+def import_(bbot, args):
+    start = time.time()
+    count = bbot.import_bullets(args.path, fmt=args.format,
+                                chunk_size=args.chunk_size)
+    elapsed = time.time() - start
+    logger.info('%s bullets in %.1fs (%.0f rows/s)',
+                count, elapsed, count / elapsed if elapsed else 0)
+
+
+def archive(bbot, args):
+    bbot.archive_bullets(days=args.older_than, dump_dir=args.dump_dir)
+
+
+def rollup(bbot, args):
+    bbot.refresh_rollups(since=args.since, backfill=args.since is None)
+
+
+def team(bbot, args):
+    bbot.set_team_schedule(args.name, hour=args.hour, minute=args.minute,
+                           timezone=args.timezone)
+
+
+def replay(bbot, args):
+    from . import replay as rtm
+    rtm.replay(rtm.ReplayBot(bbot.db, token='replay'), args.path,
+               speed=args.speed)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='bulletbot')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('export', help='stream bullet history to a file')
+    p.add_argument('--output', default='-',
+                   help='output path, .gz compresses csv/jsonl')
+    p.add_argument('--format', choices=FORMATS,
+                   help='output format, guessed from --output by default')
+    p.add_argument('--since', type=parse_date, help='YYYY-MM-DD')
+    p.add_argument('--until', type=parse_date, help='YYYY-MM-DD, exclusive')
+    p.add_argument('--nick')
+    p.add_argument('--state', choices=['all', 'sent', 'unsent'],
+                   default='all')
+    p.add_argument('--no-archive', dest='include_archive',
+                   action='store_false', help='leave out archived bullets')
+    p.set_defaults(func=export)
+
+    p = commands.add_parser('import', help='bulk load bullets from a file')
+    p.add_argument('path', help='csv or jsonl file, - for stdin')
+    p.add_argument('--format', choices=['csv', 'jsonl'],
+                   help='input format, guessed from path by default')
+    p.add_argument('--chunk-size', type=int, default=10000,
+                   help='bullets loaded per transaction')
+    p.set_defaults(func=import_)
+
+    p = commands.add_parser('archive',
+                            help='move old sent bullets to the archive')
+    p.add_argument('--older-than', type=int, metavar='DAYS',
+                   help='defaults to --retention-days')
+    p.add_argument('--dump-dir',
+                   help='also dump them to gzipped JSONL, defaults to '
+                   '--archive-dir')
+    p.set_defaults(func=archive)
+
+    p = commands.add_parser('rollup',
+                            help='rebuild the activity rollups behind .stats')
+    p.add_argument('--since', type=lambda t: parse_date(t).date(),
+                   help='YYYY-MM-DD, all of history by default')
+    p.set_defaults(func=rollup)
+
+    p = commands.add_parser('team',
+                            help="set when a team's digest is sent")
+    p.add_argument('name')
+    p.add_argument('--hour', help='cron hour, e.g. 17')
+    p.add_argument('--minute', help='cron minute, e.g. 30')
+    p.add_argument('--timezone', help='e.g. Europe/London')
+    p.set_defaults(func=team)
+
+    p = commands.add_parser('replay',
+                            help='replay recorded slack events, see '
+                            '--record-rtm')
+    p.add_argument('path', help='recording, e.g. rtm.jsonl.gz')
+    p.add_argument('--speed', type=float, default=1.0,
+                   help='multiple of real time, 0 for as fast as possible')
+    p.set_defaults(func=replay)
+
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    # The rest of argv holds the database settings read by BulletBot
+    args, _ = parser.parse_known_args(argv)
+    if not getattr(args, 'func', None):
+        parser.error('no command given')
+    bbot = BulletBot()
+    bbot.setup_logging()
+    args.func(bbot, args)
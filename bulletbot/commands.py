@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.commands
+----------------------------------
+
+Defines :class:`.CommandRouter`, the chat commands shared by every
+frontend.
+
+A message starting with ``.`` is a command.  Commands are looked up by
+name in a table built once, and each has a parser that turns the rest
+of the message into typed arguments: bullet indices and ranges
+(``.delete 0, 2-4``), ``--page N`` and ``YYYY-MM-DD`` dates.  Text that
+doesn't parse gets the command's usage back.  Middleware such as
+:class:`.Timer` and :class:`.RateLimit` wraps all commands or only
+some.
+
+Example usage::
+
+    router = CommandRouter()
+    router.use(Timer())
+    router.dispatch(bbot, 'nick', '.delete', '0, 2-3')
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from functools import partial
+
+import logging
+import re
+import threading
+import time
+
+from . import rollups
+from . import search
+
+
+logger = logging.getLogger(__name__)
+
+_delim = re.compile(',[ ]*|[ ]+')
+_index = re.compile(r'(\d+)(?:-(\d+))?$')
+
+# Most bullets one .delete may name
+MAX_INDICES = 100
+
+# Commands that scan a user's whole history
+EXPENSIVE = ('history', 'search', 'stats')
+
+
+def tokenize(text):
+    """Split on commas and spaces, e.g. ``'1, 2 test'`` to ``['1', '2',
+    'test']``
+
+    """
+
+    return [token.strip() for token in _delim.split(text)]
+
+
+def parse_page(tokens):
+    """Pop a ``--page N`` option out of a list of tokens.
+
+    :param list tokens: :class:`list` of :class:`str` tokens
+    :returns: ``(page, tokens)``, page is 1 if not given
+    :raises ValueError: if N is missing or not a page number
+
+    """
+
+    if '--page' not in tokens:
+        return 1, tokens
+
+    i = tokens.index('--page')
+    if i + 1 >= len(tokens):
+        raise ValueError('--page needs a number')
+    page = int(tokens[i + 1])
+    if page < 1:
+        raise ValueError('Pages start at 1')
+    return page, tokens[:i] + tokens[i + 2:]
+
+
+def no_args(text):
+    return {}
+
+
+def text_args(text):
+    return {'text': text}
+
+
+def page_args(text):
+    page, _ = parse_page(tokenize(text.strip()))
+    return {'page': page}
+
+
+def index_args(text):
+    """Parse indices and inclusive ranges of indices"""
+
+    indices = []
+    for token in tokenize(text):
+        match = _index.match(token)
+        if not match:
+            raise ValueError('Not an index: {!r}'.format(token))
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if last < first:
+            raise ValueError('Backwards range: {}'.format(token))
+        indices.extend(range(first, min(last, first + MAX_INDICES) + 1))
+        if len(indices) > MAX_INDICES:
+            raise ValueError('More than {} indices'.format(MAX_INDICES))
+    return {'indices': indices}
+
+
+def date_args(text):
+    page, tokens = parse_page(tokenize(text.strip()))
+    dates = [datetime.strptime(t, '%Y-%m-%d') for t in tokens if t]
+    if len(dates) > 2:
+        raise ValueError('More than two dates')
+    since, until = (dates + [None, None])[:2]
+    return {'since': since, 'until': until, 'page': page}
+
+
+def stats_args(text):
+    period, who = 'week', None
+    for token in tokenize(text.strip()):
+        if token in rollups.PERIODS:
+            period = token
+        elif token:
+            who = token
+    return {'who': who, 'period': period}
+
+
+def terms_args(text):
+    if not search.terms(text):
+        raise ValueError('No search terms')
+    return {'text': text}
+
+
+Command = namedtuple('Command', ['names', 'parse', 'handler', 'usage'])
+Command.__doc__ = """A chat command.
+
+:param tuple names: name first, then aliases, without the ``.``
+:param parse:
+    function of the text after the command returning keyword arguments
+    for `handler`, raises :class:`ValueError` for bad input
+:param str handler:
+    :class:`.BulletBot` method called with the nick and the arguments
+:param str usage: response to text that doesn't parse
+"""
+
+COMMANDS = [
+    Command(('help', 'commands', 'comands'), no_args, 'help_text', None),
+    Command(('list', 'ls'), page_args, '_list_bullets',
+            "Please specify a page number. e.g. `.list --page 2`"),
+    Command(('delete', 'rm'), index_args, '_delete_bullets',
+            "Please specify indices of bullets from .list. "
+            "e.g. `.delete 1, 3` or `.delete 0-2`"),
+    Command(('history',), date_args, '_history',
+            "Please specify dates as YYYY-MM-DD. "
+            "e.g. `.history 2016-01-01 2016-02-01 --page 2`"),
+    Command(('stats',), stats_args, '_stats', None),
+    Command(('search',), terms_args, '_search',
+            "Please specify what to search for. e.g. `.search deploy`"),
+    Command(('team',), text_args, 'join_team', None),
+    Command(('register',), text_args, 'register_nick', None),
+]
+
+
+class Timer(object):
+    """Middleware counting the calls and time spent per command"""
+
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, nick, call):
+        start = time.time()
+        try:
+            return call()
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                count, total, worst = self.stats.get(name, (0, 0.0, 0.0))
+                self.stats[name] = (count + 1, total + elapsed,
+                                    max(worst, elapsed))
+            logger.debug('.%s for %s took %.1fms', name, nick, elapsed * 1e3)
+
+    def metrics(self):
+        """Return ``{name: {count, seconds, max}}``"""
+
+        with self._lock:
+            return {name: {'count': count, 'seconds': round(total, 3),
+                           'max': round(worst, 3)}
+                    for name, (count, total, worst) in self.stats.items()}
+
+
+class RateLimit(object):
+    """Middleware allowing each user `burst` calls at once, refilled at
+    `rate` per second.
+
+    """
+
+    def __init__(self, rate, burst):
+        from .executor import FloodLimiter
+        self.limiter = FloodLimiter(rate, burst)
+
+    def __call__(self, name, nick, call):
+        if not self.limiter.allow(nick):
+            logger.warning('Rate limited .%s for %s', name, nick)
+            return 'Too many `.{}` commands, try again shortly.'.format(name)
+        return call()
+
+
+class CommandRouter(object):
+    """Dispatch table of chat commands.  Routers hold no bot state, so
+    one can serve several bots.
+
+    """
+
+    def __init__(self, commands=COMMANDS, exclude=()):
+        """
+        :param list commands: :class:`.Command` s to serve
+        :param tuple exclude: names of commands to leave out
+
+        """
+
+        self._table = {}
+        self._middleware = {}
+        for command in commands:
+            if command.names[0] in exclude:
+                continue
+            for name in command.names:
+                self._table[name] = command
+            self._middleware[command.names[0]] = []
+
+    def use(self, middleware, names=None):
+        """Wrap commands in `middleware`, called with ``(name, nick,
+        call)`` and returning the response, usually ``call()``.
+        Middleware added first runs outermost.
+
+        :param tuple names: command names, all commands if None
+
+        """
+
+        for name in names or list(self._middleware):
+            if name in self._middleware:
+                self._middleware[name].append(middleware)
+
+    @staticmethod
+    def is_command(text):
+        return text.startswith('.')
+
+    def lookup(self, cmd):
+        """Return the :class:`.Command` for ``.name`` or ``name``, or None"""
+
+        return self._table.get(cmd[1:] if cmd.startswith('.') else cmd)
+
+    def dispatch(self, bot, nick, cmd, text=''):
+        """Run a command.
+
+        :param bot: :class:`.BulletBot` running the command
+        :param str nick: The nickname of the user
+        :param str cmd: ``.name`` of the command
+        :param str text: the rest of the message
+        :returns: :class:`str` with channel response
+
+        """
+
+        command = self.lookup(cmd)
+        if command is None:
+            return '{}\n{}'.format(bot.unknown_command, bot.help_message)
+
+        try:
+            args = command.parse(text)
+        except ValueError as e:
+            logger.debug('Bad arguments to %s: %s', cmd, e)
+            return command.usage
+
+        name = command.names[0]
+        call = partial(getattr(bot, command.handler), nick, **args)
+        for middleware in reversed(self._middleware[name]):
+            call = partial(middleware, name, nick, call)
+        return call()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.digest
+----------------------------------
+
+Formatting of the emailed digest, and one digest per team.
+
+Unsent bullets are read once, as plain tuples, into a snapshot grouped
+by team.  Each team's digest is formatted in a separate process, so a
+large organization's digests are built in parallel, and only the
+bullets in the snapshot are marked sent afterwards.
+"""
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy as sa
+import textwrap
+
+from . import summary
+from .models import Bullet, User
+
+
+DigestBullet = namedtuple('DigestBullet', [
+    'id', 'bullet', 'suggestion', 'duplicate_of'])
+
+WIDTH = 80
+
+
+def collapse(bullets):
+    """Group near-duplicate bullets, see :mod:`bulletbot.minhash`.
+
+    :param list bullets: :class:`list` of :class:`.Bullet`
+    :returns:
+        :class:`list` of ``(bullet, count)`` with the first bullet of
+        each group
+
+    """
+
+    groups = OrderedDict()
+    for bullet in bullets:
+        key = bullet.duplicate_of or bullet.id
+        if key in groups:
+            groups[key][1] += 1
+        else:
+            groups[key] = [bullet, 1]
+    return [tuple(group) for group in groups.values()]
+
+
+def format_bullet(bullet, count=1, width=WIDTH):
+    prefix = '  - '
+    text = bullet.suggestion or bullet.bullet
+    if count > 1:
+        text = '{} (x{})'.format(text, count)
+    return "{}{}".format(prefix, textwrap.fill(
+        text,
+        width=width - len(prefix),
+        subsequent_indent=' '*len(prefix)
+    ))
+
+
+def format_digest(unsent_bullets, summarize=False, collapse_duplicates=False,
+                  width=WIDTH):
+    """Format a digest, see :meth:`.BulletBot.compile_plaintext_bullets`
+
+    :param dict unsent_bullets:
+        :class:`str` names to lists of :class:`.Bullet` or
+        :class:`.DigestBullet`
+    :returns: :class:`str`
+
+    """
+
+    lines = []
+    if summarize:
+        lines.append(summary.format_summary({
+            name: [b.bullet for b in bullets]
+            for name, bullets in unsent_bullets.items()
+        }))
+    for name, bullets in unsent_bullets.items():
+        lines += ['', '[{}]'.format(name)]
+        if collapse_duplicates:
+            lines += [format_bullet(bullet, count, width)
+                      for bullet, count in collapse(bullets)]
+        else:
+            lines += [format_bullet(bullet, width=width)
+                      for bullet in bullets]
+    return '\n'.join(lines).strip()
+
+
+def snapshot(s, teams=None):
+    """Read all unsent bullets, grouped by team and then by user.
+
+    :param s: :class:`sqlalchemy.orm.session.Session`
+    :param list teams:
+        only these teams, None in the list is users without a team
+    :returns:
+        :class:`dict` of team name (None for users without a team) to
+        an :class:`OrderedDict` of user name to lists of
+        :class:`.DigestBullet`
+
+    """
+
+    rows = (s.query(Bullet.id, Bullet.bullet, Bullet.suggestion,
+                    Bullet.duplicate_of, User.nick, User.realname, User.team)
+            .join(User, Bullet.nick == User.nick)
+            .filter(Bullet.last_sent == None)  # noqa
+            .order_by(Bullet.datetime, Bullet.id))
+
+    if teams is not None:
+        names = [team for team in teams if team is not None]
+        rows = rows.filter(sa.or_(
+            User.team.in_(names) if names else sa.false(),
+            User.team == None if None in teams else sa.false(),  # noqa
+        ))
+
+    snap = {}
+    for row in rows:
+        users = snap.setdefault(row.team, OrderedDict())
+        users.setdefault(row.realname or row.nick, []).append(DigestBullet(
+            row.id, row.bullet, row.suggestion, row.duplicate_of))
+    return snap
+
+
+def snapshot_ids(teams):
+    """Return the ids of all bullets in a :func:`snapshot`"""
+
+    return [bullet.id
+            for users in teams.values()
+            for bullets in users.values()
+            for bullet in bullets]
+
+
+def _format_team(args):
+    team, unsent_bullets, kwargs = args
+    return team, format_digest(unsent_bullets, **kwargs)
+
+
+def format_teams(teams, max_workers=None, **kwargs):
+    """Format one digest per team, in parallel processes when there is
+    more than one team.
+
+    :param dict teams: from :func:`snapshot`
+    :param int max_workers: processes, defaults to the number of CPUs
+    :param kwargs: passed to :func:`format_digest`
+    :returns: :class:`dict` of team name to digest text
+
+    """
+
+    jobs = [(team, users, kwargs) for team, users in teams.items()]
+    if len(jobs) < 2:
+        return dict(map(_format_team, jobs))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return dict(pool.map(_format_team, jobs))
@@ -5,16 +5,74 @@ bulletbot.driver
 ----------------------------------
 
 Defines :class:`.SQLAlchemyDriver`.
+
+Sessions opened with ``readonly=True`` go to a read replica when the
+driver has any.  Replicas are used round robin, skipping those whose
+replication lag is over ``max_replica_lag`` seconds, and the primary
+is used when none qualify.  A nick that wrote within the last
+``max_replica_lag`` seconds reads from the primary, so users always see
+their own writes.
+
+:meth:`SQLAlchemyDriver.isolated` runs everything the driver does in
+one transaction that is rolled back afterwards, which is how the tests
+share a seeded database without cleaning up after themselves.
 """
 
 from contextlib import contextmanager
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 
+import itertools
 import logging
 import sqlalchemy as sa
+import threading
+import time
+
+from .models import MIGRATIONS, SCHEMA_VERSION, Base, schema_version
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # pysqlite starts and ends transactions on its own, which breaks
+    # savepoints.  Leave that to SQLAlchemy, see the ``begin`` listener.
+    dbapi_connection.isolation_level = None
+
+
+class _SavepointSession(Session):
+    """Session whose work is a savepoint of the connection it is bound
+    to, so rolling it back leaves the enclosing transaction alone.
+
+    """
+
+    def __init__(self, **kwargs):
+        super(_SavepointSession, self).__init__(**kwargs)
+        self._savepoint = self.bind.begin_nested()
+
+    def close(self):
+        super(_SavepointSession, self).close()
+        if self._savepoint.is_active:
+            self._savepoint.commit()
 
-from .models import Base
+
+class _SavepointEngine(object):
+    """Stands in for the engine inside :meth:`SQLAlchemyDriver.isolated`.
+    ``begin()`` opens a savepoint of the one connection and
+    ``connect()`` a branch of it.
+
+    """
+
+    def __init__(self, conn, engine):
+        self.conn = conn
+        self.dialect = engine.dialect
+        self.url = engine.url
+        self.pool = engine.pool
+
+    @contextmanager
+    def begin(self):
+        with self.conn.begin_nested():
+            yield self.conn
+
+    def connect(self):
+        return self.conn.connect()
 
 
 class SQLAlchemyDriver(object):
@@ -22,21 +80,64 @@ class SQLAlchemyDriver(object):
 
     logger = logging.getLogger(__name__)
 
+    # Seconds a measured replica lag is trusted for
+    _lag_check_interval = 1.0
+
     def __init__(self, host, user, password, database, backend='postgresql',
-                 con_args={}, **kwargs):
-        """Create a new SQLAlchemy interface for making things easer"""
+                 con_args={}, scoped=False, replicas=(), max_replica_lag=5.0,
+                 **kwargs):
+        """Create a new SQLAlchemy interface for making things easer
+
+        :param str backend: ``postgresql`` or the embedded ``sqlite``
+        :param bool scoped:
+            If True, :meth:`session` hands out one session per thread
+            (see :func:`sqlalchemy.orm.scoped_session`) which is
+            released when the ``with`` block exits.  Use this when the
+            driver is shared by handler threads.
+        :param list replicas: SQLAlchemy URLs of read replicas
+        :param float max_replica_lag:
+            Seconds a replica may be behind and still serve reads
+
+        """
 
         self.host = host
         self.user = user
         self.database = database
         self.backend = backend
+        if backend == 'sqlite':
+            # Handler threads share connections inside isolated()
+            con_args = dict(con_args, check_same_thread=False)
         self.engine = create_engine(
             self._connection_string(password),
             encoding='latin1',
             connect_args=con_args,
             **kwargs
         )
+        if backend == 'sqlite':
+            sa.event.listen(self.engine, 'connect', _sqlite_connect)
+            sa.event.listen(self.engine, 'begin',
+                            lambda conn: conn.execute('BEGIN'))
         self.session_maker = sessionmaker(bind=self.engine)
+        if scoped:
+            self.session_maker = scoped_session(self.session_maker)
+        self.scoped = scoped
+
+        self.replicas = [
+            create_engine(url, encoding='latin1', connect_args=con_args,
+                          **kwargs)
+            for url in replicas]
+        self.replica_session_makers = []
+        for engine in self.replicas:
+            maker = sessionmaker(bind=engine)
+            if scoped:
+                maker = scoped_session(maker)
+            self.replica_session_makers.append(maker)
+
+        self.max_replica_lag = max_replica_lag
+        self._lags = {}
+        self._writes = {}
+        self._next_replica = itertools.count()
+        self._lock = threading.Lock()
 
     def create_all(self, settings, root_user='postgres', backend='postgresql'):
         engine = create_engine("{backend}://{user}@{host}/postgres".format(
@@ -55,14 +156,129 @@ class SQLAlchemyDriver(object):
         user = settings['user']
         database = settings['database']
         password = settings['password']
-        self.logger.info("creating database '{}'".format(database))
+        self.logger.info("creating database '%s'", database)
         try_execute('CREATE DATABASE "{database}"'.format(database=database))
-        self.logger.info("creating user '{}'".format(user))
+        self.logger.info("creating user '%s'", user)
         try_execute("CREATE USER {user} WITH PASSWORD '{password}'"
                     .format(user=user, password=password))
 
         Base.metadata.create_all(engine)
 
+    def get_schema_version(self):
+        """Return the version recorded by :meth:`ensure_schema`, or None
+        if the schema was never created.
+
+        """
+
+        try:
+            with self.engine.connect() as conn:
+                return conn.execute(
+                    sa.select([sa.func.max(schema_version.c.version)])
+                ).scalar()
+        except (sa.exc.ProgrammingError, sa.exc.OperationalError):
+            return None
+
+    def has_relation(self, name):
+        """Return True if an index or table called `name` exists"""
+
+        if self.backend == 'sqlite':
+            query = 'SELECT 1 FROM sqlite_master WHERE name = :name'
+        else:
+            query = 'SELECT 1 FROM pg_class WHERE relname = :name'
+        with self.engine.connect() as conn:
+            return conn.execute(sa.text(query), name=name).first() is not None
+
+    def migrate(self):
+        """Add the :data:`.MIGRATIONS` columns and indexes that existing
+        tables are missing.  If a migration fails, the DDL still needed
+        is logged and the error raised, so the schema version isn't
+        stamped.
+
+        :returns: :class:`list` of the ``(table, name)`` added
+
+        """
+
+        inspector = sa.inspect(self.engine)
+        columns = {}
+        missing = []
+        for table, name, statements in MIGRATIONS:
+            statements = [
+                statement if isinstance(statement, str) else statement[1]
+                for statement in statements
+                if isinstance(statement, str) or statement[0] == self.backend]
+            if not statements:
+                continue
+            if table not in columns:
+                columns[table] = {c['name'] for c in
+                                  inspector.get_columns(table)}
+            if name not in columns[table] and not self.has_relation(name):
+                missing.append((table, name, statements))
+
+        added = []
+        try:
+            for table, name, statements in missing:
+                with self.engine.begin() as conn:
+                    for statement in statements:
+                        conn.execute(statement)
+                self.logger.info('Added %s to %s', name, table)
+                added.append((table, name))
+        except sa.exc.DBAPIError:
+            self.logger.error(
+                'Schema migration failed, run as the table owner:\n%s',
+                '\n'.join('{};'.format(statement)
+                          for _, _, statements in missing[len(added):]
+                          for statement in statements))
+            raise
+        return added
+
+    def ensure_schema(self, settings, root_user='postgres'):
+        """Run :meth:`create_all` and create the tables, then
+        :meth:`migrate` the existing ones, unless the database already
+        has the current :data:`.SCHEMA_VERSION`.  This saves the
+        superuser connection on every start.
+
+        :returns: :class:`bool` True if the schema was created
+
+        """
+
+        version = self.get_schema_version()
+        if version is not None and version >= SCHEMA_VERSION:
+            self.logger.info('Schema version %s is current', version)
+            return False
+
+        if self.backend == 'postgresql':
+            self.create_all(settings, root_user=root_user)
+        Base.metadata.create_all(self.engine)
+        self.migrate()
+        with self.engine.begin() as conn:
+            conn.execute(schema_version.delete())
+            conn.execute(schema_version.insert(), version=SCHEMA_VERSION)
+
+        self.logger.info('Created schema version %s', SCHEMA_VERSION)
+        return True
+
+    def warm_up(self, connections=None):
+        """Open pool connections before they are needed, so the first
+        requests don't pay for connecting.
+
+        :param int connections: defaults to the pool size
+
+        """
+
+        if connections is None:
+            size = getattr(self.engine.pool, 'size', None)
+            connections = size() if size else 1
+
+        conns = []
+        try:
+            for _ in range(connections):
+                conns.append(self.engine.connect())
+        finally:
+            for conn in conns:
+                conn.close()
+
+        self.logger.info('Opened %s connections', len(conns))
+
     @classmethod
     def from_settings(cls, settings):
         return cls(
@@ -72,11 +288,19 @@ class SQLAlchemyDriver(object):
             settings.get('database'),
             backend=settings.get('backend', 'postgresql'),
             con_args=settings.get('connect_args', {}),
+            scoped=settings.get('scoped', False),
+            replicas=settings.get('replicas', ()),
+            max_replica_lag=settings.get('max_replica_lag', 5.0),
         )
 
     def _connection_string(self, password):
-        """Generate the SQLAlchemy connection string"""
+        """Generate the SQLAlchemy connection string.  For the sqlite
+        backend the database is a file path.
 
+        """
+
+        if self.backend == 'sqlite':
+            return 'sqlite:///{}'.format(self.database)
         return '{backend}://{user}:{password}@{host}/{database}'.format(
             backend=self.backend,
             user=self.user,
@@ -85,18 +309,136 @@ class SQLAlchemyDriver(object):
             database=self.database
         )
 
+    @staticmethod
+    def replica_lag(engine):
+        """Measure how many seconds a replica is behind its primary.
+        A replica that has replayed everything it received is not
+        behind, however long ago the last write was.
+
+        :param engine: :class:`sqlalchemy.engine.Engine` of the replica
+        :returns: :class:`float` seconds
+
+        """
+
+        if engine.dialect.name != 'postgresql':
+            return 0.0
+
+        with engine.connect() as conn:
+            if conn.dialect.server_version_info >= (10,):
+                received, replayed = ('pg_last_wal_receive_lsn()',
+                                      'pg_last_wal_replay_lsn()')
+            else:
+                received, replayed = ('pg_last_xlog_receive_location()',
+                                      'pg_last_xlog_replay_location()')
+            lag = conn.execute(sa.text("""
+            SELECT CASE WHEN {} = {} THEN 0
+            ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+            END
+            """.format(received, replayed))).scalar()
+
+        return float(lag or 0)
+
+    def _pick_replica(self):
+        """Return the index of the next replica within the lag limit,
+        or None if there is none.
+
+        """
+
+        start = next(self._next_replica)
+        for n in range(len(self.replicas)):
+            i = (start + n) % len(self.replicas)
+            lag, checked = self._lags.get(i, (None, 0))
+            now = time.time()
+            if now - checked > self._lag_check_interval:
+                try:
+                    lag = self.replica_lag(self.replicas[i])
+                except sa.exc.DBAPIError as e:
+                    self.logger.warning('Replica %s unavailable: %s', i, e)
+                    lag = None
+                self._lags[i] = (lag, now)
+            if lag is not None and lag <= self.max_replica_lag:
+                return i
+            self.logger.debug('Replica %s lag %ss', i, lag)
+
+        return None
+
+    def wrote_recently(self, nick):
+        written = self._writes.get(nick)
+        return (written is not None and
+                time.time() - written <= self.max_replica_lag)
+
+    def _record_write(self, nick):
+        now = time.time()
+        with self._lock:
+            self._writes[nick] = now
+            if len(self._writes) > 10000:
+                self._writes = {
+                    k: v for k, v in self._writes.items()
+                    if now - v <= self.max_replica_lag}
+
     @contextmanager
-    def session(self):
-        """Make working with a session even easier"""
+    def session(self, readonly=False, nick=None):
+        """Make working with a session even easier
+
+        :param bool readonly:
+            The session only reads, and may be served by a replica
+        :param str nick:
+            The user the session is for.  Writes are remembered so the
+            user's next reads see them.
 
-        session = self.session_maker()
+        """
+
+        session_maker = self.session_maker
+        if (readonly and self.replicas and
+                not (nick is not None and self.wrote_recently(nick))):
+            i = self._pick_replica()
+            if i is not None:
+                session_maker = self.replica_session_makers[i]
+
+        session = session_maker()
         try:
             yield session
             session.commit()
         except Exception as msg:
-            self.logger.error('Rolling back session {}'.format(msg))
+            self.logger.error('Rolling back session %s', msg)
             session.rollback()
             raise
         finally:
             session.expunge_all()
             session.close()
+            if self.scoped:
+                session_maker.remove()
+
+        if not readonly and nick is not None:
+            self._record_write(nick)
+
+    @contextmanager
+    def isolated(self):
+        """Run everything the driver does in one transaction that is
+        rolled back on exit.  Sessions and ``engine.begin()`` blocks
+        become savepoints, so rolling one back only undoes its own
+        work.  The connection is shared, so only one thread may use the
+        driver at a time.  Replicas don't see the transaction.
+
+        Example usage::
+
+            with driver.isolated():
+                bbot.create_bullet('nick', 'Test')
+
+        :returns: the :class:`sqlalchemy.engine.Connection`
+
+        """
+
+        engine, session_maker = self.engine, self.session_maker
+        conn = engine.connect()
+        transaction = conn.begin()
+        self.engine = _SavepointEngine(conn, engine)
+        self.session_maker = sessionmaker(bind=conn, class_=_SavepointSession)
+        if self.scoped:
+            self.session_maker = scoped_session(self.session_maker)
+        try:
+            yield conn
+        finally:
+            self.engine, self.session_maker = engine, session_maker
+            transaction.rollback()
+            conn.close()
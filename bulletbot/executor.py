@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.executor
+----------------------------------
+
+Defines :class:`.KeyedExecutor`, :class:`.LaneExecutor`,
+:class:`.FloodLimiter` and :class:`.BulletBatcher`.
+
+:class:`.LaneExecutor` queues chat work in priority lanes: interactive
+commands run before bullet ingestion, which runs before background
+enrichment.  Each lane is bounded, so a burst blocks the reader
+instead of growing memory.  When the queues get too deep or too old,
+the lanes named in ``--shed-lanes`` are deferred until the backlog
+clears.  :class:`.FloodLimiter` is a token bucket per user.
+"""
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Full
+
+import logging
+import threading
+import time
+
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+ENRICH = 'enrich'
+
+# Highest priority first
+LANES = (INTERACTIVE, BULK, ENRICH)
+
+
+class KeyedExecutor(object):
+    """Bounded thread pool that runs tasks submitted under the same key
+    one at a time, in submission order.  Tasks with different keys run
+    in parallel.
+
+    Example usage::
+
+        executor = KeyedExecutor(max_workers=4)
+        executor.submit('user1', bbot.create_bullet, 'user1', 'Test')
+        executor.submit('user1', bbot.list_bullets, 'user1')
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_workers=4, max_pending=1000):
+        """
+        :param int max_workers: Number of worker threads
+        :param int max_pending:
+            Number of queued tasks after which :meth:`submit` blocks
+            the caller.
+
+        """
+
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedule ``fn(*args, **kwargs)`` after all tasks previously
+        submitted with `key`.
+
+        :param key: hashable ordering key, e.g. a nick
+        :returns: :class:`concurrent.futures.Future`
+
+        """
+
+        self._slots.acquire()
+        future = Future()
+        task = (future, fn, args, kwargs)
+
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(task)
+                return future
+            self._queues[key] = deque([task])
+
+        self._pool.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        """Run the tasks queued for `key` until there are none left."""
+
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                future, fn, args, kwargs = queue.popleft()
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except Exception as e:
+                        self.logger.exception(e)
+                        future.set_exception(e)
+            finally:
+                self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+class _Lane(object):
+    """A :class:`.LaneExecutor` lane with the :meth:`submit` signature of
+    :class:`.KeyedExecutor`.
+
+    """
+
+    def __init__(self, executor, name):
+        self.executor = executor
+        self.name = name
+
+    def submit(self, key, fn, *args, **kwargs):
+        return self.executor.submit(self.name, key, fn, *args, **kwargs)
+
+
+class LaneExecutor(object):
+    """Thread pool with priority lanes.  Like :class:`.KeyedExecutor`,
+    tasks with the same key run one at a time in submission order.
+
+    Example usage::
+
+        lanes = LaneExecutor(max_workers=4)
+        lanes.submit(BULK, 'user1', bbot.create_bullet, 'user1', 'Test')
+        lanes.submit(INTERACTIVE, 'user2', bbot.list_bullets, 'user2')
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_workers=4, max_depth=1000, shed_depth=None,
+                 shed_lag=None, shed_lanes=(ENRICH,), metrics_interval=60):
+        """
+        :param int max_workers: Number of worker threads
+        :param int max_depth:
+            Number of queued tasks per lane after which :meth:`submit`
+            blocks the caller
+        :param int shed_depth:
+            defer `shed_lanes` while more interactive and bulk tasks
+            than this are queued
+        :param float shed_lag:
+            defer `shed_lanes` while an interactive or bulk task has
+            waited longer than this many seconds
+        :param tuple shed_lanes: lanes deferred while shedding
+        :param float metrics_interval: seconds between metrics logs
+
+        """
+
+        assert INTERACTIVE not in shed_lanes, 'Interactive lane is never shed'
+
+        self.max_workers = max_workers
+        self.max_depth = max_depth
+        self.shed_depth = shed_depth
+        self.shed_lag = shed_lag
+        self.shed_lanes = tuple(shed_lanes)
+        self.metrics_interval = metrics_interval
+
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._space = threading.Condition(self._lock)
+        self._keys = {}
+        self._running = set()
+        self._ready = {lane: deque() for lane in LANES}
+        self._threads = []
+        self._local = threading.local()
+        self._shutdown = False
+        self._shedding = False
+        self._logged = time.time()
+
+        self._depth = dict.fromkeys(LANES, 0)
+        self._counts = {lane: dict.fromkeys([
+            'submitted', 'completed', 'failed', 'blocked', 'dropped'], 0)
+            for lane in LANES}
+        self._wait = dict.fromkeys(LANES, 0.0)
+        self._shed_count = 0
+
+    def lane(self, name):
+        """Return a view submitting to lane `name`"""
+
+        assert name in LANES, 'Unknown lane {}'.format(name)
+        return _Lane(self, name)
+
+    def submit(self, lane, key, fn, *args, **kwargs):
+        """Schedule ``fn(*args, **kwargs)`` in `lane`, after all tasks
+        previously submitted with `key`.  Blocks while the lane is
+        full, except on a worker thread, where waiting for other workers
+        could deadlock: there it drops the task like :meth:`try_submit`.
+
+        :param str lane: one of :data:`LANES`
+        :param key: hashable ordering key, e.g. a channel
+        :returns: :class:`concurrent.futures.Future`
+
+        """
+
+        block = not getattr(self._local, 'worker', False)
+        return self._submit(lane, key, fn, args, kwargs, block)
+
+    def try_submit(self, lane, key, fn, *args, **kwargs):
+        """Like :meth:`submit`, but never blocks.  If the lane is full
+        the task is dropped and the future fails with
+        :class:`queue.Full`.
+
+        """
+
+        return self._submit(lane, key, fn, args, kwargs, False)
+
+    def _submit(self, lane, key, fn, args, kwargs, block):
+        future = Future()
+        task = (future, lane, time.time(), fn, args, kwargs)
+
+        with self._lock:
+            if not self._threads:
+                self._start()
+
+            if self._depth[lane] >= self.max_depth:
+                if not block:
+                    self._counts[lane]['dropped'] += 1
+                    self.logger.warning('Lane %s full, dropped %s',
+                                        lane, getattr(fn, '__name__', fn))
+                    future.set_exception(Full(lane))
+                    return future
+                self._counts[lane]['blocked'] += 1
+                while self._depth[lane] >= self.max_depth:
+                    self._space.wait()
+
+            self._depth[lane] += 1
+            self._counts[lane]['submitted'] += 1
+
+            queue = self._keys.get(key)
+            if queue is None:
+                queue = self._keys[key] = deque()
+            queue.append(task)
+            if len(queue) == 1 and key not in self._running:
+                self._ready[lane].append(key)
+                self._work.notify()
+
+        return future
+
+    def _start(self):
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._worker, daemon=True,
+                                      name='lanes-{}'.format(i))
+            thread.start()
+            self._threads.append(thread)
+
+    def _oldest(self, lane):
+        if not self._ready[lane]:
+            return 0.0
+        return time.time() - self._keys[self._ready[lane][0]][0][2]
+
+    def _check_shedding(self):
+        depth = self._depth[INTERACTIVE] + self._depth[BULK]
+        lag = max(self._oldest(INTERACTIVE), self._oldest(BULK))
+        shedding = bool(
+            (self.shed_depth and depth > self.shed_depth) or
+            (self.shed_lag and lag > self.shed_lag))
+
+        if shedding != self._shedding:
+            self._shedding = shedding
+            if shedding:
+                self._shed_count += 1
+                self.logger.warning(
+                    'Deferring %s: %s queued, oldest %.1fs',
+                    ', '.join(self.shed_lanes), depth, lag)
+            else:
+                self.logger.info('Resuming %s', ', '.join(self.shed_lanes))
+        return shedding
+
+    def _next_key(self):
+        shedding = self._check_shedding()
+        for lane in LANES:
+            if shedding and lane in self.shed_lanes:
+                continue
+            if self._ready[lane]:
+                return self._ready[lane].popleft()
+        return None
+
+    def _worker(self):
+        self._local.worker = True
+        while True:
+            with self._lock:
+                key = self._next_key()
+                while key is None:
+                    if self._shutdown:
+                        return
+                    # Wake up to recheck shedding as queued tasks age
+                    self._work.wait(timeout=1)
+                    key = self._next_key()
+
+                self._running.add(key)
+                future, lane, queued, fn, args, kwargs = \
+                    self._keys[key].popleft()
+                self._depth[lane] -= 1
+                self._wait[lane] = time.time() - queued
+                self._space.notify_all()
+
+            failed = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    self.logger.exception(e)
+                    future.set_exception(e)
+                    failed = True
+
+            with self._lock:
+                self._running.discard(key)
+                queue = self._keys[key]
+                if queue:
+                    self._ready[queue[0][1]].append(key)
+                    self._work.notify()
+                else:
+                    del self._keys[key]
+                self._counts[lane]['failed' if failed else 'completed'] += 1
+                log = (self.metrics_interval and
+                       time.time() - self._logged > self.metrics_interval)
+                if log:
+                    self._logged = time.time()
+
+            if log:
+                self.logger.info('Lanes %s', self.metrics())
+
+    def metrics(self):
+        """Return queue depth, counters and the last wait in seconds per
+        lane, and whether lanes are being shed.
+
+        :returns: :class:`dict`
+
+        """
+
+        with self._lock:
+            metrics = {lane: dict(self._counts[lane],
+                                  depth=self._depth[lane],
+                                  wait=round(self._wait[lane], 3))
+                       for lane in LANES}
+            metrics['shedding'] = self._shedding
+            metrics['shed_count'] = self._shed_count
+        return metrics
+
+    def shutdown(self, wait=True):
+        """Stop the workers once no task they may run is queued.  Tasks
+        in deferred lanes are left behind.
+
+        """
+
+        with self._lock:
+            self._shutdown = True
+            self._work.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class FloodLimiter(object):
+    """Token bucket per user: `burst` events at once, refilled at `rate`
+    per second.
+
+    """
+
+    def __init__(self, rate, burst, max_users=10000):
+        """
+        :param float rate: events per second allowed, 0 for no limit
+        :param int burst: events allowed at once
+        :param int max_users: buckets kept, least recent dropped first
+
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, user):
+        """Take a token for `user`.
+
+        :returns: :class:`bool` False if the user is over the limit
+
+        """
+
+        if not self.rate:
+            return True
+
+        now = time.time()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(user, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.limited += 1
+            self._buckets[user] = (tokens, now)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        return allowed
+
+
+class BulletBatcher(object):
+    """Coalesces bullets from the same nick that arrive while a write is
+    queued into a single :meth:`.BulletBot.create_bullets` transaction.
+
+    :param bbot: :class:`.BulletBot`
+    :param executor: :class:`.KeyedExecutor` keyed on nick
+
+    """
+
+    def __init__(self, bbot, executor):
+        self.bbot = bbot
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, nick, text, callback):
+        """Queue a bullet to be written.
+
+        :param str nick: The nickname of the user
+        :param str text: The text of the bullet
+        :param callback:
+            called with the channel response once the bullet is
+            written
+
+        """
+
+        with self._lock:
+            pending = self._pending.setdefault(nick, [])
+            pending.append((text, callback))
+            if len(pending) > 1:
+                return
+
+        self.executor.submit(nick, self._flush, nick)
+
+    def _flush(self, nick):
+        with self._lock:
+            pending = self._pending.pop(nick, [])
+
+        if not pending:
+            return
+
+        responses = self.bbot.create_bullets(nick, [t for t, _ in pending])
+        for (_, callback), response in zip(pending, responses):
+            callback(response)
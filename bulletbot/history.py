@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.history
+----------------------------------
+
+Keyset pagination of a user's bullets on ``(datetime, id)``.
+
+Each page is fetched with ``WHERE (datetime, id) > <last key>`` on the
+``(nick, datetime, id)`` index instead of ``OFFSET``, so deep pages
+cost the same as the first.  :class:`.PageCursors` remembers where
+pages start so jumping to page N doesn't rescan pages 1..N-1.
+"""
+
+from collections import OrderedDict
+
+import sqlalchemy as sa
+import threading
+
+from .models import Bullet
+
+
+def after_key(query, key, model=Bullet):
+    """Restrict an ordered bullet query to rows after `key`.
+
+    :param query: :class:`sqlalchemy.orm.query.Query` over bullets
+    :param tuple key: ``(datetime, id)`` of the last row seen, or None
+    :param model: :class:`.Bullet` or :class:`.ArchivedBullet`
+
+    """
+
+    if key is not None:
+        dt, id_ = key
+        query = query.filter(sa.or_(
+            model.datetime > dt,
+            sa.and_(model.datetime == dt, model.id > id_),
+        ))
+    return query.order_by(model.datetime, model.id)
+
+
+def _fetch(sources, key, limit, keys_only=False):
+    """Fetch the next `limit` rows after `key` from each source and
+    merge them.  Ids are unique across bullets and the archive, so the
+    merged order is well defined.
+
+    """
+
+    rows = []
+    for source in sources:
+        if callable(source):
+            rows += source(key, limit, keys_only)
+            continue
+        query, model = source
+        if keys_only:
+            query = query.with_entities(model.datetime, model.id)
+        rows += after_key(query, key, model).limit(limit).all()
+
+    if len(sources) > 1:
+        rows.sort(key=lambda row: (row.datetime, row.id))
+    return rows[:limit]
+
+
+class PageCursors(object):
+    """LRU cache of the key each page starts after, per listing.
+
+    A listing is identified by a tuple whose first element is the nick,
+    so all of a user's listings can be invalidated when their bullets
+    change.
+
+    """
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self._cursors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def nearest(self, listing, page):
+        """Return ``(n, key)`` for the closest known page ``n <= page``."""
+
+        with self._lock:
+            pages = self._cursors.get(listing)
+            if pages is None:
+                return 1, None
+            self._cursors.move_to_end(listing)
+            known = [n for n in pages if n <= page]
+            if not known:
+                return 1, None
+            n = max(known)
+            return n, pages[n]
+
+    def set(self, listing, page, key):
+        with self._lock:
+            self._cursors.setdefault(listing, {})[page] = key
+            self._cursors.move_to_end(listing)
+            while len(self._cursors) > self.maxlen:
+                self._cursors.popitem(last=False)
+
+    def invalidate(self, nick=None):
+        """Forget cursors for `nick`, or all cursors if None."""
+
+        with self._lock:
+            for listing in list(self._cursors):
+                if nick is None or listing[0] == nick:
+                    del self._cursors[listing]
+
+
+def get_page(sources, page, size, cursors=None, listing=None):
+    """Fetch one page of bullets.
+
+    :param list sources:
+        ``(query, model)`` pairs, each an unordered
+        :class:`sqlalchemy.orm.query.Query` selecting columns of
+        `model` including ``datetime`` and ``id``, or functions of
+        ``(key, limit, keys_only)`` like
+        :func:`bulletbot.queries.unsent_page`
+    :param int page: 1 based page number
+    :param int size: rows per page
+    :param cursors: :class:`.PageCursors` to reuse page boundaries
+    :param tuple listing: cache key for this query in `cursors`
+    :returns: ``(rows, has_more)``
+
+    """
+
+    n, key = (cursors.nearest(listing, page) if cursors
+              else (1, None))
+
+    # Walk forward from the nearest known page reading only index keys
+    while n < page:
+        skipped = _fetch(sources, key, size, keys_only=True)
+        if len(skipped) < size:
+            return [], False
+        key = (skipped[-1].datetime, skipped[-1].id)
+        n += 1
+        if cursors:
+            cursors.set(listing, n, key)
+
+    rows = _fetch(sources, key, size + 1)
+    has_more = len(rows) > size
+    if has_more and cursors:
+        last = rows[size - 1]
+        cursors.set(listing, page + 1, (last.datetime, last.id))
+
+    return rows[:size], has_more
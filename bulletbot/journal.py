@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.journal
+----------------------------------
+
+Defines :class:`.BulletJournal` and :class:`.JournalReplayer`.
+
+Bullets are appended to the journal and fsynced before they are
+acknowledged to the user.  If the database write that follows fails,
+the entry stays pending in the journal and the replayer writes it once
+the database is back.  Entries never acknowledged before a restart are
+replayed too.  Bullets already in the database are recognized by their
+:attr:`.Bullet.source_id`.  A bullet that keeps failing for reasons
+other than the database being down is moved to ``bullets.quarantine``
+so it doesn't hold up the rest.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import logging
+import os
+import simplejson
+import sqlalchemy as sa
+import threading
+import uuid
+
+from .models import Bullet, User
+
+
+# Errors meaning the database is unavailable rather than the bullet bad
+OUTAGE_ERRORS = (sa.exc.OperationalError, sa.exc.InterfaceError,
+                 sa.exc.TimeoutError)
+
+
+class BulletJournal(object):
+    """Append-only, fsynced file of bullets waiting to reach the
+    database.
+
+    Each line is a JSON object, either a bullet::
+
+        {"id": "...", "nick": "...", "bullet": "...", "datetime": "...",
+         "source_id": "...", "tenant": "..."}
+
+    or an acknowledgement that a bullet is in the database::
+
+        {"ack": "..."}
+
+    Concurrent writers share fsyncs: a writer that finds another
+    fsync in progress waits for it and returns without syncing if its
+    line was covered.
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    _filename = 'bullets.journal'
+    _quarantine_filename = 'bullets.quarantine'
+    _datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
+    _compact_bytes = 1 << 20
+
+    def __init__(self, directory):
+        """
+        :param str directory: Directory to keep the journal file in
+
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, self._filename)
+        self.quarantine_path = os.path.join(directory,
+                                            self._quarantine_filename)
+
+        self._write_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        # Ids of appended records not yet acknowledged or deferred
+        self._in_flight = set()
+
+        self.pending = self._recover()
+        self._fp = open(self.path, 'a')
+
+        if self.pending:
+            self.logger.warning('Recovered %s journaled bullets',
+                                len(self.pending))
+
+    def _recover(self):
+        """Read the journal and return the bullets that were never
+        acknowledged, in order.
+
+        """
+
+        pending = OrderedDict()
+        if not os.path.exists(self.path):
+            return pending
+
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    record = simplejson.loads(line)
+                except ValueError:
+                    # A torn write at the end of the file
+                    self.logger.warning('Skipping bad journal line %r', line)
+                    continue
+                if 'ack' in record:
+                    pending.pop(record['ack'], None)
+                else:
+                    pending[record['id']] = record
+
+        return pending
+
+    def _write(self, records, in_flight=False):
+        with self._write_lock:
+            if in_flight:
+                self._in_flight.update(record['id'] for record in records)
+            for record in records:
+                self._fp.write(simplejson.dumps(record) + '\n')
+            self._fp.flush()
+            self._written += 1
+            return self._written
+
+    def _sync(self, seq):
+        """Make sure write number `seq` is on disk."""
+
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            target = self._written
+            os.fsync(self._fp.fileno())
+            self._synced = target
+
+    def append(self, nick, texts, source_ids=None, tenant=None):
+        """Durably record bullets.
+
+        :param str nick: The nickname of the user
+        :param list texts: :class:`list` of :class:`str` bullet texts
+        :param list source_ids: :attr:`.Bullet.source_id` for each text
+        :param str tenant: :attr:`.Bullet.tenant`
+        :returns: :class:`list` of the journal records
+
+        """
+
+        now = datetime.utcnow().strftime(self._datetime_format)
+        source_ids = source_ids or [None] * len(texts)
+        records = [{
+            'id': uuid.uuid4().hex,
+            'nick': nick,
+            'bullet': text,
+            'datetime': now,
+            'source_id': source_id,
+            'tenant': tenant,
+        } for text, source_id in zip(texts, source_ids)]
+
+        self._sync(self._write(records, in_flight=True))
+        return records
+
+    def defer(self, records):
+        """Hand records whose database write failed to the replayer."""
+
+        with self._write_lock:
+            for record in records:
+                self._in_flight.discard(record['id'])
+                self.pending[record['id']] = record
+
+    def pending_batch(self, size):
+        """Return up to `size` of the oldest unacknowledged records."""
+
+        with self._write_lock:
+            return [r for _, r in zip(range(size), self.pending.values())]
+
+    def ack(self, records):
+        """Mark records as written to the database.  Acks are not
+        fsynced; losing one only means the bullet is replayed, and
+        replays are deduplicated on source id.
+
+        """
+
+        with self._write_lock:
+            for record in records:
+                self._in_flight.discard(record['id'])
+                self.pending.pop(record['id'], None)
+
+        self._write([{'ack': record['id']} for record in records])
+        self._compact()
+
+    def quarantine(self, record, error):
+        """Set aside a record that can't be written and acknowledge it.
+
+        :param dict record: journal record
+        :param error: the exception writing it raised
+
+        """
+
+        self.logger.error('Quarantined journaled bullet %s: %s',
+                          record['id'], error)
+        with self._write_lock:
+            with open(self.quarantine_path, 'a') as fp:
+                fp.write(simplejson.dumps(dict(record, error=str(error)))
+                         + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+        self.ack([record])
+
+    def _compact(self):
+        """Start a fresh file once everything has been acknowledged."""
+
+        with self._write_lock:
+            if (self.pending or self._in_flight or
+                    self._fp.tell() < self._compact_bytes):
+                return
+            self._fp.truncate(0)
+            self._fp.seek(0)
+
+    def close(self):
+        self._fp.close()
+
+
+class JournalReplayer(threading.Thread):
+    """Background thread that bulk writes pending journal entries to the
+    database.
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, journal, db, interval=5, batch_size=500,
+                 max_attempts=3, cursors=None):
+        """
+        :param journal: :class:`.BulletJournal`
+        :param db: driver with a ``session()`` context manager
+        :param int interval: Seconds between replay attempts
+        :param int batch_size: Bullets written per transaction
+        :param int max_attempts:
+            Failed writes of a bullet, not counting database outages,
+            before it is quarantined
+        :param cursors:
+            :class:`.PageCursors` to invalidate for the nicks of
+            replayed bullets, whose pages now start elsewhere
+
+        """
+
+        super(JournalReplayer, self).__init__(name='journal-replayer')
+        self.daemon = True
+        self.journal = journal
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.cursors = cursors
+        self._attempts = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.replay()
+            except Exception as e:
+                self.logger.warning('Journal replay failed: %s', e)
+
+    def stop(self):
+        self._stopped.set()
+
+    @staticmethod
+    def dedupe(s, records):
+        """Drop records whose source message is already in the database
+        or earlier in the batch.
+
+        :param s: :class:`sqlalchemy.orm.session.Session`
+        :param list records: journal records
+
+        """
+
+        source_ids = [r['source_id'] for r in records if r.get('source_id')]
+        seen = set()
+        if source_ids:
+            seen.update(row.source_id for row in (
+                s.query(Bullet.source_id)
+                .filter(Bullet.source_id.in_(source_ids))))
+
+        unique = []
+        for record in records:
+            source_id = record.get('source_id')
+            if source_id in seen:
+                continue
+            if source_id:
+                seen.add(source_id)
+            unique.append(record)
+        return unique
+
+    def replay(self):
+        """Write all pending journal entries.  If a batch fails, its
+        records are retried one at a time and the ones that keep failing
+        are quarantined.  Database outages are raised.
+
+        :returns: :class:`int` number of bullets written
+
+        """
+
+        written = 0
+        while True:
+            batch = self.journal.pending_batch(self.batch_size)
+            if not batch:
+                return written
+
+            try:
+                written += self._write_batch(batch)
+                continue
+            except OUTAGE_ERRORS:
+                raise
+            except Exception as e:
+                self.logger.warning('Journal batch failed, retrying one '
+                                    'at a time: %s', e)
+
+            retry = False
+            for record in batch:
+                try:
+                    written += self._write_batch([record])
+                except OUTAGE_ERRORS:
+                    raise
+                except Exception as e:
+                    attempts = self._attempts.get(record['id'], 0) + 1
+                    if attempts >= self.max_attempts:
+                        self._attempts.pop(record['id'], None)
+                        self.journal.quarantine(record, e)
+                    else:
+                        self._attempts[record['id']] = attempts
+                        retry = True
+            if retry:
+                # Try the rest again on the next round
+                return written
+
+    def _write_batch(self, batch):
+        with self.db.session() as s:
+            records = self.dedupe(s, batch)
+            tenants = dict((r['nick'], r.get('tenant')) for r in records)
+            for nick, tenant in tenants.items():
+                user = User()
+                user.nick = nick
+                if tenant is not None:
+                    user.tenant = tenant
+                s.merge(user)
+            for record in records:
+                bullet = Bullet()
+                bullet.nick = record['nick']
+                bullet.bullet = record['bullet']
+                bullet.source_id = record.get('source_id')
+                bullet.tenant = record.get('tenant')
+                bullet.datetime = datetime.strptime(
+                    record['datetime'], self.journal._datetime_format,
+                ).replace(tzinfo=timezone.utc)
+                s.add(bullet)
+
+        self.journal.ack(batch)
+        for record in batch:
+            self._attempts.pop(record['id'], None)
+        if self.cursors is not None:
+            for nick in tenants:
+                self.cursors.invalidate(nick)
+        self.logger.info('Replayed %s journaled bullets', len(records))
+        return len(records)
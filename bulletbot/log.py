@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.log
+----------------------------------
+
+Defines :func:`setup_logging`, which sends log records through a
+bounded queue to a background thread that formats and writes them.
+
+Logging from a chat handler only builds the message, if the level is
+enabled, and puts it on the queue, so slow terminals or disks never
+delay a reply.  Messages longer than ``--log-max-length`` are
+truncated, and records are dropped (and counted) rather than blocking
+when the queue is full.  Use ``--log-format json`` for one JSON object
+per line.
+
+Example usage::
+
+    setup_logging('INFO', 'json')
+"""
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import atexit
+import logging
+import queue
+import simplejson
+import sys
+
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+MAX_LENGTH = 2000
+
+QUEUE_SIZE = 10000
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one line of JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return simplejson.dumps(entry)
+
+
+class TruncatingQueueHandler(QueueHandler):
+    """Queue handler that truncates messages and drops records when the
+    queue is full.  Records are formatted by the listener's handler.
+
+    """
+
+    def __init__(self, queue, max_length=MAX_LENGTH):
+        """
+        :param queue: bounded :class:`queue.Queue`
+        :param int max_length: longest message kept, None for no limit
+
+        """
+
+        super(TruncatingQueueHandler, self).__init__(queue)
+        self.max_length = max_length
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge the arguments now, they may change once we return, but
+        # leave formatting to the listener thread
+        message = record.getMessage()
+        if self.max_length and len(message) > self.max_length:
+            message = '{}... ({} more chars)'.format(
+                message[:self.max_length], len(message) - self.max_length)
+        record.msg = message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level='INFO', fmt='text', max_length=MAX_LENGTH,
+                  stream=None, queue_size=QUEUE_SIZE):
+    """Route the root logger through a queue to a background thread.
+    Calling it again replaces the previous setup.
+
+    :param str level: name of the lowest level logged
+    :param str fmt: ``text`` or ``json``
+    :param int max_length: longest message kept, None for no limit
+    :param stream: written to, defaults to :data:`sys.stderr`
+    :returns: the :class:`TruncatingQueueHandler` on the root logger
+
+    """
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if fmt == 'json':
+        output.setFormatter(JSONFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    handler = TruncatingQueueHandler(queue.Queue(queue_size), max_length)
+
+    root = logging.getLogger()
+    for old in [h for h in root.handlers
+                if isinstance(h, TruncatingQueueHandler)]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level.upper()))
+
+    _listener = QueueListener(handler.queue, output)
+    _listener.start()
+    return handler
+
+
+def stop_logging():
+    """Write out queued records and stop the background thread."""
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.minhash
+----------------------------------
+
+Near-duplicate detection of bullets with MinHash and locality
+sensitive hashing.
+
+Each bullet is reduced to a set of character shingles and a MinHash
+signature of :data:`NUM_PERM` values.  The signature is cut into
+:data:`BANDS` bands and each band is hashed to a bucket, stored in
+``bullet_buckets`` as the bullet is written.  Bullets sharing a bucket
+with a new bullet are candidates, and a candidate whose shingles
+overlap by at least the threshold (Jaccard similarity) is a
+duplicate.  A lookup reads a fixed number of buckets from the
+``(nick, band, bucket)`` index, however long the user's history is.
+"""
+
+from datetime import datetime, timezone
+
+import random
+import re
+import sqlalchemy as sa
+import struct
+import zlib
+
+from .models import Bullet, BulletBucket
+
+
+BANDS = 10
+ROWS = 3
+NUM_PERM = BANDS * ROWS
+
+SHINGLE_SIZE = 4
+
+# Bullets at least this similar are duplicates
+THRESHOLD = 0.6
+
+# Candidates checked per bullet
+MAX_CANDIDATES = 20
+
+_prime = (1 << 61) - 1
+_random = random.Random(0x5eed)
+_permutations = [(_random.randrange(1, _prime), _random.randrange(_prime))
+                 for _ in range(NUM_PERM)]
+
+_words = re.compile(r'\w+', re.UNICODE)
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Return the set of `size` character shingles of the text, ignoring
+    case and punctuation.
+
+    """
+
+    text = ' '.join(_words.findall(text.lower()))
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def signature(shingle_set):
+    """Return the MinHash signature of a set of shingles"""
+
+    hashes = [zlib.crc32(s.encode('utf-8')) for s in shingle_set]
+    return [min((a * h + b) % _prime for h in hashes)
+            for a, b in _permutations]
+
+
+def buckets(sig):
+    """Return ``(band, bucket)`` pairs for a signature"""
+
+    return [(band, zlib.crc32(struct.pack(
+        '<{}Q'.format(ROWS), *sig[band * ROWS:(band + 1) * ROWS])))
+        for band in range(BANDS)]
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def find_duplicate(s, nick, text, since, threshold=THRESHOLD):
+    """Find a bullet by `nick` written since `since` that is a near
+    duplicate of `text`.
+
+    :param s: :class:`sqlalchemy.orm.session.Session`
+    :param str nick: The nickname of the user
+    :param str text: The new bullet
+    :param datetime since: only consider bullets indexed after this
+    :returns:
+        ``(duplicate, keys)``, the most similar :class:`.Bullet` or
+        None, and the bucket keys to index the new bullet under
+
+    """
+
+    shingle_set = shingles(text)
+    keys = buckets(signature(shingle_set))
+
+    candidates = (
+        s.query(Bullet)
+        .join(BulletBucket, BulletBucket.bullet_id == Bullet.id)
+        .filter(BulletBucket.nick == nick)
+        .filter(BulletBucket.datetime >= since)
+        .filter(sa.or_(*[
+            sa.and_(BulletBucket.band == band, BulletBucket.bucket == bucket)
+            for band, bucket in keys]))
+        .distinct()
+        .limit(MAX_CANDIDATES)
+        .all())
+
+    best, best_score = None, threshold
+    for candidate in candidates:
+        score = jaccard(shingle_set, shingles(candidate.bullet))
+        if score >= best_score:
+            best, best_score = candidate, score
+
+    return best, keys
+
+
+def index(s, bullet, keys):
+    """Add a flushed bullet to the index under `keys`"""
+
+    now = datetime.now(timezone.utc)
+    for band, bucket in keys:
+        entry = BulletBucket()
+        entry.bullet_id = bullet.id
+        entry.band = band
+        entry.bucket = bucket
+        entry.nick = bullet.nick
+        entry.datetime = now
+        s.add(entry)
+
+
+def prune(s, before):
+    """Drop index entries older than `before`
+
+    :returns: :class:`int` number of entries removed
+
+    """
+
+    return (s.query(BulletBucket)
+            .filter(BulletBucket.datetime < before)
+            .delete(synchronize_session=False))
@@ -4,26 +4,116 @@
 bulletbot.models
 ----------------------------------
 
-Defines :class:`.Recipient`, :class:`.User`, :class:`.Bullet`.
+Defines :class:`.Team`, :class:`.Recipient`, :class:`.User`,
+:class:`.Bullet`, :class:`.BulletBucket`, :class:`.DailyActivity`,
+:class:`.ArchivedBullet` and the full text search index on bullets.
 """
 
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import functions
 
 from sqlalchemy import (
+    DDL,
+    BigInteger,
     Boolean,
     Column,
+    Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
-    text,
+    Table,
+    event,
+    func,
 )
 
 
 Base = declarative_base()
 
 
+@compiles(functions.now, 'sqlite')
+def _sqlite_now(element, compiler, **kw):
+    # CURRENT_TIMESTAMP has no fraction of a second and wouldn't compare
+    # with the datetimes SQLAlchemy stores, e.g. in keyset pagination
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+# Bump when the tables change, so the next start runs create_all, see
+# :meth:`.SQLAlchemyDriver.ensure_schema`
+SCHEMA_VERSION = 9
+
+schema_version = Table(
+    'schema_version', Base.metadata,
+    Column('version', Integer, nullable=False),
+)
+
+# create_all only creates missing tables.  Columns and indexes added to
+# existing tables are listed here as ``(table, name, statements)``, and
+# the statements run where no column, index or table has that name, see
+# :meth:`.SQLAlchemyDriver.migrate`.  A ``(dialect, statement)`` pair
+# only runs on that backend.
+MIGRATIONS = [
+    ('bullets', 'source_id', [
+        'ALTER TABLE bullets ADD COLUMN source_id VARCHAR',
+        'CREATE UNIQUE INDEX ix_bullets_source_id ON bullets (source_id)',
+    ]),
+    ('bullets', 'ix_bullets_nick_datetime_id', [
+        'CREATE INDEX ix_bullets_nick_datetime_id '
+        'ON bullets (nick, datetime, id)',
+    ]),
+    ('bullets', 'duplicate_of', [
+        'ALTER TABLE bullets ADD COLUMN duplicate_of INTEGER',
+    ]),
+    ('bullets', 'suggestion', [
+        'ALTER TABLE bullets ADD COLUMN suggestion VARCHAR',
+    ]),
+    ('users', 'team', [
+        'ALTER TABLE users ADD COLUMN team VARCHAR REFERENCES teams (name)',
+    ]),
+    ('recipients', 'team', [
+        'ALTER TABLE recipients ADD COLUMN team VARCHAR '
+        'REFERENCES teams (name)',
+    ]),
+    ('teams', 'cron_hour', [
+        'ALTER TABLE teams ADD COLUMN cron_hour VARCHAR',
+    ]),
+    ('teams', 'cron_minute', [
+        'ALTER TABLE teams ADD COLUMN cron_minute VARCHAR',
+    ]),
+    ('teams', 'timezone', [
+        'ALTER TABLE teams ADD COLUMN timezone VARCHAR',
+    ]),
+    ('bullets', 'tenant', [
+        'ALTER TABLE bullets ADD COLUMN tenant VARCHAR',
+        'CREATE INDEX ix_bullets_tenant ON bullets (tenant)',
+    ]),
+    ('users', 'tenant', [
+        'ALTER TABLE users ADD COLUMN tenant VARCHAR',
+        'CREATE INDEX ix_users_tenant ON users (tenant)',
+    ]),
+]
+
+
+class Team(Base):
+    """A group of users who get their own digest"""
+
+    __tablename__ = 'teams'
+
+    name = Column(String, primary_key=True)
+
+    # When the team's digest is sent, see bulletbot.schedule.  Teams
+    # without a schedule use the dispatcher's.
+    cron_hour = Column(String)
+    cron_minute = Column(String)
+    timezone = Column(String)
+
+    def __repr__(self):
+        return ('<Team({})>'.format(self.name))
+
+
 class Recipient(Base):
     """People who are receiving bullets"""
 
@@ -32,6 +122,10 @@ class Recipient(Base):
     email = Column(String, primary_key=True)
     is_addressee = Column(Boolean, default=False)
 
+    # Receives this team's digest, or the digest of users without a
+    # team if None
+    team = Column(String, ForeignKey('teams.name'))
+
     def __repr__(self):
         return ('<Recipient({})>'.format(self.email))
 
@@ -46,14 +140,33 @@ class Bullet(Base):
     last_sent = Column(DateTime)
     nick = Column(String, ForeignKey('users.nick'))
 
+    # Identifies the chat message the bullet came from, so redelivered
+    # messages are not stored twice
+    source_id = Column(String, unique=True)
+
+    # Id of the earlier bullet this one nearly repeats, see
+    # bulletbot.minhash
+    duplicate_of = Column(Integer)
+
+    # Spell checked text for the digest, see bulletbot.spelling
+    suggestion = Column(String)
+
+    # Slack workspace the bullet was written in, see bulletbot.workspaces
+    tenant = Column(String, index=True)
+
     datetime = Column(
         DateTime(timezone=True),
         nullable=False,
-        server_default=text('now()'),
+        server_default=func.now(),
     )
 
     user = relationship("User", back_populates="bullets")
 
+    __table_args__ = (
+        # Keyset pagination of a user's bullets, see bulletbot.history
+        Index('ix_bullets_nick_datetime_id', 'nick', 'datetime', 'id'),
+    )
+
     def __repr__(self):
         return ("<Bullet({}, {}, '{}...')>"
                 .format(self.id, self.nick, self.bullet[:15]))
@@ -67,6 +180,11 @@ class User(Base):
     nick = Column(String, primary_key=True)
     realname = Column(String)
     password = Column(String)
+    team = Column(String, ForeignKey('teams.name'))
+
+    # Slack workspace of the user, see bulletbot.workspaces.  The nick
+    # is prefixed with it too, so users never collide across tenants.
+    tenant = Column(String, index=True)
 
     bullets = relationship(
         "Bullet",
@@ -76,3 +194,123 @@ class User(Base):
 
     def __repr__(self):
         return ('<User({})>'.format(self.nick))
+
+
+class BulletBucket(Base):
+    """A locality sensitive hash bucket of a bullet's MinHash
+    signature, see :mod:`bulletbot.minhash`
+
+    """
+
+    __tablename__ = 'bullet_buckets'
+
+    bullet_id = Column(Integer,
+                       ForeignKey('bullets.id', ondelete='CASCADE'),
+                       primary_key=True)
+    band = Column(Integer, primary_key=True)
+    bucket = Column(BigInteger, nullable=False)
+    nick = Column(String, nullable=False)
+    datetime = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('ix_bullet_buckets_lookup', 'nick', 'band', 'bucket',
+              'datetime'),
+    )
+
+    def __repr__(self):
+        return ('<BulletBucket({}, {}, {})>'
+                .format(self.bullet_id, self.band, self.bucket))
+
+
+class DailyActivity(Base):
+    """Number of bullets a user wrote on a day, maintained by
+    :mod:`bulletbot.rollups`
+
+    """
+
+    __tablename__ = 'daily_activity'
+
+    nick = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return ('<DailyActivity({}, {}, {})>'
+                .format(self.nick, self.day, self.count))
+
+
+# The archive table is created by :func:`bulletbot.retention.create_archive`
+# rather than with the other tables, since on PostgreSQL it is
+# partitioned.
+ArchiveBase = declarative_base()
+
+
+class ArchivedBullet(ArchiveBase):
+    """A sent bullet moved out of :class:`.Bullet` by the retention
+    job, see :mod:`bulletbot.retention`
+
+    """
+
+    __tablename__ = 'bullets_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    bullet = Column(String)
+    last_sent = Column(DateTime)
+    nick = Column(String, index=True)
+    source_id = Column(String)
+    duplicate_of = Column(Integer)
+    suggestion = Column(String)
+    tenant = Column(String)
+    datetime = Column(DateTime(timezone=True), primary_key=True)
+
+    def __repr__(self):
+        return ("<ArchivedBullet({}, {}, '{}...')>"
+                .format(self.id, self.nick, self.bullet[:15]))
+
+
+# Full text search over bullets, see :mod:`bulletbot.search`.  On
+# PostgreSQL this is an expression GIN index, on SQLite an FTS5 table
+# kept in sync with triggers.
+
+SEARCH_DDL = [
+    ('postgresql', """
+    CREATE INDEX ix_bullets_fts ON bullets
+    USING gin (to_tsvector('english', coalesce(bullet, '')))
+    """),
+    ('sqlite', """
+    CREATE VIRTUAL TABLE bullets_fts
+    USING fts5(bullet, content='bullets', content_rowid='id')
+    """),
+    ('sqlite', """
+    CREATE TRIGGER bullets_fts_ai AFTER INSERT ON bullets BEGIN
+      INSERT INTO bullets_fts (rowid, bullet) VALUES (new.id, new.bullet);
+    END
+    """),
+    ('sqlite', """
+    CREATE TRIGGER bullets_fts_ad AFTER DELETE ON bullets BEGIN
+      INSERT INTO bullets_fts (bullets_fts, rowid, bullet)
+      VALUES ('delete', old.id, old.bullet);
+    END
+    """),
+    ('sqlite', """
+    CREATE TRIGGER bullets_fts_au AFTER UPDATE OF bullet ON bullets BEGIN
+      INSERT INTO bullets_fts (bullets_fts, rowid, bullet)
+      VALUES ('delete', old.id, old.bullet);
+      INSERT INTO bullets_fts (rowid, bullet) VALUES (new.id, new.bullet);
+    END
+    """),
+]
+
+for dialect, statement in SEARCH_DDL:
+    event.listen(Bullet.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect=dialect))
+
+# Full text search on a bullets table that already exists.  The GIN
+# index covers existing rows, the FTS5 table is rebuilt from them.
+MIGRATIONS.extend([
+    ('bullets', 'ix_bullets_fts',
+     [ddl for ddl in SEARCH_DDL if ddl[0] == 'postgresql']),
+    ('bullets', 'bullets_fts',
+     [ddl for ddl in SEARCH_DDL if ddl[0] == 'sqlite'] +
+     [('sqlite', "INSERT INTO bullets_fts (bullets_fts) VALUES ('rebuild')")]),
+])
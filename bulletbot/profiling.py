@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.profiling
+----------------------------------
+
+Defines :class:`.Profiler`, captures of a running bot triggered by a
+signal.
+
+``kill -USR1 <pid>`` samples every thread's stack for
+``--profile-seconds`` and traces allocations over the same window.
+``kill -USR2 <pid>`` only dumps the stacks of all threads.  Files are
+written to ``--profile-dir``:
+
+- ``<capture>.stacks.txt``: every thread's stack when triggered
+- ``<capture>.folded``: sampled stacks in the folded format read by
+  flamegraph.pl and speedscope, one ``stack count`` per line
+- ``<capture>.heap``: :mod:`tracemalloc` snapshot (load with
+  :meth:`tracemalloc.Snapshot.load`), top allocations in
+  ``<capture>.heap.txt``
+
+Each stack is tagged with the chat command being run (the ``cmd`` of
+:meth:`.SlackBulletBot.execute`) and the innermost
+:class:`.BulletBot` method, both read from the sampled frames.  Until
+a signal arrives nothing runs: no tracing, no sampling thread and no
+bookkeeping in the handlers.
+"""
+
+from datetime import datetime
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+
+logger = logging.getLogger(__name__)
+
+_bulletbot_file = os.path.join(os.path.dirname(__file__), 'bulletbot.py')
+
+
+def tags(frame):
+    """Return ``(command, method)`` for a thread's innermost frame.
+
+    :returns:
+        the ``cmd`` local of the outermost ``execute`` frame and the
+        name of the innermost function defined in
+        :mod:`bulletbot.bulletbot`, either None if not on the stack
+
+    """
+
+    command = method = None
+    while frame is not None:
+        code = frame.f_code
+        if method is None and code.co_filename == _bulletbot_file:
+            method = code.co_name
+        if code.co_name == 'execute' and 'cmd' in frame.f_locals:
+            command = frame.f_locals['cmd']
+        frame = frame.f_back
+    return command, method
+
+
+def folded(frame):
+    """Return the stack of `frame` as ``outer;...;inner``"""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(
+            os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler(object):
+    """Samples the whole process on demand.
+
+    Example usage::
+
+        Profiler('/var/tmp/bulletbot').install()
+
+    """
+
+    def __init__(self, directory, seconds=30, interval=0.005):
+        """
+        :param str directory: where captures are written
+        :param float seconds: length of a capture
+        :param float interval: seconds between stack samples
+
+        """
+
+        self.directory = directory
+        self.seconds = seconds
+        self.interval = interval
+        self._running = threading.Lock()
+
+    def install(self):
+        """Handle SIGUSR1 and SIGUSR2.  Must be called from the main
+        thread.
+
+        """
+
+        signal.signal(signal.SIGUSR1, lambda *_: self.start())
+        signal.signal(signal.SIGUSR2, lambda *_: self.dump_stacks())
+        logger.info('kill -USR1 %s to profile for %ss, -USR2 to dump stacks'
+                    ' to %s', os.getpid(), self.seconds, self.directory)
+
+    def _path(self, suffix):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, '{}-{}{}'.format(
+            datetime.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid(), suffix))
+
+    def dump_stacks(self, path=None):
+        """Write the tagged stack of every thread.
+
+        :returns: :class:`str` path written
+
+        """
+
+        path = path or self._path('.stacks.txt')
+        names = {t.ident: t.name for t in threading.enumerate()}
+        with open(path, 'w') as fp:
+            for ident, frame in sys._current_frames().items():
+                command, method = tags(frame)
+                fp.write('Thread {} ({}) command={} method={}\n'.format(
+                    names.get(ident, ident), ident, command, method))
+                fp.write(''.join(traceback.format_stack(frame)))
+                fp.write('\n')
+
+        logger.info('Dumped thread stacks to %s', path)
+        return path
+
+    def start(self):
+        """Start a capture on a background thread unless one is
+        running.
+
+        :returns: the :class:`threading.Thread` or None
+
+        """
+
+        if not self._running.acquire(blocking=False):
+            logger.warning('Profile already running')
+            return None
+        thread = threading.Thread(target=self._capture, name='profiler',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _capture(self):
+        try:
+            self.capture()
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self._running.release()
+
+    def capture(self, seconds=None):
+        """Sample all threads and trace allocations for `seconds`.
+
+        :returns: :class:`str` path prefix of the files written
+
+        """
+
+        import tracemalloc
+
+        prefix = self._path('')
+        seconds = self.seconds if seconds is None else seconds
+        self.dump_stacks(prefix + '.stacks.txt')
+
+        me = threading.get_ident()
+        counts = {}
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            end = time.time() + seconds
+            while time.time() < end:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    command, method = tags(frame)
+                    key = 'command={};method={};{}'.format(
+                        command, method, folded(frame))
+                    counts[key] = counts.get(key, 0) + 1
+                time.sleep(self.interval)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+        with open(prefix + '.folded', 'w') as fp:
+            for key, count in sorted(counts.items()):
+                fp.write('{} {}\n'.format(key, count))
+
+        snapshot.dump(prefix + '.heap')
+        with open(prefix + '.heap.txt', 'w') as fp:
+            for stat in snapshot.statistics('lineno')[:50]:
+                fp.write('{}\n'.format(stat))
+
+        logger.info('Wrote %s samples to %s.*', sum(counts.values()), prefix)
+        return prefix
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.queries
+----------------------------------
+
+Precompiled statements for the chat and digest hot paths.
+
+Read queries are baked (:mod:`sqlalchemy.ext.baked`): each is built
+and compiled to SQL once per process, later calls only bind
+parameters.  They select columns rather than :class:`.Bullet`
+instances, so rows come back as plain tuples without identity map
+bookkeeping.  Writes that don't need the ORM are Core statements
+built at import.
+
+Example usage::
+
+    with bbot.read_session(nick) as s:
+        rows = queries.unsent_page(s, nick)(None, 10)
+"""
+
+from sqlalchemy.ext import baked
+
+import sqlalchemy as sa
+
+from .models import Bullet, User
+
+
+bakery = baked.bakery()
+
+mark_all_sent = (Bullet.__table__.update()
+                 .where(Bullet.__table__.c.last_sent == None)  # noqa
+                 .values(last_sent=sa.func.now()))
+
+
+def _unsent(keys_only=False):
+    if keys_only:
+        bq = bakery(lambda s: s.query(Bullet.datetime, Bullet.id))
+    else:
+        bq = bakery(lambda s: s.query(
+            Bullet.id, Bullet.bullet, Bullet.datetime))
+    bq += lambda q: (q.filter(Bullet.last_sent == None)  # noqa
+                     .filter(Bullet.nick == sa.bindparam('nick')))
+    return bq
+
+
+def unsent_page(s, nick):
+    """Return a page source over a user's unsent bullets for
+    :func:`bulletbot.history.get_page`.
+
+    :param s: :class:`sqlalchemy.orm.session.Session`
+    :param str nick: The nickname of the user
+    :returns:
+        function of ``(key, limit, keys_only=False)`` returning rows of
+        ``(id, bullet, datetime)``, or ``(datetime, id)`` for keys only
+
+    """
+
+    def fetch(key, limit, keys_only=False):
+        bq = _unsent(keys_only)
+        params = dict(nick=nick, limit=limit)
+        if key is not None:
+            bq += lambda q: q.filter(sa.or_(
+                Bullet.datetime > sa.bindparam('dt'),
+                sa.and_(Bullet.datetime == sa.bindparam('dt'),
+                        Bullet.id > sa.bindparam('id')),
+            ))
+            params['dt'], params['id'] = key
+        bq += lambda q: (q.order_by(Bullet.datetime, Bullet.id)
+                         .limit(sa.bindparam('limit')))
+        return bq(s).params(**params).all()
+
+    return fetch
+
+
+def unsent_at(s, nick, index):
+    """Return the `index` th (0 based) of a user's unsent bullets, as
+    listed by ``.list``.
+
+    :returns: ``(id, bullet, datetime)`` row or None
+
+    """
+
+    bq = _unsent()
+    bq += lambda q: (q.order_by(Bullet.datetime, Bullet.id)
+                     .offset(sa.bindparam('index')).limit(1))
+    rows = bq(s).params(nick=nick, index=index).all()
+    return rows[0] if rows else None
+
+
+def unsent_bullets(s):
+    """Return every unsent bullet with its author, oldest first.
+
+    :returns:
+        :class:`list` of ``(id, bullet, suggestion, duplicate_of, nick,
+        realname)`` rows, usable as :class:`.DigestBullet`
+
+    """
+
+    bq = bakery(lambda s: s.query(
+        Bullet.id, Bullet.bullet, Bullet.suggestion, Bullet.duplicate_of,
+        User.nick, User.realname))
+    bq += lambda q: (q.join(User, Bullet.nick == User.nick)
+                     .filter(Bullet.last_sent == None)  # noqa
+                     .order_by(Bullet.datetime, Bullet.id))
+    return bq(s).all()
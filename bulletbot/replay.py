@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.replay
+----------------------------------
+
+Record and replay the Slack RTM event stream.
+
+With ``--record-rtm <path>`` the Slack bots write every event
+:meth:`.SlackBulletBot.rtm_read` returns to a gzipped JSON lines file,
+one ``{"t": <unix time>, "read": <event>}`` per line.
+``--record-anonymize`` replaces the words of message text with salted
+hashes of the same length, keeping commands (``.list``) and numbers so
+the replay takes the same code paths.
+
+:func:`replay` feeds a recording back through
+:meth:`.SlackBulletBot._parse_reads` of a :class:`.ReplayBot`, whose
+Slack client is a stub, at real time, a multiple of it, or as fast as
+possible, and reports throughput and per-event latency along with the
+lane metrics.
+
+Example usage::
+
+    $ bulletbot replay monday.jsonl.gz --speed 10
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import re
+import simplejson
+import threading
+import time
+
+from .executor import FloodLimiter
+from .slack import SlackBulletBot
+
+
+logger = logging.getLogger(__name__)
+
+_word = re.compile(r'\S+')
+
+
+class Recorder(object):
+    """Appends RTM reads to a gzipped JSON lines file"""
+
+    def __init__(self, path, anonymize=False):
+        """
+        :param str path: file to append to
+        :param bool anonymize: hash the words of message text
+
+        """
+
+        self.path = path
+        self.anonymize = anonymize
+        self._salt = os.urandom(16)
+        self._lock = threading.Lock()
+        self._fp = gzip.open(path, 'at')
+
+    def _hash_word(self, match):
+        word = match.group(0)
+        if word.startswith('.') or word.strip(',').isdigit():
+            return word
+        digest = hashlib.sha1(self._salt + word.encode('utf-8')).hexdigest()
+        return (digest * (len(word) // len(digest) + 1))[:len(word)]
+
+    def scrub(self, read):
+        """Return `read` with its text anonymized"""
+
+        if not self.anonymize or not read.get('text'):
+            return read
+        return dict(read, text=_word.sub(self._hash_word, read['text']))
+
+    def record(self, reads):
+        """Append a batch of reads, stamped with the current time.
+
+        :param list reads: events from :meth:`SlackClient.rtm_read`
+
+        """
+
+        if not reads:
+            return
+        now = time.time()
+        lines = ''.join(simplejson.dumps({'t': now, 'read': self.scrub(read)})
+                        + '\n' for read in reads)
+        with self._lock:
+            self._fp.write(lines)
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+def load(path):
+    """Yield ``(t, read)`` from a recording"""
+
+    with gzip.open(path, 'rt') as fp:
+        for line in fp:
+            if line.strip():
+                entry = simplejson.loads(line)
+                yield entry['t'], entry['read']
+
+
+class StubChannel(object):
+
+    def __init__(self, channel):
+        # Direct message channel ids start with a D and have no members
+        self.members = [] if channel.startswith('D') else [channel]
+        self.sent = 0
+
+    def send_message(self, text):
+        self.sent += 1
+
+
+class StubChannels(dict):
+
+    def find(self, channel):
+        if channel not in self:
+            self[channel] = StubChannel(channel)
+        return self[channel]
+
+
+class StubServer(object):
+
+    def __init__(self):
+        self.channels = StubChannels()
+        self.login_data = {'team': {'id': 'replay'}}
+
+
+class StubSlackClient(object):
+    """Answers the Slack calls :class:`.SlackBulletBot` makes without
+    touching the network.  Users are named after their id.
+
+    """
+
+    def __init__(self, token=None):
+        self.server = StubServer()
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        return []
+
+    def api_call(self, method, **kwargs):
+        if method == 'users.info':
+            return simplejson.dumps({'ok': True, 'user': {
+                'name': kwargs['user'],
+                'is_bot': False,
+            }})
+        return simplejson.dumps({'ok': True})
+
+
+class ReplayBot(SlackBulletBot):
+    """:class:`.SlackBulletBot` with a stubbed Slack client"""
+
+    def reset_sc(self):
+        self.sc = StubSlackClient(self.token)
+
+    def start_lanes(self):
+        super(ReplayBot, self).start_lanes()
+        # Recordings replay faster than anyone types
+        self.flood = FloodLimiter(0, 0)
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def replay(bot, path, speed=1.0):
+    """Feed a recording through ``bot._parse_reads``.
+
+    Latency is from queueing an event to its reply, see
+    :meth:`.SlackBulletBot.admit`.  Reading blocks while a lane is full,
+    so if the bot falls behind the schedule the delay shows up in
+    ``lag``.
+
+    :param bot: :class:`.ReplayBot`
+    :param str path: recording from :class:`.Recorder`
+    :param float speed:
+        multiple of real time, None or 0 to replay as fast as possible
+    :returns:
+        :class:`dict` with ``events``, ``elapsed`` seconds,
+        ``per_second`` and latency percentiles in seconds
+
+    """
+
+    batches = []
+    for t, read in load(path):
+        if batches and batches[-1][0] == t:
+            batches[-1][1].append(read)
+        else:
+            batches.append((t, [read]))
+
+    bot.prepare_db()
+    latencies, lag = [], 0.0
+
+    def timer(began):
+        return lambda future: latencies.append(time.time() - began)
+
+    start = time.time()
+    for t, reads in batches:
+        if speed:
+            due = start + (t - batches[0][0]) / speed
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                lag = max(lag, -wait)
+
+        for read in reads:
+            began = time.time()
+            for future in bot._parse_reads([read]):
+                future.add_done_callback(timer(began))
+
+    # Callbacks have run once the workers have stopped
+    bot.lanes.shutdown()
+    elapsed = time.time() - start
+    latencies.sort()
+    stats = {
+        'events': len(latencies),
+        'elapsed': elapsed,
+        'per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': _percentile(latencies, 0.5),
+        'p95': _percentile(latencies, 0.95),
+        'p99': _percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else 0.0,
+        'lag': lag,
+        'lanes': bot.lanes.metrics(),
+    }
+    logger.info('Replayed %s events in %.2fs (%.0f/s), latency p50 %.1fms '
+                'p95 %.1fms p99 %.1fms, max lag %.2fs',
+                stats['events'], elapsed, stats['per_second'],
+                stats['p50'] * 1e3, stats['p95'] * 1e3, stats['p99'] * 1e3,
+                lag)
+    return stats
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.retention
+----------------------------------
+
+Moves old sent bullets out of the ``bullets`` table.
+
+Sent bullets older than the retention age are copied to
+``bullets_archive``, optionally dumped to gzipped JSONL, and deleted
+from ``bullets``, in batches of one transaction each.  This keeps the
+hot unsent queries and indexes small.
+
+On PostgreSQL 10 and later the archive is range partitioned by month
+on ``datetime``, with partitions created as rows arrive.  Elsewhere it
+is a plain table.  Search and history reach archived rows when asked
+with ``include_archive``.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import gzip
+import logging
+import simplejson
+import sqlalchemy as sa
+
+from .models import ArchivedBullet, Bullet
+
+
+logger = logging.getLogger(__name__)
+
+archive = ArchivedBullet.__table__
+
+ARCHIVE_COLUMNS = ['id', 'bullet', 'last_sent', 'nick', 'source_id',
+                   'duplicate_of', 'suggestion', 'tenant', 'datetime']
+
+# Columns added after the archive was first released, and their types
+ADDED_COLUMNS = [
+    ('duplicate_of', 'integer'),
+    ('suggestion', 'varchar'),
+    ('tenant', 'varchar'),
+]
+
+
+def partitioned(conn):
+    return (conn.dialect.name == 'postgresql' and
+            conn.dialect.server_version_info >= (10,))
+
+
+def create_archive(conn):
+    """Create the archive table if it doesn't exist, and add the
+    :data:`ADDED_COLUMNS` an older one is missing.
+
+    """
+
+    is_partitioned = partitioned(conn)
+    if not is_partitioned:
+        archive.create(conn, checkfirst=True)
+    else:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS bullets_archive (
+            id integer NOT NULL,
+            bullet varchar,
+            last_sent timestamp,
+            nick varchar,
+            source_id varchar,
+            duplicate_of integer,
+            suggestion varchar,
+            tenant varchar,
+            datetime timestamptz NOT NULL,
+            PRIMARY KEY (id, datetime)
+        ) PARTITION BY RANGE (datetime)
+        """)
+
+    existing = {c['name'] for c in
+                sa.inspect(conn).get_columns('bullets_archive')}
+    for column, type_ in ADDED_COLUMNS:
+        if column not in existing:
+            # Partitions get the column from their parent
+            conn.execute('ALTER TABLE bullets_archive ADD COLUMN {} {}'
+                         .format(column, type_))
+            logger.info('Added column bullets_archive.%s', column)
+
+    if is_partitioned and conn.dialect.server_version_info >= (11,):
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_bullets_archive_nick
+        ON bullets_archive (nick, datetime, id)
+        """)
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_bullets_archive_fts
+        ON bullets_archive
+        USING gin (to_tsvector('english', coalesce(bullet, '')))
+        """)
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def create_partitions(conn, datetimes):
+    """Create the monthly partitions needed to hold rows with these
+    timestamps.
+
+    """
+
+    for start in set(month_start(dt) for dt in datetimes):
+        end = month_start(start + timedelta(days=32))
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS bullets_archive_{:%Y_%m}
+        PARTITION OF bullets_archive
+        FOR VALUES FROM ('{:%Y-%m-%d}') TO ('{:%Y-%m-%d}')
+        """.format(start, start, end))
+
+
+def dump(path, rows):
+    """Append rows to a gzipped JSONL file."""
+
+    with gzip.open(path, 'at') as fp:
+        for row in rows:
+            fp.write(simplejson.dumps({
+                c: (getattr(row, c).isoformat()
+                    if isinstance(getattr(row, c), datetime)
+                    else getattr(row, c))
+                for c in ARCHIVE_COLUMNS
+            }))
+            fp.write('\n')
+
+
+def archive_sent(engine, older_than, dump_path=None, batch_size=5000):
+    """Move sent bullets created before `older_than` to the archive.
+
+    :param engine: :class:`sqlalchemy.engine.Engine`
+    :param datetime older_than: cutoff on :attr:`.Bullet.datetime`
+    :param str dump_path: also append the rows to this ``.jsonl.gz``
+    :param int batch_size: rows moved per transaction
+    :returns: :class:`int` number of bullets archived
+
+    """
+
+    bullets = Bullet.__table__
+    select = (sa.select([bullets.c[c] for c in ARCHIVE_COLUMNS])
+              .where(bullets.c.last_sent != None)  # noqa
+              .where(bullets.c.datetime < older_than)
+              .order_by(bullets.c.id)
+              .limit(batch_size))
+
+    with engine.begin() as conn:
+        create_archive(conn)
+
+    count = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select).fetchall()
+            if not rows:
+                break
+
+            if partitioned(conn):
+                create_partitions(conn, [row.datetime for row in rows])
+            conn.execute(archive.insert(), [
+                {c: row[c] for c in ARCHIVE_COLUMNS} for row in rows])
+            conn.execute(bullets.delete().where(
+                bullets.c.id.in_([row.id for row in rows])))
+
+        # Only dump rows whose move committed, so a failed batch that is
+        # retried isn't written twice
+        if dump_path:
+            dump(dump_path, rows)
+        count += len(rows)
+        logger.info('Archived %s bullets', count)
+
+    return count
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.rollups
+----------------------------------
+
+Per-user daily bullet counts in :class:`.DailyActivity`.
+
+:func:`refresh` recomputes the counts for recent days with a single
+``GROUP BY`` in the database; run periodically it keeps the rollups
+current, and with an early `since` it backfills history.  Statistics
+are then read from at most one row per user per day instead of from
+raw bullets.
+"""
+
+from collections import namedtuple
+from datetime import date, timedelta
+
+import sqlalchemy as sa
+
+from .models import ArchivedBullet, Bullet, DailyActivity
+from .retention import archive
+
+
+Stats = namedtuple('Stats', ['nick', 'days', 'total', 'active_days',
+                             'per_day', 'streak', 'longest_streak'])
+
+PERIODS = {
+    'day': 1,
+    'week': 7,
+    'month': 30,
+    'quarter': 91,
+    'year': 365,
+}
+
+
+def _counts(model, since):
+    day = sa.func.date(model.datetime)
+    query = (sa.select([model.nick, day.label('day'),
+                        sa.func.count().label('count')])
+             .group_by(model.nick, day))
+    if since is not None:
+        query = query.where(model.datetime >= since)
+    return query
+
+
+def refresh(conn, since=None):
+    """Recompute rollups for days on or after `since`, or for all of
+    history if None.  Runs in one transaction, so readers see either
+    the old or the new counts.
+
+    :param conn: :class:`sqlalchemy.engine.Connection` in a transaction
+    :param date since: first day to recompute
+    :returns: :class:`int` number of rollup rows written
+
+    """
+
+    counts = _counts(Bullet, since)
+    if since is None or since < date.today() - timedelta(days=1):
+        # Older days may have been moved to the archive
+        if archive.exists(conn):
+            counts = sa.union_all(counts, _counts(ArchivedBullet, since))
+    counts = counts.alias()
+
+    totals = (sa.select([counts.c.nick, counts.c.day,
+                         sa.func.sum(counts.c.count)])
+              .group_by(counts.c.nick, counts.c.day))
+
+    table = DailyActivity.__table__
+    delete = table.delete()
+    if since is not None:
+        delete = delete.where(table.c.day >= since)
+    conn.execute(delete)
+
+    return conn.execute(table.insert().from_select(
+        ['nick', 'day', 'count'], totals)).rowcount
+
+
+def streaks(days, end):
+    """Return ``(current, longest)`` runs of consecutive active days.
+    The current streak still counts if `end` itself has no bullets yet.
+
+    :param days: :class:`set` of active :class:`date`
+    :param date end: last day of the period
+
+    """
+
+    longest = run = 0
+    for day in sorted(days):
+        run = run + 1 if day - timedelta(days=1) in days else 1
+        longest = max(longest, run)
+
+    current = 0
+    day = end if end in days else end - timedelta(days=1)
+    while day in days:
+        current += 1
+        day -= timedelta(days=1)
+
+    return current, longest
+
+
+def stats(s, nick=None, days=7, end=None, prefix=None):
+    """Activity statistics per user over the last `days` days.
+
+    :param s: :class:`sqlalchemy.orm.session.Session`
+    :param str nick: a single user, or everyone if None
+    :param int days: length of the period
+    :param date end: last day of the period, defaults to today
+    :param str prefix: only users whose nick starts with this
+    :returns: :class:`list` of :class:`.Stats`, most active first
+
+    """
+
+    end = end or date.today()
+    start = end - timedelta(days=days - 1)
+
+    query = (s.query(DailyActivity.nick, DailyActivity.day,
+                     DailyActivity.count)
+             .filter(DailyActivity.day >= start)
+             .filter(DailyActivity.day <= end))
+    if nick is not None:
+        query = query.filter(DailyActivity.nick == nick)
+    if prefix is not None:
+        query = query.filter(DailyActivity.nick.startswith(prefix))
+
+    active = {}
+    for row in query:
+        active.setdefault(row.nick, {})[row.day] = row.count
+
+    results = []
+    for user, counts in active.items():
+        total = sum(counts.values())
+        current, longest = streaks(set(counts), end)
+        results.append(Stats(user, days, total, len(counts),
+                             total / days, current, longest))
+
+    return sorted(results, key=lambda r: (-r.total, r.nick))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.schedule
+----------------------------------
+
+Defines :class:`.DigestScheduler`.
+
+Teams can have their own send time and timezone, stored on
+:class:`.Team`.  Teams without one, and users without a team, are sent
+on the global ``--cron-hour``/``--cron-minute`` schedule.
+
+Digest jobs are kept in the database with APScheduler's
+:class:`SQLAlchemyJobStore`, so a dispatcher that was down when a job
+was due runs it once (``coalesce``) when it comes back, as long as it
+is within ``--misfire-grace`` seconds.  Each send waits a random delay
+of up to ``--send-jitter`` seconds first, so teams scheduled for the
+same minute don't all hit the database and mail relay at once.
+"""
+
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.blocking import BlockingScheduler
+from datetime import datetime, timezone as tz
+
+import logging
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Stored jobs refer to their function by name, so the job function is
+# module level and looks the bot up here
+_bot = None
+
+DEFAULT = '*'
+
+JOB_PREFIX = 'digest:'
+
+
+def send_digest(key):
+    """Job function that sends the digest for a team, or for everyone
+    on the default schedule if `key` is :data:`DEFAULT`.
+
+    """
+
+    bot = _bot
+    delay = random.uniform(0, bot.args.send_jitter or 0)
+    logger.info('Sending digest %s in %.0fs', key, delay)
+    time.sleep(delay)
+
+    if key == DEFAULT:
+        teams = [None] + [team.name for team in bot.team_schedules()
+                          if not team.cron_hour and not team.cron_minute]
+    else:
+        teams = [key]
+    bot.send_bullets_mark_sent(teams)
+
+
+class DigestScheduler(object):
+    """Keeps one digest job per team schedule in a persistent job
+    store, in sync with the :class:`.Team` table.
+
+    Example usage::
+
+        DigestScheduler(bbot).start()
+
+    """
+
+    def __init__(self, bot):
+        """
+        :param bot: :class:`.BulletBot` with a SQLAlchemy driver
+
+        """
+
+        self.bot = bot
+        self.scheduler = BlockingScheduler(
+            jobstores={
+                'default': SQLAlchemyJobStore(engine=bot.db.engine),
+                'local': MemoryJobStore(),
+            },
+            job_defaults={
+                'coalesce': True,
+                'misfire_grace_time': bot.args.misfire_grace,
+            },
+            timezone=bot.args.cron_timezone or None,
+        )
+
+    def schedules(self):
+        """Return ``{key: (cron_args, timezone)}`` for each digest job"""
+
+        schedules = {}
+        cron_args = self.bot.get_email_cron_args()
+        if cron_args:
+            schedules[DEFAULT] = (cron_args, self.bot.args.cron_timezone)
+
+        for team in self.bot.team_schedules():
+            team_args = {k: v for k, v in dict(
+                hour=team.cron_hour,
+                minute=team.cron_minute,
+            ).items() if v}
+            if team_args:
+                schedules[team.name] = (
+                    team_args, team.timezone or self.bot.args.cron_timezone)
+
+        return schedules
+
+    def sync(self):
+        """Add, replace and remove digest jobs to match the schedules in
+        the database.  Jobs whose schedule is unchanged are left alone,
+        so their missed runs are still caught up.
+
+        """
+
+        schedules = self.schedules()
+        for key, (cron_args, timezone) in schedules.items():
+            trigger_args = dict(cron_args)
+            if timezone:
+                trigger_args['timezone'] = timezone
+
+            # The job name records the schedule it was created with
+            job_id = JOB_PREFIX + key
+            name = 'Digest for {} at {}'.format(key, sorted(
+                trigger_args.items()))
+            job = self.scheduler.get_job(job_id)
+            if job is not None and job.name == name:
+                continue
+
+            self.scheduler.add_job(
+                'bulletbot.schedule:send_digest', 'cron',
+                id=job_id,
+                name=name,
+                args=[key],
+                replace_existing=True,
+                **trigger_args)
+            logger.info(name)
+
+        for job in self.scheduler.get_jobs(jobstore='default'):
+            if (job.id.startswith(JOB_PREFIX) and
+                    job.id[len(JOB_PREFIX):] not in schedules):
+                logger.info('Removing %s', job.name)
+                job.remove()
+
+    def start(self):
+        """Blocking call to run the scheduler."""
+
+        global _bot
+        _bot = self.bot
+
+        # Sync once the stored jobs are loaded, then every few minutes
+        self.scheduler.add_job(self.sync, 'interval', jobstore='local',
+                               minutes=self.bot.args.schedule_minutes,
+                               next_run_time=datetime.now(tz.utc))
+        if self.bot.args.rollup_minutes:
+            self.scheduler.add_job(self.bot.refresh_rollups, 'interval',
+                                   jobstore='local',
+                                   minutes=self.bot.args.rollup_minutes)
+
+        self.scheduler.start()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.search
+----------------------------------
+
+Ranked full text search over all bullets.
+
+Results are ordered by ``(rank, id)`` descending and paginated by
+keyset: pass the last row of a page as `after` to get the next one.
+PostgreSQL uses the ``tsvector`` GIN index and ``ts_rank``, SQLite the
+FTS5 table and ``bm25``.  Other backends fall back to an unranked
+``LIKE`` scan, as does the archive table on SQLite.
+"""
+
+from collections import namedtuple
+
+import re
+import sqlalchemy as sa
+
+from .models import ArchivedBullet, Bullet
+
+
+SearchResult = namedtuple('SearchResult',
+                          ['id', 'nick', 'bullet', 'datetime', 'rank'])
+
+_term_pattern = re.compile(r'\w+', re.UNICODE)
+
+
+def terms(query):
+    """Split a user query into search terms, dropping operators and
+    punctuation so user input can't produce invalid query syntax.
+
+    """
+
+    return _term_pattern.findall(query)
+
+
+def _filters(model, nick, since):
+    clauses = []
+    if nick is not None:
+        clauses.append(model.nick == nick)
+    if since is not None:
+        clauses.append(model.datetime >= since)
+    return clauses
+
+
+def _postgresql(model, query, nick, since):
+    tsvector = sa.func.to_tsvector(
+        'english', sa.func.coalesce(model.bullet, ''))
+    tsquery = sa.func.plainto_tsquery('english', ' '.join(terms(query)))
+    rank = sa.func.ts_rank(tsvector, tsquery)
+
+    return (sa.select([model.id, model.nick, model.bullet,
+                       model.datetime, rank.label('rank')])
+            .where(sa.and_(tsvector.op('@@')(tsquery),
+                           *_filters(model, nick, since))))
+
+
+def _sqlite(model, query, nick, since):
+    if model is not Bullet:
+        return _like(model, query, nick, since)
+
+    fts = sa.table('bullets_fts', sa.column('rowid'))
+    match = ' '.join('"{}"'.format(t) for t in terms(query))
+    # bm25() is lower for better matches
+    rank = -sa.func.bm25(sa.literal_column('bullets_fts'))
+
+    return (sa.select([Bullet.id, Bullet.nick, Bullet.bullet,
+                       Bullet.datetime, rank.label('rank')])
+            .select_from(fts.join(Bullet.__table__,
+                                  Bullet.id == fts.c.rowid))
+            .where(sa.and_(sa.literal_column('bullets_fts').op('MATCH')(match),
+                           *_filters(Bullet, nick, since))))
+
+
+def _escape_like(term):
+    """Escape ``LIKE`` wildcards so `term` only matches itself."""
+
+    return (term.replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _like(model, query, nick, since):
+    return (sa.select([model.id, model.nick, model.bullet,
+                       model.datetime, sa.literal(0.0).label('rank')])
+            .where(sa.and_(*[model.bullet.ilike(
+                                 '%{}%'.format(_escape_like(t)), escape='\\')
+                             for t in terms(query)] +
+                           _filters(model, nick, since))))
+
+
+_dialects = {
+    'postgresql': _postgresql,
+    'sqlite': _sqlite,
+}
+
+
+def search(conn, query, nick=None, since=None, limit=10, after=None,
+           include_archive=False):
+    """Search bullets.
+
+    :param conn: connection or session to execute on
+    :param str query: free text search terms
+    :param str nick: only search this nick's bullets
+    :param datetime since: only search bullets created at or after
+    :param int limit: page size
+    :param after: last :class:`.SearchResult` of the previous page
+    :param bool include_archive: also search archived bullets
+    :returns: :class:`list` of :class:`.SearchResult`
+
+    """
+
+    if not terms(query):
+        return []
+
+    bind = conn.get_bind() if hasattr(conn, 'get_bind') else conn
+    build = _dialects.get(bind.dialect.name, _like)
+    matches = build(Bullet, query, nick, since)
+    if include_archive:
+        matches = sa.union_all(
+            matches, build(ArchivedBullet, query, nick, since))
+    matches = matches.alias()
+
+    page = sa.select([matches])
+    if after is not None:
+        page = page.where(sa.or_(
+            matches.c.rank < after.rank,
+            sa.and_(matches.c.rank == after.rank, matches.c.id < after.id),
+        ))
+    page = (page
+            .order_by(matches.c.rank.desc(), matches.c.id.desc())
+            .limit(limit))
+
+    return [SearchResult(*row) for row in conn.execute(page)]
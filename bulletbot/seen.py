@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.seen
+----------------------------------
+
+Defines :class:`.SeenSet`.
+"""
+
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class SeenSet(object):
+    """Bounded set of recently seen keys.  Keys are forgotten after
+    `ttl` seconds, or oldest first once there are more than `maxlen`.
+
+    Example usage::
+
+        seen = SeenSet()
+        seen.add(('C024BE91L', '1358878749.000002'))  # True
+        seen.add(('C024BE91L', '1358878749.000002'))  # False
+
+    """
+
+    def __init__(self, maxlen=10000, ttl=600):
+        """
+        :param int maxlen: Maximum number of keys remembered
+        :param float ttl: Seconds a key is remembered for
+
+        """
+
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        keys = self._keys
+        while keys:
+            key, seen_at = next(iter(keys.items()))
+            if len(keys) <= self.maxlen and now - seen_at < self.ttl:
+                break
+            keys.popitem(last=False)
+
+    def add(self, key):
+        """Remember `key`.
+
+        :returns: :class:`bool` True if the key was not already seen
+
+        """
+
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if key in self._keys:
+                return False
+            self._keys[key] = now
+            return True
+
+    def __contains__(self, key):
+        with self._lock:
+            self._expire(time.time())
+            return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
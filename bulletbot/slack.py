@@ -13,9 +13,12 @@ To use, run ``bin/slack_bulletbot``
 from slackclient import SlackClient
 
 import simplejson
+import threading
 import time
 
 from .bulletbot import BulletBot
+from .executor import BULK, INTERACTIVE
+from .seen import SeenSet
 
 
 HELP_MESSAGE = """
@@ -26,8 +29,12 @@ have any bullets that did not make the deadline, they will be sent the
 following day.
 
 Commands:
-   .list                      - list unsent bullets
-   .delete <no.> [<no. 2>]    - delete unsent bullets
+   .list [--page <no.>]       - list unsent bullets
+   .delete <no.>[-<no.>] ...  - delete unsent bullets
+   .search <terms>            - search all of your bullets
+   .history [<from>] [<to>]   - page through your bullets by date
+   .stats [<nick>|all] [week] - bullet counts and streaks
+   .team [<name>]             - join a team, its digest gets your bullets
 
 That's it!
 """.strip()
@@ -38,26 +45,85 @@ class SlackBulletBot(BulletBot):
 
     """
 
+    # Set by ``--record-rtm``, see :mod:`bulletbot.replay`
+    recorder = None
+
+    help_message = HELP_MESSAGE
+    unknown_command = "Sorry :sweat_smile: I don't know that command"
+    # Slack names users itself
+    excluded_commands = ('register',)
+
     def __init__(self, db=None, token=None):
         super(SlackBulletBot, self).__init__(db)
         self.token = token or self.args.token
+        self.seen = SeenSet()
+        self._say_lock = threading.Lock()
+        self.start_lanes()
+        self.recorder = self.get_recorder()
         self.reset_sc()
 
+    def get_recorder(self):
+        """Record the event stream with ``--record-rtm``, see
+        :mod:`bulletbot.replay`.
+
+        :returns: :class:`.Recorder` or None
+
+        """
+
+        if not self.args.record_rtm:
+            return None
+        from .replay import Recorder
+        return Recorder(self.args.record_rtm, self.args.record_anonymize)
+
     def reset_sc(self):
         """Create a slack client with self.token"""
 
         self.sc = SlackClient(self.token)
 
+    def rtm_connect(self):
+        """Connect the websocket while the database is prepared on
+        another thread, see :meth:`.BulletBot.prepare_db`.
+
+        :returns: :class:`bool` True if connected
+
+        """
+
+        start = time.time()
+        prepare = threading.Thread(target=self.prepare_db, name='prepare-db')
+        prepare.start()
+        connected = self.sc.rtm_connect()
+        prepare.join()
+
+        elapsed = time.time() - start
+        self.logger.info('Connected in %.2fs', elapsed)
+        if elapsed > self.args.startup_budget:
+            self.logger.warning('Connecting took %.2fs, over the %ss budget',
+                                elapsed, self.args.startup_budget)
+        return connected
+
+    def rtm_read(self):
+        """Read events from the websocket, recording them if
+        ``--record-rtm`` is set.
+
+        :returns: :class:`list` of JSON reads
+
+        """
+
+        reads = self.sc.rtm_read()
+        if self.recorder is not None:
+            self.recorder.record(reads)
+        return reads
+
     def listen(self):
         """Connect a websocket and read/parse incoming events.
 
         """
 
-        if self.sc.rtm_connect():
+        if self.rtm_connect():
             self.sc.server.websocket.sock.setblocking(True)
             while True:
                 try:
-                    self._parse_reads(self.sc.rtm_read())
+                    self._parse_reads(self.rtm_read())
                 except Exception as e:
                     self.logger.exception(e)
                     break
@@ -69,14 +135,38 @@ class SlackBulletBot(BulletBot):
         return self.listen()
 
     def _parse_reads(self, reads):
-        """Loop over events read from the websocket
+        """Queue events read from the websocket to be parsed on the
+        worker threads, see :meth:`admit`.
 
         :param list read: List of JSON reads
+        :returns: :class:`list` of :class:`Future` for the queued reads
 
         """
 
+        futures = []
         for read in reads:
-            self._parse_read(read)
+            future = self.admit(read)
+            if future is not None:
+                futures.append(future)
+        return futures
+
+    def admit(self, read):
+        """Queue a message for :meth:`_parse_read`, commands in the
+        interactive lane and bullets in the bulk lane.  Events without
+        text are dropped.  Blocks while the lane is full.
+
+        :param dict read: JSON read from websocket
+        :returns: :class:`Future` or None if dropped
+
+        """
+
+        channel = read.get('channel')
+        text = read.get('text', '').strip()
+        if not channel or not text:
+            return self.logger.debug('Non message read: %s', read)
+
+        lane = INTERACTIVE if text.startswith('.') else BULK
+        return self.lanes.submit(lane, channel, self._parse_read, read)
 
     def say(self, channel, text):
         """Send text to channel
@@ -86,7 +176,8 @@ class SlackBulletBot(BulletBot):
 
         """
 
-        self.sc.server.channels.find(channel).send_message(text)
+        with self._say_lock:
+            self.sc.server.channels.find(channel).send_message(text)
 
     def get_user_info(self, user):
         """Given user key, return user info dict
@@ -96,7 +187,7 @@ class SlackBulletBot(BulletBot):
         """
 
         user_info_str = self.sc.api_call('users.info', user=user)
-        self.logger.debug('User info: {}'.format(user_info_str))
+        self.logger.debug('User info: %s', user_info_str)
         user_info = simplejson.loads(user_info_str)
         assert user_info['ok'], 'Failed to get info on user {}'.format(user)
         return user_info['user']
@@ -114,32 +205,55 @@ class SlackBulletBot(BulletBot):
         tokens = text.split(' ')
 
         if not channel:
-            return self.logger.info('Non channel read: {}'.format(read))
+            return self.logger.debug('Non channel read: %s', read)
 
         if not text:
-            return self.logger.debug('Non text read: {}'.format(read))
+            return self.logger.debug('Non text read: %s', read)
 
         if not tokens:
-            return self.logger.debug('Non token read: {}'.format(read))
+            return self.logger.debug('Non token read: %s', read)
 
         if self.sc.server.channels.find(channel).members:
-            return self.logger.debug('Non privmsg read: {}'.format(read))
-
-        self.logger.info("New command: '{}'".format(text))
+            return self.logger.debug('Non privmsg read: %s', read)
+
+        # Slack redelivers messages after a reconnect.  A message is only
+        # marked seen once handled, so one that failed before it was
+        # stored or journaled is handled again.
+        ts = read.get('ts')
+        key = (channel, ts)
+        if ts and key in self.seen:
+            return self.logger.debug('Duplicate read: %s', read)
+
+        # Bullets are never dropped, only commands are flood limited
+        if self.router.is_command(text) and not self.flood.allow(user):
+            self.logger.warning('Flood limited %s', user)
+            self.say(channel, self.flood_message)
+            if ts:
+                self.seen.add(key)
+            return
+
+        self.logger.info("New command: '%s'", text)
 
         user_info = self.get_user_info(user)
-        nick = user_info['name']
+        nick = self.qualify(user_info['name'])
         realname = user_info.get('real_name', None)
 
         if user_info['is_bot']:
-            return self.logger.debug('Bot message read: {}'.format(read))
+            if ts:
+                self.seen.add(key)
+            return self.logger.debug('Bot message read: %s', read)
 
         cmd = tokens[0]
         text = ' '.join(tokens[1:])
 
-        self.execute(channel, nick, cmd, text, realname=realname)
+        # Channel ids are only unique within a workspace
+        source = self.qualify('{}:{}'.format(channel, ts)) if ts else None
+        self.execute(channel, nick, cmd, text, realname=realname,
+                     source=source)
+        if ts:
+            self.seen.add(key)
 
-    def execute(self, channel, nick, cmd, text, realname=None):
+    def execute(self, channel, nick, cmd, text, realname=None, source=None):
         """Given a nick on a channel execute a command.  If :param:`realname`
         is provided, perform a registration using it.
 
@@ -148,27 +262,22 @@ class SlackBulletBot(BulletBot):
         :param str cmd: first token in input text
         :param str text: all of input text that's not the first token
         :param str realname: Slack user `real_name`
+        :param str source: unique id of the Slack message
 
         """
-        self.merge_nick(nick, realname)
-
-        self.logger.info('Command [{}]: {}'.format(cmd, text))
-
-        if cmd in ['.ls', '.list']:
-            self.say(channel, self.list_bullets(nick))
-
-        elif cmd in ['.help', '.comands']:
-            self.say(channel, HELP_MESSAGE)
 
-        elif cmd in ['.delete', '.rm']:
-            self.say(channel, self.delete_bullets(nick, text))
+        self.logger.info('Command [%s]: %s', cmd, text)
 
-        elif cmd.startswith('.'):
-            self.say(channel, "Sorry :sweat_smile: I don't know that command")
-            self.say(channel, HELP_MESSAGE)
+        if self.router.is_command(cmd):
+            self.merge_nick(nick, realname)
+            self.say(channel, self.router.dispatch(self, nick, cmd, text))
 
         else:
             full_text = '{} {}'.format(cmd, text)
+            lines = full_text.split('\n')
 
-            for line in full_text.split('\n'):
-                self.say(channel, self.create_bullet(nick, line))
+            # create_bullets stores the user itself, journaled if the
+            # database is down
+            responses = self.create_bullets(nick, lines, realname=realname,
+                                            source=source)
+            self.say(channel, '\n'.join(responses))
@@ -16,19 +16,15 @@ following line in the file `~/.sopel/modules/sopel_bulletbot.py`
 """
 
 from sopel.config.types import StaticSection, NO_DEFAULT, ValidatedAttribute
-from sopel.module import rule, commands, require_privmsg
+from sopel.module import rule, require_privmsg
 
 from bulletbot.driver import SQLAlchemyDriver
 from bulletbot.bulletbot import BulletBot
-from bulletbot.models import Base
+from bulletbot.executor import BULK, INTERACTIVE, BulletBatcher
 
 import configargparse
-import logging
+import threading
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(message)s'
-)
 
 HELP_MESSAGE = """
 
@@ -38,8 +34,12 @@ have any bullets that did not make the deadline, they will be sent the
 following day.
 
 Commands:
-   .list                      - list unsent bullets
-   .delete <no.> [<no. 2>]    - delete unsent bullets
+   .list [--page <no.>]       - list unsent bullets
+   .delete <no.>[-<no.>] ...  - delete unsent bullets
+   .search <terms>            - search all of your bullets
+   .history [<from>] [<to>]   - page through your bullets by date
+   .stats [<nick>|all] [week] - bullet counts and streaks
+   .team [<name>]             - join a team, its digest gets your bullets
    .register <name >          - register the name to use on your bullets
 
 That's it!
@@ -49,14 +49,24 @@ SKIP_TRIGGERS = ['help', 'commands']
 
 
 def setup(bot):
-    bbot = BulletBot()
-    bbot.db.create_all(bbot.db_settings)
-    Base.metadata.create_all(bbot.db.engine)
+    parser = BulletBot.get_parser()
+    db_settings = BulletBot.get_db_settings(parser.parse_known_args()[0])
+    # Handlers run on executor threads, give each its own session.  The
+    # journal replayer and spell checker share it too.
+    db = SQLAlchemyDriver(scoped=True, **db_settings)
+    db.ensure_schema(db_settings)
+    threading.Thread(target=db.warm_up, name='warm-up', daemon=True).start()
+    bbot = BulletBot(db, parser=parser)
+    bbot.help_message = HELP_MESSAGE
+    bbot.setup_logging()
+    bbot.start_lanes()
     bot.memory['bbot'] = bbot
+    bot.memory['bbot_executor'] = bbot.lanes
+    bot.memory['bbot_batcher'] = BulletBatcher(bbot, bbot.lanes.lane(BULK))
 
 
 def shutdown(bot):
-    pass
+    bot.memory['bbot_executor'].shutdown()
 
 
 def bot_say(bot, text):
@@ -67,46 +77,40 @@ def bot_say(bot, text):
         bot.say(line)
 
 
-def strip_command(text):
-    return ' '.join(text.strip().split(' ')[1:])
+def submit(bot, trigger, func, *args):
+    """Run a blocking BulletBot call off of Sopel's handler thread,
+    ordered with the nick's other commands, and say the response.
 
+    """
 
-@commands('help')
-@require_privmsg
-def help(bot, trigger):
-    bot_say(bot, HELP_MESSAGE)
-
+    def run():
+        bot_say(bot, func(*args))
 
-@commands('list')
-@commands('ls')
-@require_privmsg
-def list_bullets(bot, trigger, found_match=None):
     bbot = bot.memory['bbot']
-    bot_say(bot, bbot.list_bullets(str(trigger.nick)))
+    nick = str(trigger.nick)
+    if not bbot.flood.allow(nick):
+        return bot_say(bot, bbot.flood_message)
+    bot.memory['bbot_executor'].submit(INTERACTIVE, nick, run)
 
 
-@commands('delete')
-@commands('rm')
+@rule('(.+)')
 @require_privmsg
-def delete_bullets(bot, trigger, found_match=None):
-    bbot = bot.memory['bbot']
-    text = strip_command(trigger.match.string)
-    bot_say(bot, bbot.delete_bullets(str(trigger.nick), text))
+def message(bot, trigger, found_match=None):
+    """Route commands through :class:`.CommandRouter`, anything else is
+    a bullet.
 
+    """
 
-@commands('register')
-@require_privmsg
-def register(bot, trigger, found_match=None):
     bbot = bot.memory['bbot']
-    realname = strip_command(trigger.match.string)
-    bot_say(bot, bbot.register_nick(str(trigger.nick), realname))
-
+    text = trigger.match.string.strip()
+    if not text or text in SKIP_TRIGGERS:
+        return
 
-@rule('^(?!\.)(.+)')
-@require_privmsg
-def new_bullet(bot, trigger, found_match=None):
-    bbot = bot.memory['bbot']
-    text = trigger.match.groups(0)[0]
-    if text in SKIP_TRIGGERS:
+    nick = str(trigger.nick)
+    if bbot.router.is_command(text):
+        cmd, _, text = text.partition(' ')
+        submit(bot, trigger, bbot.router.dispatch, bbot, nick, cmd, text)
         return
-    bot_say(bot, bbot.create_bullet(str(trigger.nick), text))
+
+    batcher = bot.memory['bbot_batcher']
+    batcher.add(nick, text, lambda r: bot_say(bot, r))
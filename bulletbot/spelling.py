@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.spelling
+----------------------------------
+
+Defines :class:`.Speller` and :class:`.Enricher`.
+
+Bullets are spell checked after they are written, on a small worker
+pool, so chat replies don't wait on dictionary lookups.  The corrected
+text is stored in :attr:`.Bullet.suggestion` and used by the emailed
+digest in place of the original.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import logging
+import re
+import threading
+
+from .executor import ENRICH
+from .models import Bullet
+
+
+class Speller(object):
+    """Spell checker over a pyenchant dictionary, with an LRU cache of
+    word lookups.
+
+    Example usage::
+
+        speller = Speller('en_US')
+        speller.correct('fixed  teh build')  # 'fixed the build'
+
+    """
+
+    _word = re.compile(r"\b[A-Za-z][A-Za-z']*\b")
+    _space = re.compile(r'\s+')
+    _skip = re.compile(r'(\w+://|www\.|[@#<`])\S*')
+
+    def __init__(self, lang='en_US', cache_size=10000):
+        """
+        :param str lang: enchant dictionary tag
+        :param int cache_size: Number of words whose lookups are cached
+
+        """
+
+        try:
+            import enchant
+        except ImportError:
+            raise RuntimeError('Spell checking requires pyenchant '
+                               '(pip install pyenchant)')
+
+        self.dictionary = enchant.Dict(lang)
+        self._lock = threading.Lock()
+        self.suggest = lru_cache(maxsize=cache_size)(self._suggest)
+
+    def _suggest(self, word):
+        """Return the best replacement for `word`, or None if it is
+        spelled correctly or there is no suggestion.
+
+        """
+
+        # enchant dictionaries are not safe to share between threads
+        with self._lock:
+            if self.dictionary.check(word):
+                return None
+            suggestions = self.dictionary.suggest(word)
+
+        return suggestions[0] if suggestions else None
+
+    def _correct_word(self, match):
+        word = match.group(0)
+        # Leave acronyms and CamelCase names alone, words mixed with
+        # digits never match
+        if word[1:] != word[1:].lower():
+            return word
+        return self.suggest(word) or word
+
+    def correct(self, text):
+        """Normalize whitespace and replace misspelled words.  Links,
+        mentions, channels and code are left as they are.
+
+        :param str text: The bullet text
+        :returns: :class:`str` the corrected text
+
+        """
+
+        text = self._space.sub(' ', text).strip()
+
+        parts, end = [], 0
+        for match in self._skip.finditer(text):
+            parts.append(self._word.sub(
+                self._correct_word, text[end:match.start()]))
+            parts.append(match.group(0))
+            end = match.end()
+        parts.append(self._word.sub(self._correct_word, text[end:]))
+
+        return ''.join(parts)
+
+
+class Enricher(object):
+    """Spell checks bullets on a background thread pool and stores the
+    suggestions.
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    # Set by :meth:`.BulletBot.start_lanes`
+    lanes = None
+
+    def __init__(self, db, speller, max_workers=1):
+        """
+        :param db: driver with a ``session()`` context manager
+        :param speller: :class:`.Speller`
+        :param int max_workers: Number of worker threads
+
+        """
+
+        self.db = db
+        self.speller = speller
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, ids):
+        """Schedule :meth:`enrich` for bullets by id, in the enrichment
+        lane if there is one.  Bullets are written on lane workers, so
+        this never waits for room in the lane: when it is full the
+        bullets go without suggestions.
+
+        :returns: :class:`concurrent.futures.Future`
+
+        """
+
+        if self.lanes is not None:
+            return self.lanes.try_submit(ENRICH, (ENRICH,),
+                                         self._enrich_logged, ids)
+        return self._pool.submit(self._enrich_logged, ids)
+
+    def _enrich_logged(self, ids):
+        try:
+            return self.enrich(ids)
+        except Exception as e:
+            self.logger.warning('Unable to spell check bullets %s: %s', ids, e)
+            raise
+
+    def enrich(self, ids):
+        """Store spelling suggestions for bullets by id.
+
+        :param list ids: :class:`list` of :attr:`.Bullet.id`
+        :returns: :class:`int` number of bullets corrected
+
+        """
+
+        count = 0
+        with self.db.session() as s:
+            for bullet in s.query(Bullet).filter(Bullet.id.in_(ids)):
+                corrected = self.speller.correct(bullet.bullet)
+                if corrected != bullet.bullet:
+                    bullet.suggestion = corrected
+                    count += 1
+
+        self.logger.info('Corrected %s of %s bullets', count, len(ids))
+        return count
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
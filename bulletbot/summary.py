@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.summary
+----------------------------------
+
+Top terms per user and for the whole digest.
+
+Each user's bullets are joined and tokenized with one pass of a
+compiled regex, counted with a :class:`collections.Counter`, and the
+per-user counters are summed into the team counter, so the whole
+snapshot is tokenized exactly once.
+"""
+
+from collections import Counter
+
+import re
+
+
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be been before being but
+by can could did do does doing done for from get got had has have he her
+him his how i if in into is it its just me more my no not of on one or
+our out over re so some than that the their them then there these they
+this to too up us was we were what when which while who will with would
+you your
+""".split())
+
+_word_pattern = re.compile(r"[a-z][a-z0-9'+#-]*[a-z0-9+#]")
+
+
+def term_counts(texts):
+    """Count the terms in a list of texts.
+
+    :param list texts: :class:`list` of :class:`str`
+    :returns: :class:`collections.Counter` of terms
+
+    """
+
+    words = _word_pattern.findall('\n'.join(texts).lower())
+    counts = Counter(words)
+    for word in STOPWORDS.intersection(counts):
+        del counts[word]
+    return counts
+
+
+def summarize(unsent_bullets, top=5):
+    """Top terms per user and overall.
+
+    :param dict unsent_bullets:
+        name to :class:`list` of bullet texts, as rendered in the digest
+    :param int top: terms to keep per user
+    :returns: ``(overall, per_user)`` lists of ``(term, count)``
+
+    """
+
+    overall = Counter()
+    per_user = {}
+    for name, texts in unsent_bullets.items():
+        counts = term_counts(texts)
+        overall.update(counts)
+        per_user[name] = counts.most_common(top)
+
+    return overall.most_common(top * 2), per_user
+
+
+def format_summary(unsent_bullets, top=5):
+    """Render the summary section at the top of the digest.
+
+    .. codeblock::
+
+        Top terms: deploy (12), review (8), pipeline (3)
+          User 1: deploy, pipeline
+          user2: review
+
+    """
+
+    overall, per_user = summarize(unsent_bullets, top)
+    if not overall:
+        return ''
+
+    lines = ['Top terms: {}'.format(', '.join(
+        '{} ({})'.format(term, count) for term, count in overall))]
+    for name, terms in per_user.items():
+        if terms:
+            lines.append('  {}: {}'.format(
+                name, ', '.join(term for term, _ in terms)))
+
+    return '\n'.join(lines)
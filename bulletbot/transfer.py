@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.transfer
+----------------------------------
+
+Streaming export and bulk import of bullet history.
+
+Exports read rows through a server-side cursor and write them out one
+batch at a time, so memory use does not depend on the size of the
+export.  Imports load chunks of rows per transaction, through ``COPY``
+on PostgreSQL.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import csv
+import gzip
+import io
+import itertools
+import logging
+import re
+import simplejson
+import sys
+import time
+
+from .models import ArchivedBullet, Bullet, User
+
+
+logger = logging.getLogger(__name__)
+
+
+EXPORT_COLUMNS = ['id', 'nick', 'bullet', 'datetime', 'last_sent']
+
+FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+def guess_format(path):
+    """Guess the export format from a file name, e.g. ``out.jsonl.gz``
+
+    :param str path: output path
+    :returns: :class:`str` one of :data:`FORMATS`
+
+    """
+
+    name = path[:-3] if path.endswith('.gz') else path
+    for fmt in FORMATS:
+        if name.endswith('.' + fmt):
+            return fmt
+    return 'csv'
+
+
+def bullet_rows(s, since=None, until=None, nick=None, sent=None,
+                include_archive=True, batch_size=1000):
+    """Stream bullets as tuples of :data:`EXPORT_COLUMNS`.
+
+    :param s: :class:`sqlalchemy.orm.session.Session`
+    :param datetime since: only bullets created at or after
+    :param datetime until: only bullets created before
+    :param str nick: only bullets by this nick
+    :param bool sent: only sent (True) or unsent (False) bullets
+    :param bool include_archive:
+        also export bullets moved to the archive, see
+        :mod:`bulletbot.retention`
+    :param int batch_size: rows fetched from the cursor at a time
+
+    """
+
+    models = [Bullet]
+    # The archive table is created by the first archive run
+    if include_archive and ArchivedBullet.__table__.exists(s.get_bind()):
+        models.append(ArchivedBullet)
+
+    queries = []
+    for model in models:
+        query = s.query(*[getattr(model, c) for c in EXPORT_COLUMNS])
+        if since is not None:
+            query = query.filter(model.datetime >= since)
+        if until is not None:
+            query = query.filter(model.datetime < until)
+        if nick is not None:
+            query = query.filter(model.nick == nick)
+        if sent is True:
+            query = query.filter(model.last_sent != None)  # noqa
+        elif sent is False:
+            query = query.filter(model.last_sent == None)  # noqa
+        queries.append(query)
+
+    query = queries[0]
+    if len(queries) > 1:
+        query = query.union_all(*queries[1:])
+
+    # stream_results asks psycopg2 for a named (server-side) cursor
+    return (query
+            .order_by(Bullet.id)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size))
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def open_text(path):
+    """Open `path` for writing text, gzipped if it ends in ``.gz``.
+    ``-`` is stdout.
+
+    """
+
+    if path == '-':
+        return sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', newline='')
+    return open(path, 'w', newline='')
+
+
+def write_csv(rows, fp):
+    writer = csv.writer(fp)
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow([row.id, row.nick, row.bullet,
+                         _isoformat(row.datetime), _isoformat(row.last_sent)])
+        count += 1
+    return count
+
+
+def write_jsonl(rows, fp):
+    count = 0
+    for row in rows:
+        fp.write(simplejson.dumps({
+            'id': row.id,
+            'nick': row.nick,
+            'bullet': row.bullet,
+            'datetime': _isoformat(row.datetime),
+            'last_sent': _isoformat(row.last_sent),
+        }))
+        fp.write('\n')
+        count += 1
+    return count
+
+
+def write_parquet(rows, path, batch_size=1000):
+    """Write rows to a snappy compressed Parquet file, one row group per
+    batch.  Requires :mod:`pyarrow`.
+
+    """
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export requires pyarrow '
+                           '(pip install pyarrow)')
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('nick', pa.string()),
+        ('bullet', pa.string()),
+        ('datetime', pa.timestamp('us', tz='UTC')),
+        ('last_sent', pa.timestamp('us')),
+    ])
+
+    def flush(writer, batch):
+        columns = list(zip(*batch))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type)
+             for col, field in zip(columns, schema)],
+            schema=schema))
+
+    count = 0
+    writer = pq.ParquetWriter(path, schema, compression='snappy')
+    try:
+        batch = []
+        for row in rows:
+            batch.append(tuple(row))
+            if len(batch) >= batch_size:
+                flush(writer, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            flush(writer, batch)
+            count += len(batch)
+    finally:
+        writer.close()
+
+    return count
+
+
+def export_rows(rows, path, fmt=None):
+    """Write streamed rows to `path`.
+
+    :param rows: iterable from :func:`bullet_rows`
+    :param str path: output path, ``.gz`` suffix compresses csv/jsonl
+    :param str fmt: one of :data:`FORMATS`, guessed from path if None
+    :returns: :class:`int` number of rows written
+
+    """
+
+    fmt = fmt or guess_format(path)
+    assert fmt in FORMATS, 'Unknown export format {}'.format(fmt)
+
+    if fmt == 'parquet':
+        return write_parquet(rows, path)
+
+    fp = open_text(path)
+    try:
+        if fmt == 'csv':
+            return write_csv(rows, fp)
+        return write_jsonl(rows, fp)
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+
+IMPORT_COLUMNS = ['nick', 'bullet', 'datetime', 'last_sent', 'source_id']
+
+_tz_pattern = re.compile(r'(Z|[+-]\d\d:?\d\d)$')
+_datetime_formats = [
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+]
+
+
+def parse_datetime(text):
+    """Parse an ISO 8601 timestamp like those written by the export.
+
+    :param str text: e.g. ``2016-01-11T17:30:00+00:00``
+    :returns: :class:`datetime`, None if text is empty
+
+    """
+
+    if not text:
+        return None
+
+    tz = None
+    match = _tz_pattern.search(text)
+    if match:
+        text = text[:match.start()]
+        offset = match.group(1).replace(':', '')
+        if offset == 'Z':
+            tz = timezone.utc
+        else:
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            sign = -1 if offset[0] == '-' else 1
+            tz = timezone(timedelta(minutes=sign * minutes))
+
+    for fmt in _datetime_formats:
+        try:
+            value = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return value.replace(tzinfo=tz) if tz else value
+
+    raise ValueError('Unrecognized timestamp {!r}'.format(text))
+
+
+def open_text_input(path):
+    """Open `path` for reading text, gunzipped if it ends in ``.gz``.
+    ``-`` is stdin.
+
+    """
+
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+
+def read_records(fp, fmt):
+    """Read bullet records from a csv or jsonl file.  Only the nick and
+    bullet fields are required; a ``realname`` field sets the user's
+    name.
+
+    :returns: generator of :class:`dict`
+
+    """
+
+    assert fmt in ('csv', 'jsonl'), 'Cannot import {}'.format(fmt)
+    records = (csv.DictReader(fp) if fmt == 'csv'
+               else (simplejson.loads(line) for line in fp if line.strip()))
+
+    for record in records:
+        now = datetime.now(timezone.utc)
+        yield {
+            'nick': record['nick'],
+            'bullet': record['bullet'],
+            'datetime': parse_datetime(record.get('datetime')) or now,
+            'last_sent': parse_datetime(record.get('last_sent')),
+            'source_id': record.get('source_id') or None,
+            'realname': record.get('realname') or None,
+        }
+
+
+def _upsert_users(conn, records):
+    """Insert users that don't exist yet, one query to look them up and
+    one executemany to insert them.
+
+    """
+
+    realnames = {}
+    for record in records:
+        realnames.setdefault(record['nick'], record['realname'])
+
+    users = User.__table__
+    existing = set(row.nick for row in conn.execute(
+        users.select().with_only_columns([users.c.nick])
+        .where(users.c.nick.in_(list(realnames)))))
+
+    missing = [{'nick': nick, 'realname': realname}
+               for nick, realname in realnames.items()
+               if nick not in existing]
+    if missing:
+        conn.execute(users.insert(), missing)
+
+
+def _copy_bullets(conn, records):
+    """Load bullets with PostgreSQL ``COPY ... FROM STDIN``"""
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for record in records:
+        writer.writerow([
+            '' if record[c] is None else
+            record[c].isoformat() if isinstance(record[c], datetime) else
+            record[c]
+            for c in IMPORT_COLUMNS
+        ])
+    buf.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        'COPY bullets ({}) FROM STDIN WITH CSV'.format(
+            ', '.join(IMPORT_COLUMNS)),
+        buf)
+
+
+def _insert_bullets(conn, records):
+    """Load bullets with a single executemany"""
+
+    conn.execute(Bullet.__table__.insert(), [
+        {c: record[c] for c in IMPORT_COLUMNS} for record in records
+    ])
+
+
+def import_records(engine, records, chunk_size=10000):
+    """Load bullet records, one transaction per chunk.
+
+    :param engine: :class:`sqlalchemy.engine.Engine`
+    :param records: iterable from :func:`read_records`
+    :param int chunk_size: records loaded per transaction
+    :returns: :class:`int` number of bullets loaded
+
+    """
+
+    load = (_copy_bullets if engine.dialect.name == 'postgresql'
+            else _insert_bullets)
+
+    records = iter(records)
+    count, start = 0, time.time()
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+
+        with engine.begin() as conn:
+            _upsert_users(conn, chunk)
+            load(conn, chunk)
+
+        count += len(chunk)
+        elapsed = time.time() - start
+        logger.info('Imported %s bullets (%.0f rows/s)',
+                    count, count / elapsed if elapsed else 0)
+
+    return count
+
+
+def import_path(engine, path, fmt=None, chunk_size=10000):
+    """Load bullets from a csv or jsonl file.
+
+    :param str path: input path, ``.gz`` files are decompressed
+    :param str fmt: ``csv`` or ``jsonl``, guessed from path if None
+    :returns: :class:`int` number of bullets loaded
+
+    """
+
+    fmt = fmt or guess_format(path)
+    fp = open_text_input(path)
+    try:
+        return import_records(engine, read_records(fp, fmt), chunk_size)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
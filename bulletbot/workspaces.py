@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+bulletbot.workspaces
+----------------------------------
+
+Defines :class:`.SlackWorkspaces`, which serves many Slack workspaces
+from one process.
+
+Each workspace is a :class:`.WorkspaceBot` that shares the host's
+settings, database driver (and so its connection pool), journal, page
+cursors and spell checker, and owns only its websocket and seen
+message cache.  Users are stored with their nick prefixed by the
+workspace id and bullets record the workspace in
+:attr:`.Bullet.tenant`, so workspaces never see each other's rows.
+
+The websockets are spread over ``--workers`` threads, each waiting on
+its share of sockets with :mod:`selectors`.
+
+Example usage::
+
+    $ bin/slack_bulletbot --slack-tokens xoxb-1,xoxb-2
+"""
+
+import logging
+import selectors
+import threading
+import time
+
+from .bulletbot import BulletBot
+from .slack import SlackBulletBot
+
+
+class WorkspaceBot(SlackBulletBot):
+    """One workspace served by a :class:`.SlackWorkspaces` host"""
+
+    def __init__(self, host, token):
+        """
+        :param host: :class:`.SlackWorkspaces` to share resources with
+        :param str token: the workspace's bot token
+
+        """
+
+        self.host = host
+        super(WorkspaceBot, self).__init__(host.db, token)
+        self.args = host.args
+        # Nicks are qualified, so workspaces can share the cursors the
+        # host's journal replayer invalidates
+        self.page_cursors = host.page_cursors
+
+    # The host's router, journal, spell checker, lanes and recorder are
+    # shared by all of its workspaces
+
+    def get_router(self):
+        self.command_timer = self.host.command_timer
+        return self.host.router
+
+    def get_journal(self):
+        self.replayer = getattr(self.host, 'replayer', None)
+        return self.host.journal
+
+    def get_enricher(self):
+        return self.host.enricher
+
+    def start_lanes(self):
+        self.lanes = self.host.lanes
+        self.flood = self.host.flood
+
+    def get_recorder(self):
+        return self.host.recorder
+
+    def rtm_connect(self):
+        """Connect the websocket and take the workspace id as tenant.
+
+        :returns: :class:`bool` True if connected
+
+        """
+
+        if not self.sc.rtm_connect():
+            return False
+        self.tenant = self.sc.server.login_data['team']['id']
+        self.logger.info('Connected to workspace %s', self.tenant)
+        return True
+
+
+class WorkspaceWorker(threading.Thread):
+    """Thread reading the websockets of a share of the workspaces"""
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, bots, retry_interval=1):
+        """
+        :param list bots: :class:`list` of :class:`.WorkspaceBot`
+        :param float retry_interval: seconds between reconnects
+
+        """
+
+        super(WorkspaceWorker, self).__init__(name='workspaces')
+        self.daemon = True
+        self.bots = bots
+        self.retry_interval = retry_interval
+        self.selector = selectors.DefaultSelector()
+        self.disconnected = list(bots)
+
+    def connect(self):
+        """Try to connect every disconnected workspace once."""
+
+        for bot in list(self.disconnected):
+            try:
+                connected = bot.rtm_connect()
+            except Exception as e:
+                self.logger.exception(e)
+                connected = False
+
+            if connected:
+                self.disconnected.remove(bot)
+                self.selector.register(
+                    bot.sc.server.websocket.sock, selectors.EVENT_READ, bot)
+            else:
+                self.logger.error("Connection Failed, invalid token?")
+                bot.reset_sc()
+
+    def run(self):
+        last_attempt = 0
+        while True:
+            if self.disconnected and (time.time() - last_attempt >
+                                      self.retry_interval):
+                last_attempt = time.time()
+                self.connect()
+
+            if not self.selector.get_map():
+                time.sleep(self.retry_interval)
+                continue
+
+            for key, _ in self.selector.select(timeout=self.retry_interval):
+                bot = key.data
+                try:
+                    bot._parse_reads(bot.rtm_read())
+                except Exception as e:
+                    self.logger.exception(e)
+                    self.selector.unregister(key.fileobj)
+                    bot.reset_sc()
+                    self.disconnected.append(bot)
+
+
+class SlackWorkspaces(BulletBot):
+    """Host for many Slack workspace connections in one process"""
+
+    # The workspace bots share this router
+    excluded_commands = SlackBulletBot.excluded_commands
+
+    def __init__(self, db=None, tokens=None):
+        """
+        :param db: driver shared by all workspaces
+        :param list tokens: bot tokens, defaults to ``--slack-tokens``
+
+        """
+
+        super(SlackWorkspaces, self).__init__(db)
+        if tokens is None:
+            tokens = [token.strip()
+                      for token in (self.args.slack_tokens or '').split(',')
+                      if token.strip()]
+        assert tokens, 'No slack tokens specified'
+        self.start_lanes()
+        self.recorder = None
+        if self.args.record_rtm:
+            from .replay import Recorder
+            self.recorder = Recorder(self.args.record_rtm,
+                                     self.args.record_anonymize)
+        self.bots = [WorkspaceBot(self, token) for token in tokens]
+
+    def listen(self):
+        """Blocking call that serves every workspace."""
+
+        self.prepare_db()
+
+        n = max(1, min(self.args.workers, len(self.bots)))
+        workers = [WorkspaceWorker(self.bots[i::n]) for i in range(n)]
+        for worker in workers:
+            worker.start()
+
+        self.logger.info('Serving %s workspaces on %s threads',
+                         len(self.bots), n)
+        for worker in workers:
+            worker.join()
@@ -30,6 +30,7 @@ requirements = [
 
 test_requirements = [
     'pytest',
+    'pytest-xdist',
 ]
 
 setup(
@@ -44,6 +45,7 @@ setup(
     package_dir={'bulletbot': 'bulletbot'},
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.5',
     license="ISCL",
     zip_safe=False,
     keywords='bulletbot',
@@ -53,8 +55,6 @@ setup(
         'License :: OSI Approved :: ISC License (ISCL)',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
     ],
     test_suite='tests',
@@ -2,13 +2,12 @@
 """BulletBot module for Sopel"""
 
 from sopel.config.types import StaticSection, NO_DEFAULT, ValidatedAttribute
-from sopel.module import rule, commands, example, require_privmsg
-import sopel.module
-import re
+from sopel.module import rule, require_privmsg
+import threading
 
 from bulletbot.driver import SQLAlchemyDriver
 from bulletbot.bulletbot import BulletBot
-from bulletbot.models import Base
+from bulletbot.executor import BULK, INTERACTIVE, BulletBatcher
 
 
 HELP_MESSAGE = """
@@ -17,8 +16,12 @@ To use the bullet bot, just talk to it throughout the day Each
 time you hit enter, I'll add a bullet.
 
 Other commands:
-   .list                      - will list bullets from today
+   .list [--page <no.>]       - will list bullets from today
    .delete <no.> [<no. 2>]    - will delete a bullet from today
+   .search <terms>            - search all of your bullets
+   .history [<from>] [<to>]   - page through your bullets by date
+   .stats [<nick>|all] [week] - bullet counts and streaks
+   .team [<name>]             - join a team, its digest gets your bullets
    .register <name >          - register the name to use on your bullets
 
 That's it!
@@ -32,6 +35,7 @@ class BulletBotSection(StaticSection):
     user = ValidatedAttribute('user', default=NO_DEFAULT)
     password = ValidatedAttribute('password', default=NO_DEFAULT)
     database = ValidatedAttribute('database', default='bullets')
+    workers = ValidatedAttribute('workers', int, default=4)
 
 
 def configure(config):
@@ -53,15 +57,22 @@ def setup(bot):
         user=bot.config.bulletbot.user,
         password=bot.config.bulletbot.password,
         database=bot.config.bulletbot.database,
+        scoped=True,
     )
     db = SQLAlchemyDriver.from_settings(db_settings)
-    db.create_all(db_settings)
-    Base.metadata.create_all(db.engine)
-    bot.memory['bbot'] = BulletBot(db)
+    db.ensure_schema(db_settings)
+    threading.Thread(target=db.warm_up, name='warm-up', daemon=True).start()
+    bbot = BulletBot(db)
+    bbot.help_message = HELP_MESSAGE
+    bbot.args.workers = bot.config.bulletbot.workers
+    bbot.start_lanes()
+    bot.memory['bbot'] = bbot
+    bot.memory['bbot_executor'] = bbot.lanes
+    bot.memory['bbot_batcher'] = BulletBatcher(bbot, bbot.lanes.lane(BULK))
 
 
 def shutdown(bot):
-    pass
+    bot.memory['bbot_executor'].shutdown()
 
 
 def bot_say(bot, text):
@@ -71,47 +82,35 @@ def bot_say(bot, text):
         bot.say(line)
 
 
-def strip_command(text):
-    return ' '.join(text.strip().split(' ')[1:])
+def submit(bot, trigger, func, *args):
+    def run():
+        bot_say(bot, func(*args))
 
-
-@rule('[help|commands]')
-@commands('help')
-@require_privmsg
-def help(bot, trigger):
-    bot_say(bot, HELP_MESSAGE)
-
-
-@commands('list')
-@commands('ls')
-@require_privmsg
-def list_bullets(bot, trigger, found_match=None):
     bbot = bot.memory['bbot']
-    bot_say(bot, bbot.list_bullets(str(trigger.nick)))
+    nick = str(trigger.nick)
+    if not bbot.flood.allow(nick):
+        return bot_say(bot, bbot.flood_message)
+    bot.memory['bbot_executor'].submit(INTERACTIVE, nick, run)
 
 
-@rule('^(?!\.)(.+)')
+@rule('(.+)')
 @require_privmsg
-def new_bullets(bot, trigger, found_match=None):
-    bbot = bot.memory['bbot']
-    text = strip_command(trigger.match.groups(0))
-    if text in SKIP_TRIGGERS:
-        return
-    bot_say(bot, bbot.create_bullet(str(trigger.nick), text))
+def message(bot, trigger, found_match=None):
+    """Route commands through :class:`.CommandRouter`, anything else is
+    a bullet.
 
+    """
 
-@commands('delete')
-@commands('rm')
-@require_privmsg
-def delete_bullets(bot, trigger, found_match=None):
     bbot = bot.memory['bbot']
-    text = strip_command(trigger.match.string)
-    bot_say(bot, bbot.delete_bullets(str(trigger.nick), text))
+    text = trigger.group(1).strip()
+    if not text or text in SKIP_TRIGGERS:
+        return
 
+    nick = str(trigger.nick)
+    if bbot.router.is_command(text):
+        cmd, _, text = text.partition(' ')
+        submit(bot, trigger, bbot.router.dispatch, bbot, nick, cmd, text)
+        return
 
-@commands('register')
-@require_privmsg
-def register(bot, trigger, found_match=None):
-    bbot = bot.memory['bbot']
-    realname = strip_command(trigger.match.string)
-    bot_say(bot, bbot.register_nick(str(trigger.nick), realname))
+    batcher = bot.memory['bbot_batcher']
+    batcher.add(nick, text, lambda r: bot_say(bot, r))
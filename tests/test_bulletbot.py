@@ -6,58 +6,112 @@ test_bulletbot
 ----------------------------------
 
 Tests for `bulletbot` module.
+
+The test database is emptied and seeded once per process.  Each test
+then runs inside :meth:`.SQLAlchemyDriver.isolated`, so whatever it
+writes is rolled back.  Under pytest-xdist (``py.test -n 4``) every
+worker gets its own database.  Set ``BBOT_BACKEND=sqlite`` to run
+against a sqlite file instead of PostgreSQL.
 """
 
+import asyncio
+import contextlib
+import gzip
+import io
 import os
+import simplejson
+import sqlalchemy
+import subprocess
 import sys
+import tempfile
+import time
 import unittest
+import unittest.mock
 
 import bulletbot
+from bulletbot import (
+    commands, history, log, queries, replay, workspaces)
 from bulletbot.driver import SQLAlchemyDriver
+from bulletbot.executor import (
+    BULK, ENRICH, INTERACTIVE, FloodLimiter, LaneExecutor)
 from bulletbot.bulletbot import BulletBot
+from bulletbot.aio import AsyncBulletBot
+from bulletbot.journal import BulletJournal, JournalReplayer
+from bulletbot.profiling import Profiler
+from bulletbot.spelling import Enricher, Speller
 
 import logging
 logging.root.setLevel(level=logging.DEBUG)
 
 
 from bulletbot.models import (
-    Recipient,
+    Base,
     User,
     Bullet,
+    ArchivedBullet,
+    schema_version,
 )
 
 
+TEST_BULLETS = [
+    'bullet A',
+    'test bullet B',
+    'third',
+]
+
+# Set by pytest-xdist, e.g. gw0
+worker = os.environ.get('PYTEST_XDIST_WORKER')
+database = '__test_bulletbot{}__'.format('_' + worker if worker else '')
+
 os.environ['BBOT_HOST'] = 'localhost'
 os.environ['BBOT_USER'] = 'test'
 os.environ['BBOT_PASS'] = 'password'
-os.environ['BBOT_DATABASE'] = '__test_bulletbot__'
+os.environ.setdefault('BBOT_BACKEND', 'postgresql')
+if os.environ['BBOT_BACKEND'] == 'sqlite':
+    database = os.path.join(tempfile.gettempdir(), database + '.db')
+os.environ['BBOT_DATABASE'] = database
 
 bbot = BulletBot()
 db = bbot.db
-db.create_all(bbot.db_settings)
-bulletbot.models.Base.metadata.create_all(db.engine)
+db.ensure_schema(bbot.db_settings)
+
+
+def seed():
+    """Empty the tables and insert the bullets every test starts with,
+    one statement per table.
+
+    """
+
+    with db.engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            if table is not schema_version:
+                conn.execute(table.delete())
+        conn.execute(User.__table__.insert(), [{'nick': 'nick'}])
+        conn.execute(Bullet.__table__.insert(), [
+            {'nick': 'nick', 'bullet': bullet} for bullet in TEST_BULLETS])
+
+
+seed()
+
+
+class Unprintable(object):
+    """Fails if a disabled log call formats it"""
+
+    def __str__(self):
+        raise AssertionError('formatted a disabled log message')
 
 
 class TestBulletbot(unittest.TestCase):
 
-    test_bullets = [
-        'bullet A',
-        'test bullet B',
-        'third',
-    ]
+    test_bullets = TEST_BULLETS
 
     def setUp(self):
-        with db.session() as s:
-            s.query(Recipient).delete()
-            s.query(Bullet).delete()
-            s.query(User).delete()
+        stack = contextlib.ExitStack()
+        stack.enter_context(db.isolated())
+        self.addCleanup(stack.close)
         self.bot = bbot
         self.bot.logger.level = logging.DEBUG
-        self.create_bullets()
-
-    def create_bullets(self):
-        for bullet in self.test_bullets:
-            self.bot.create_bullet('nick', bullet)
+        self.bot.page_cursors.invalidate()
 
     def test_tokenize(self):
         self.assertEqual(self.bot.tokenize('1, 2 test'), ['1', '2', 'test'])
@@ -70,6 +124,13 @@ class TestBulletbot(unittest.TestCase):
                 self.assertEqual(bullet.nick, 'nick')
                 self.assertIn(bullet.bullet, self.test_bullets)
 
+    def test_create_bullets(self):
+        self.assertEqual(self.bot.create_bullets('nick', ['four', 'five']),
+                         ['Wrote bullet: four', 'Wrote bullet: five'])
+        self.assertEqual(self.bot.list_bullets('nick'),
+                         "0. bullet A\n1. test bullet B\n2. third"
+                         "\n3. four\n4. five")
+
     def test_list(self):
         self.assertEqual(self.bot.list_bullets('nick'),
                          "0. bullet A\n1. test bullet B\n2. third")
@@ -92,6 +153,483 @@ class TestBulletbot(unittest.TestCase):
         self.assertEqual(self.bot.delete_bullets('nick', '3'),
                          "Bullet 3 not found.")
 
+    def test_async_create_list(self):
+        abot = AsyncBulletBot(self.bot, loop=asyncio.new_event_loop())
+        abot.loop.run_until_complete(abot.create_bullet('nick', 'fourth'))
+        self.assertEqual(
+            abot.loop.run_until_complete(abot.list_bullets('nick')),
+            "0. bullet A\n1. test bullet B\n2. third\n3. fourth")
+        abot.close()
+        abot.loop.close()
+
+    def test_journal_replay(self):
+        journal = BulletJournal(tempfile.mkdtemp())
+        journal.defer(journal.append('nick', ['fourth', 'fourth'],
+                                     ['C1:1/0', 'C1:1/0']))
+        self.assertEqual(len(BulletJournal(os.path.dirname(journal.path))
+                             .pending), 2)
+        cursors = history.PageCursors()
+        cursors.set(('nick', 'unsent'), 2, 'stale')
+        self.assertEqual(JournalReplayer(journal, db, cursors=cursors)
+                         .replay(), 1)
+        self.assertEqual(cursors.nearest(('nick', 'unsent'), 2), (1, None))
+        self.assertEqual(journal.pending, {})
+        self.assertEqual(BulletJournal(os.path.dirname(journal.path))
+                         .pending, {})
+        self.assertIn('3. fourth', self.bot.list_bullets('nick'))
+
+    def test_journal_quarantine(self):
+        journal = BulletJournal(tempfile.mkdtemp())
+        journal._compact_bytes = 0
+        unacked = journal.append('nick', ['fourth'])
+        bad, = journal.append('nick', ['fifth'])
+        journal.defer([dict(bad, datetime='not a date')])
+        self.assertEqual(JournalReplayer(journal, db, max_attempts=1)
+                         .replay(), 0)
+        self.assertEqual(journal.pending, {})
+        with open(journal.quarantine_path) as fp:
+            self.assertEqual(simplejson.loads(fp.read())['bullet'], 'fifth')
+
+        # Appended but unacknowledged records survive compaction
+        with open(journal.path) as fp:
+            self.assertIn(unacked[0]['id'], fp.read())
+
+    def test_create_bullets_duplicate_source(self):
+        self.bot.create_bullets('nick', ['fourth'], source='C1:1')
+        self.bot.create_bullets('nick', ['fourth'], source='C1:1')
+        self.assertEqual(self.bot.list_bullets('nick'),
+                         "0. bullet A\n1. test bullet B\n2. third"
+                         "\n3. fourth")
+
+    def test_create_bullets_other_integrity_error(self):
+        error = sqlalchemy.exc.IntegrityError('INSERT', {}, Exception())
+        with unittest.mock.patch.object(
+                self.bot, 'flag_duplicate', side_effect=error):
+            with self.assertRaises(sqlalchemy.exc.IntegrityError):
+                self.bot.create_bullets('nick', ['fourth'], source='C1:2')
+
+    def test_export_jsonl(self):
+        path = os.path.join(tempfile.mkdtemp(), 'bullets.jsonl')
+        self.assertEqual(self.bot.export_bullets(path, sent=False), 3)
+        with open(path) as fp:
+            self.assertEqual(
+                [simplejson.loads(line)['bullet'] for line in fp],
+                self.test_bullets)
+
+    def test_import_csv(self):
+        path = os.path.join(tempfile.mkdtemp(), 'bullets.csv.gz')
+        self.bot.export_bullets(path)
+        self.assertEqual(self.bot.import_bullets(path, chunk_size=2), 3)
+        self.assertEqual(len(self.bot.list_bullets('nick').split('\n')), 6)
+
+    def test_search(self):
+        results = self.bot.search_bullets('bullet', nick='nick', limit=1)
+        self.assertEqual(len(results), 1)
+        results += self.bot.search_bullets('bullet', nick='nick',
+                                           after=results[-1])
+        self.assertEqual(sorted(r.bullet for r in results),
+                         ['bullet A', 'test bullet B'])
+        self.assertEqual(self.bot.search('other', 'bullet'),
+                         "No bullets found.")
+
+    def test_list_page(self):
+        self.bot._page_size = 2
+        try:
+            self.assertEqual(self.bot.list_bullets('nick'),
+                             "0. bullet A\n1. test bullet B\n"
+                             "... more on `.list --page 2`")
+            self.assertEqual(self.bot.list_bullets('nick', '--page 2'),
+                             "2. third")
+            self.assertEqual(self.bot.list_bullets('nick', '--page 3'),
+                             "No page 3.")
+        finally:
+            del self.bot._page_size
+
+    def test_history(self):
+        self.bot.mark_all_sent()
+        rows, has_more = self.bot.history_bullets('nick', limit=2, page=2)
+        self.assertEqual([r.bullet for r in rows], ['third'])
+        self.assertFalse(has_more)
+        self.assertEqual(self.bot.history('nick', '2000-01-01 2000-01-02'),
+                         "No bullets found.")
+
+    def test_archive(self):
+        self.bot.mark_all_sent()
+        with db.session() as s:
+            s.query(Bullet).filter_by(bullet='third').update(
+                {'suggestion': 'thrid'})
+        dump_dir = tempfile.mkdtemp()
+        self.assertEqual(
+            self.bot.archive_bullets(days=0, dump_dir=dump_dir), 3)
+        self.assertEqual(self.bot.history_bullets('nick'), ([], False))
+        with db.session() as s:
+            self.assertEqual(s.query(ArchivedBullet.suggestion)
+                             .filter_by(bullet='third').scalar(), 'thrid')
+        path, = [os.path.join(dump_dir, name)
+                 for name in os.listdir(dump_dir)]
+        with gzip.open(path, 'rt') as fp:
+            dumped = [simplejson.loads(line) for line in fp]
+        self.assertEqual(sorted(d['bullet'] for d in dumped),
+                         sorted(self.test_bullets))
+        self.assertIn('tenant', dumped[0])
+        rows, _ = self.bot.history_bullets('nick', include_archive=True)
+        self.assertEqual([r.bullet for r in rows], self.test_bullets)
+
+        self.bot.create_bullet('nick', 'fourth')
+        path = os.path.join(tempfile.mkdtemp(), 'bullets.jsonl')
+        self.assertEqual(self.bot.export_bullets(path), 4)
+        with open(path) as fp:
+            self.assertEqual(
+                sorted(simplejson.loads(line)['bullet'] for line in fp),
+                sorted(self.test_bullets + ['fourth']))
+        self.assertEqual(self.bot.export_bullets(path, include_archive=False),
+                         1)
+
+        # _ in a term isn't a LIKE wildcard
+        self.assertEqual(
+            self.bot.search_bullets('bullet_A', include_archive=True), [])
+        self.assertEqual(
+            sorted(r.bullet for r in
+                   self.bot.search_bullets('bullet', include_archive=True)),
+            ['bullet A', 'test bullet B'])
+
+    def test_stats(self):
+        self.bot.refresh_rollups(backfill=True)
+        stats, = self.bot.activity_stats('nick')
+        self.assertEqual((stats.total, stats.active_days, stats.streak),
+                         (3, 1, 1))
+        self.assertEqual(self.bot.stats('nick', 'other'),
+                         "No bullets in the last week.")
+
+    def test_digest_summary(self):
+        digest = self.bot.compile_plaintext_bullets(summarize=True)
+        self.assertTrue(digest.startswith(
+            'Top terms: bullet (2), test (1), third (1)\n'
+            '  nick: bullet, test, third\n'))
+
+    def test_collapse_duplicates(self):
+        self.bot.create_bullets('nick', ['code review', 'Code review.'])
+        with db.session() as s:
+            first, second = (s.query(Bullet)
+                             .filter(Bullet.bullet.ilike('code review%'))
+                             .order_by(Bullet.id).all())
+            self.assertEqual(second.duplicate_of, first.id)
+
+        digest = self.bot.compile_plaintext_bullets(collapse=True)
+        self.assertIn('  - code review (x2)', digest)
+        self.assertNotIn('Code review.', digest)
+
+    def test_spellcheck(self):
+        self.bot.create_bullets('nick', ['fixd  the buidl', 'the build'])
+        with db.session() as s:
+            ids = [b.id for b in s.query(Bullet).filter(
+                Bullet.bullet.in_(['fixd  the buidl', 'the build']))]
+
+        enricher = Enricher(db, Speller())
+        self.assertEqual(enricher.submit(ids).result(), 1)
+        enricher.shutdown()
+
+        with db.session() as s:
+            suggestions = dict(s.query(Bullet.bullet, Bullet.suggestion)
+                               .filter(Bullet.id.in_(ids)))
+        self.assertIsNone(suggestions['the build'])
+        self.assertNotEqual(suggestions['fixd  the buidl'], 'fixd  the buidl')
+        self.assertIn(suggestions['fixd  the buidl'],
+                      self.bot.compile_plaintext_bullets())
+
+    def test_team_digests(self):
+        self.bot.create_bullet('other', 'other bullet')
+        self.assertEqual(self.bot.join_team('other', 'infra'),
+                         'other joined team infra')
+
+        digests, ids = self.bot.compile_team_digests()
+        self.assertEqual(set(digests), {None, 'infra'})
+        self.assertEqual(digests['infra'], '[other]\n  - other bullet')
+        self.assertNotIn('other bullet', digests[None])
+        self.assertEqual(len(ids['infra']), 1)
+        self.assertEqual(len(ids[None]), len(self.test_bullets))
+
+        self.bot.create_bullet('nick', 'late bullet')
+        self.assertEqual(self.bot.mark_sent(ids[None] + ids['infra']),
+                         len(self.test_bullets) + 1)
+        self.assertEqual(list(self.bot.get_unsent_bullets()), ['nick'])
+
+    def test_team_digests_partial_send(self):
+        self.bot.create_bullet('other', 'other bullet')
+        self.bot.join_team('other', 'infra')
+
+        bot = BulletBot(db)
+        bot.args.email_to = 'bullets@example.com'
+        bot._connect_smtp = lambda: unittest.mock.Mock()
+
+        def send(server, to, text, team=None):
+            if team == 'infra':
+                raise IOError('relay down')
+        bot._send_email = send
+
+        with self.assertRaises(IOError):
+            bot.send_team_digests()
+        # Users without a team were sent before infra failed
+        self.assertEqual(list(bot.get_unsent_bullets()), ['other'])
+
+    def test_team_schedule(self):
+        self.bot.set_team_schedule('london', hour='17', minute='30',
+                                   timezone='Europe/London')
+        team, = [t for t in self.bot.team_schedules() if t.name == 'london']
+        self.assertEqual((team.cron_hour, team.cron_minute, team.timezone),
+                         ('17', '30', 'Europe/London'))
+
+    def test_import_time(self):
+        # The chat frontends import bulletbot.bulletbot on every start
+        lazy = ['markovify', 'apscheduler', 'smtplib', 'email.mime.text',
+                'bulletbot.schedule', 'bulletbot.transfer', 'enchant']
+        output = subprocess.check_output([sys.executable, '-c', '''
+import sys, time
+start = time.time()
+import bulletbot.bulletbot
+print(time.time() - start)
+print(' '.join(m for m in {} if m in sys.modules))
+'''.format(lazy)], universal_newlines=True)
+
+        elapsed, loaded = output.split('\n')[:2]
+        self.assertEqual(loaded, '')
+        self.assertLess(float(elapsed), 2.0)
+
+    def test_ensure_schema(self):
+        self.assertFalse(db.ensure_schema(bbot.db_settings))
+        self.assertEqual(db.get_schema_version(),
+                         bulletbot.models.SCHEMA_VERSION)
+
+    def test_migrate(self):
+        path = os.path.join(tempfile.mkdtemp(), 'old.db')
+        old = SQLAlchemyDriver(None, None, None, path, backend='sqlite')
+        with old.engine.begin() as conn:
+            # The schema of the first release
+            conn.execute('CREATE TABLE users (nick VARCHAR PRIMARY KEY, '
+                         'realname VARCHAR, password VARCHAR)')
+            conn.execute('CREATE TABLE recipients (email VARCHAR PRIMARY '
+                         'KEY, is_addressee BOOLEAN)')
+            conn.execute('CREATE TABLE bullets (id INTEGER PRIMARY KEY, '
+                         'bullet VARCHAR, last_sent DATETIME, '
+                         'nick VARCHAR REFERENCES users (nick), '
+                         'datetime DATETIME NOT NULL '
+                         'DEFAULT CURRENT_TIMESTAMP)')
+            conn.execute("INSERT INTO users (nick) VALUES ('old')")
+            conn.execute("INSERT INTO bullets (bullet, nick) "
+                         "VALUES ('old deploy', 'old')")
+
+        self.assertTrue(old.ensure_schema({}))
+        self.assertEqual(old.get_schema_version(),
+                         bulletbot.models.SCHEMA_VERSION)
+        self.assertEqual(old.migrate(), [])
+        self.assertTrue(old.has_relation('ix_bullets_nick_datetime_id'))
+        bot = BulletBot(old)
+        self.assertEqual([r.bullet for r in
+                          bot.search_bullets('deploy', nick='old')],
+                         ['old deploy'])
+        bot.tenant = 'T1'
+        bot.create_bullet(bot.qualify('nick'), 'migrated bullet')
+        self.assertIn('migrated bullet', bot.list_bullets('T1/nick'))
+        bot.create_bullets(bot.qualify('nick'), ['sourced'], source='C1:1')
+        bot.create_bullets(bot.qualify('nick'), ['sourced'], source='C1:1')
+        self.assertEqual(bot.list_bullets('T1/nick').count('sourced'), 1)
+        self.assertEqual(bot.join_team('T1/nick', 'infra'),
+                         'nick joined team infra')
+        bot.set_team_schedule('infra', hour='9')
+        self.assertIn('9', [t.cron_hour for t in bot.team_schedules()])
+
+    def test_tenant(self):
+        tenant = BulletBot(db)
+        tenant.tenant = 'T1'
+        nick = tenant.qualify('nick')
+        self.assertEqual(nick, 'T1/nick')
+
+        tenant.create_bullet(nick, 'tenant bullet')
+        self.assertIn('tenant bullet', tenant.list_bullets(nick))
+        self.assertNotIn('tenant bullet', self.bot.list_bullets('nick'))
+        with db.session() as s:
+            bullet = s.query(Bullet).filter(Bullet.nick == nick).one()
+            self.assertEqual(bullet.tenant, 'T1')
+            self.assertEqual(bullet.user.tenant, 'T1')
+
+    def test_workspaces(self):
+        host = workspaces.SlackWorkspaces(db, tokens=['xoxb-1', 'xoxb-2'])
+        for tenant, bot in zip(['T1', 'T2'], host.bots):
+            self.assertIs(bot.command_timer, host.command_timer)
+            self.assertIs(bot.lanes, host.lanes)
+            bot.tenant = tenant
+            bot.sc = replay.StubSlackClient()
+            # Channel ids and timestamps repeat across workspaces
+            bot._parse_read({'channel': 'D1', 'user': 'U1',
+                             'text': 'same message', 'ts': '1'})
+        host.lanes.shutdown()
+
+        for bot in host.bots:
+            self.assertIn('same message', bot.list_bullets(bot.qualify('U1')))
+
+    def test_replica_routing(self):
+        # The test database stands in for its own replica
+        settings = dict(bbot.db_settings, replicas=[str(db.engine.url)])
+        driver = SQLAlchemyDriver(**settings)
+        bot = BulletBot(driver)
+        self.assertEqual(driver.replica_lag(driver.replicas[0]), 0.0)
+
+        with driver.isolated():
+            bot.create_bullet('nick', 'fourth')
+            self.assertTrue(driver.wrote_recently('nick'))
+            self.assertFalse(driver.wrote_recently('other'))
+            self.assertIn('fourth', bot.list_bullets('nick'))
+
+    def test_queries(self):
+        unsent = self.bot.get_unsent_bullets()
+        self.assertEqual([row.bullet for row in unsent['nick']],
+                         self.test_bullets)
+        with db.session() as s:
+            self.assertEqual(queries.unsent_at(s, 'nick', 1).bullet,
+                             'test bullet B')
+            self.assertIsNone(queries.unsent_at(s, 'nick', 3))
+        self.assertEqual(self.bot.mark_all_sent(), len(self.test_bullets))
+        self.assertEqual(self.bot.mark_all_sent(), 0)
+
+    def test_rtm_replay(self):
+        path = os.path.join(tempfile.mkdtemp(), 'rtm.jsonl.gz')
+        recorder = replay.Recorder(path, anonymize=True)
+        recorder.record([
+            {'channel': 'D1', 'user': 'replayer', 'text': 'secret work',
+             'ts': '1'},
+            {'channel': 'D1', 'user': 'replayer', 'text': '.list',
+             'ts': '2'},
+        ])
+        recorder.close()
+
+        (_, read), (_, command) = replay.load(path)
+        self.assertEqual(len(read['text']), len('secret work'))
+        self.assertNotIn('secret', read['text'])
+        self.assertEqual(command['text'], '.list')
+
+        stats = replay.replay(replay.ReplayBot(db, token='replay'), path,
+                              speed=0)
+        self.assertEqual(stats['events'], 2)
+        self.assertIn(read['text'], self.bot.list_bullets('replayer'))
+
+    def test_flood_limit(self):
+        bot = replay.ReplayBot(db, token='replay')
+        self.assertTrue(all(bot.flood.allow('flooder') for _ in range(100)))
+
+        bot.flood = FloodLimiter(rate=0.001, burst=1)
+        reads = [{'channel': 'D1', 'user': 'flooder', 'text': text,
+                  'ts': str(ts)}
+                 for ts, text in enumerate(['.list', 'one', 'two', '.list'],
+                                           start=1)]
+        # A redelivered command isn't charged
+        for read in reads[:1] + reads:
+            bot._parse_read(read)
+        bot.lanes.shutdown()
+
+        self.assertEqual(bot.flood.limited, 1)
+        self.assertIn('two', bot.list_bullets('flooder'))
+        # Every message got a reply, the second .list a slow down
+        self.assertEqual(bot.sc.server.channels.find('D1').sent, 4)
+
+    def test_redelivered_after_failure(self):
+        bot = replay.ReplayBot(db, token='replay')
+        read = {'channel': 'D1', 'user': 'retrier', 'text': 'retried',
+                'ts': '1'}
+        user_info = bot.get_user_info('retrier')
+        with unittest.mock.patch.object(
+                bot, 'get_user_info',
+                side_effect=[RuntimeError('users.info failed'), user_info]):
+            with self.assertRaises(RuntimeError):
+                bot._parse_read(read)
+            # Not marked seen, so the redelivery is stored, and only once
+            bot._parse_read(read)
+            bot._parse_read(read)
+        bot.lanes.shutdown()
+
+        self.assertEqual(bot.list_bullets('retrier').count('retried'), 1)
+
+    def test_profiler(self):
+        profiler = Profiler(tempfile.mkdtemp(), seconds=0.2)
+        prefix = profiler.capture()
+        for suffix in ['.stacks.txt', '.folded', '.heap', '.heap.txt']:
+            self.assertTrue(os.path.exists(prefix + suffix))
+        with open(prefix + '.stacks.txt') as fp:
+            self.assertIn('method=None', fp.read())
+
+    def test_lanes(self):
+        lanes = LaneExecutor(max_workers=1, shed_depth=2)
+        order = []
+        # Hold the only worker while the lanes fill up
+        lanes.submit(BULK, 'nick', time.sleep, 0.2)
+        time.sleep(0.05)
+        lanes.submit(ENRICH, 'enrich', order.append, ENRICH)
+        for nick in ['a', 'b', 'c']:
+            lanes.submit(BULK, nick, order.append, BULK)
+        lanes.submit(INTERACTIVE, 'd', order.append, INTERACTIVE).result()
+        lanes.shutdown()
+
+        self.assertEqual(order, [INTERACTIVE, BULK, BULK, BULK, ENRICH])
+        metrics = lanes.metrics()
+        self.assertEqual(metrics[BULK]['completed'], 4)
+        self.assertEqual(metrics['shed_count'], 1)
+
+        flood = FloodLimiter(rate=1, burst=2)
+        self.assertEqual([flood.allow('nick') for _ in range(3)],
+                         [True, True, False])
+
+    def test_lanes_submit_from_worker(self):
+        lanes = LaneExecutor(max_workers=1, max_depth=2)
+
+        def write():
+            # As create_bullets queues spell checking
+            return [lanes.submit(ENRICH, 'enrich', time.sleep, 0.01)
+                    for _ in range(5)]
+
+        futures = lanes.submit(BULK, 'nick', write).result(timeout=5)
+        lanes.shutdown()
+
+        self.assertEqual(sum(f.exception() is None for f in futures), 2)
+        self.assertEqual(lanes.metrics()[ENRICH]['dropped'], 3)
+
+    def test_commands(self):
+        router = commands.CommandRouter(exclude=('register',))
+        timer = commands.Timer()
+        router.use(timer)
+        router.use(commands.RateLimit(rate=1, burst=1), ['search'])
+
+        router.dispatch(self.bot, 'nick', '.rm', '0-1')
+        self.assertEqual(self.bot.list_bullets('nick'), "0. third")
+        self.assertEqual(router.dispatch(self.bot, 'nick', '.delete', '2-1'),
+                         router.lookup('delete').usage)
+        self.assertEqual(router.dispatch(self.bot, 'nick', '.history',
+                                         '2016-13-01'),
+                         router.lookup('history').usage)
+        self.assertTrue(router.dispatch(self.bot, 'nick', '.register', 'x')
+                        .startswith(self.bot.unknown_command))
+
+        self.assertIn('third',
+                      router.dispatch(self.bot, 'nick', '.search', 'third'))
+        self.assertIn('Too many',
+                      router.dispatch(self.bot, 'nick', '.search', 'third'))
+        self.assertEqual(timer.metrics()['search']['count'], 2)
+        self.assertEqual(timer.metrics()['delete']['count'], 1)
+
+    def test_log_pipeline(self):
+        stream = io.StringIO()
+        handler = log.setup_logging('INFO', 'json', max_length=10,
+                                    stream=stream)
+        try:
+            logging.getLogger('test').info('%s', 'x' * 100)
+            logging.getLogger('test').debug('%s', Unprintable())
+        finally:
+            log.stop_logging()
+            logging.root.removeHandler(handler)
+            logging.root.setLevel(logging.DEBUG)
+
+        entry = simplejson.loads(stream.getvalue())
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['message'], 'x' * 10 + '... (90 more chars)')
+
 
 if __name__ == '__main__':
     sys.exit(unittest.main())